@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# 每连接一条访问日志（替代逐包日志）+ 基于队列的异步日志输出
+
+import json
+import time
+import atexit
+import random
+import threading
+from queue import SimpleQueue
+from logging.handlers import QueueHandler, QueueListener
+
+from proxy_common import logger
+from metrics import metrics
+
+# 逐包跟踪的抽样比例（0~1），0 表示关闭，由 --trace-sample 设置
+TRACE_SAMPLE = 0.0
+
+
+def format_peer(address):
+    """('1.2.3.4', 80) -> '1.2.3.4:80'"""
+    if not address:
+        return None
+    ip, port, *rest = address
+    return f"[{ip}]:{port}" if ':' in ip else f"{ip}:{port}"
+
+
+class ConnectionRecord:
+    """单个连接的统计：客户端、远端、双向字节数、耗时、连接远端耗时、关闭原因"""
+    __slots__ = ('client', 'upstream', 'mode', 'start', 'connect_latency', 'bytes_up', 'bytes_down',
+                 'close_reason', 'traced', 'backend', 'admission', 'shaping', '_pending', '_lock')
+
+    def __init__(self, client):
+        self.client = format_peer(client)
+        self.upstream = None
+        self.mode = None  # 转发方式：copy / splice / event / event-tls
+        self.start = time.monotonic()
+        self.connect_latency = None
+        self.bytes_up = 0  # 客户端 -> 远端
+        self.bytes_down = 0  # 远端 -> 客户端
+        self.close_reason = None
+        self.traced = TRACE_SAMPLE > 0 and random.random() < TRACE_SAMPLE
+        self.backend = None  # 多远端模式下选中的 backends.Backend
+        self.admission = None  # 开启并发上限时占用的 admission.Admission 名额
+        self.shaping = None  # 开启带宽整形时的 shaping.Flow
+        self._pending = 2
+        self._lock = threading.Lock()
+        metrics.opened(self)
+
+    def connected(self, upstream, latency=None):
+        """latency 为 None 表示没有实际建连（如 mux 流复用已有长连接），不计入建连耗时统计"""
+        self.upstream = format_peer(upstream)
+        self.connect_latency = latency
+        if latency is not None:
+            metrics.connected(latency)
+
+    def direction_done(self, reason):
+        """线程模式下每个方向结束时调用一次，两个方向都结束后输出日志"""
+        with self._lock:
+            if self.close_reason is None:
+                self.close_reason = reason
+            self._pending -= 1
+            if self._pending:
+                return
+        self._emit()
+
+    def finish(self, reason):
+        """连接整体结束（连接失败或事件循环关闭连接），立即输出日志"""
+        with self._lock:
+            if self._pending <= 0:
+                return
+            self._pending = 0
+            if self.close_reason is None:
+                self.close_reason = reason
+        self._emit()
+
+    def summary(self):
+        return {
+            'client': self.client,
+            'upstream': self.upstream,
+            'mode': self.mode,
+            'bytes_up': self.bytes_up,
+            'bytes_down': self.bytes_down,
+            'duration_ms': round((time.monotonic() - self.start) * 1000, 1),
+            'connect_ms': None if self.connect_latency is None else round(self.connect_latency * 1000, 1),
+            'close_reason': self.close_reason,
+        }
+
+    def _emit(self):
+        metrics.closed(self, time.monotonic() - self.start, self.close_reason == 'connect_failed')
+        if self.backend is not None:
+            self.backend.release(self)
+        if self.admission is not None:
+            self.admission.release()
+        if self.shaping is not None:
+            self.shaping.release()
+        logger.info('Access %s', json.dumps(self.summary(), ensure_ascii=False))
+
+
+def start_async_logging(target_logger=logger):
+    """把日志处理器挪到后台线程：业务线程只负责入队，格式化后的写文件/写终端由 QueueListener 完成"""
+    handlers = [h for h in target_logger.handlers if not isinstance(h, QueueHandler)]
+    if not handlers:
+        return None
+    queue = SimpleQueue()
+    listener = QueueListener(queue, *handlers, respect_handler_level=True)
+    target_logger.handlers = [QueueHandler(queue)]
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# 准入控制：监听 backlog、并发连接上限（超限立即拒绝或排队等待）、有界的远端建连线程池
+
+import time
+import socket
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from proxy_common import logger
+
+# 监听队列长度（默认取系统上限），突发连接时避免 SYN 被丢弃、客户端等待重传
+LISTEN_BACKLOG = socket.SOMAXCONN
+# 并发连接上限，0 表示不限制
+MAX_CONNECTIONS = 0
+# 超限时排队等待空闲名额的最长时间（秒），0 表示立即拒绝
+QUEUE_TIMEOUT = 0
+# 远端建连线程池大小
+CONNECT_WORKERS = 32
+# 过载时汇总输出被拒绝连接数的最短间隔（秒）
+REJECT_LOG_INTERVAL = 10
+
+
+def reject(sock):
+    """拒绝连接：SO_LINGER 0 关闭直接发送 RST，客户端立即得到错误而不是等待超时"""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    except OSError:
+        pass
+    sock.close()
+
+
+class Admission:
+    """并发连接名额：admit() 占用，连接结束时 release() 归还"""
+
+    def __init__(self, max_conns=MAX_CONNECTIONS, queue_timeout=QUEUE_TIMEOUT):
+        self.max_conns = max_conns
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.queued = 0
+        self._reject_logged = 0  # 上次汇总日志时的 rejected
+        self._reject_log_time = 0.0
+        self._cond = threading.Condition()
+
+    def has_room(self):
+        return not self.max_conns or self.active < self.max_conns
+
+    def admit(self, wait=True):
+        """占用一个名额；已满时按 queue_timeout 排队等待（wait 为 False 时不等待），仍无名额返回 False"""
+        with self._cond:
+            if not self.has_room():
+                if not wait or self.queue_timeout <= 0:
+                    self.rejected += 1
+                    return False
+                self.queued += 1
+                if not self._cond.wait_for(self.has_room, self.queue_timeout):
+                    self.rejected += 1
+                    return False
+            self.active += 1
+            self.admitted += 1
+            return True
+
+    def log_rejected(self, interval=REJECT_LOG_INTERVAL):
+        """拒绝连接后调用：每 interval 秒最多输出一条汇总日志，过载时不为每个被拒绝的连接写一行"""
+        now = time.monotonic()
+        if now - self._reject_log_time < interval:
+            return
+        with self._cond:
+            count = self.rejected - self._reject_logged
+            self._reject_logged = self.rejected
+        self._reject_log_time = now
+        if count:
+            logger.warning(f'Connection limit {self.max_conns} reached, rejected {count} connections '
+                           f'(total {self.rejected}).')
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def render_metrics(self):
+        return [
+            '# HELP proxy_connection_limit Maximum concurrent connections (0 means unlimited).',
+            '# TYPE proxy_connection_limit gauge',
+            f'proxy_connection_limit {self.max_conns}',
+            '# HELP proxy_connections_rejected_total Connections rejected because the limit was reached.',
+            '# TYPE proxy_connections_rejected_total counter',
+            f'proxy_connections_rejected_total {self.rejected}',
+            '# HELP proxy_connections_queued_total Connections that waited for a free slot.',
+            '# TYPE proxy_connections_queued_total counter',
+            f'proxy_connections_queued_total {self.queued}',
+        ]
+
+    def stats(self):
+        return {'active': self.active, 'limit': self.max_conns, 'admitted': self.admitted,
+                'rejected': self.rejected, 'queued': self.queued}
+
+
+def connect_pool(workers=CONNECT_WORKERS):
+    """处理新连接（解析、连接远端）的有界线程池，线程复用，替代每个连接新建一个线程"""
+    logger.debug(f'Connect pool of {workers} threads.')
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix='connect')
@@ -3,17 +3,43 @@
 # 功能说明：应对公网服务器ssh爆破攻击，把ssh监听改为非22端口，然后启动本程序，把22端口的请求转发回给客户端。攻击我=攻击他自己
 
 import sys
+import time
 import socket
 import logging
+import argparse
 import threading
 
-# 配置本地服务端口
-CFG_LOCAL_IP = '0.0.0.0'
-CFG_LOCAL_PORT = int(sys.argv[1])
+from proxy_common import CONN_TIMEOUT
+from access_log import ConnectionRecord
+from admission import Admission, connect_pool, reject
 
 # 接收数据缓存大小
 PKT_BUFF_SIZE = 2048
 
+# 监听队列长度、并发连接上限、回连线程池大小
+# 公网 22 端口随时会被扫描爆破，默认就限制并发，避免连接突发耗尽线程和文件描述符
+LISTEN_BACKLOG = socket.SOMAXCONN
+MAX_CONNECTIONS = 256
+CONNECT_WORKERS = 32
+
+
+def parse_args(argv=None):
+    """解析命令行参数：anti-ssh-attack.py 本地端口 [选项]"""
+    parser = argparse.ArgumentParser(description='把 ssh 爆破连接转发回攻击者自己的 22 端口')
+    parser.add_argument('local_port', type=int, help='本地端口')
+    parser.add_argument('--backlog', type=int, default=LISTEN_BACKLOG, help='监听队列长度')
+    parser.add_argument('--max-conns', type=int, default=MAX_CONNECTIONS,
+                        help=f'并发连接上限，默认 {MAX_CONNECTIONS}，0 表示不限制')
+    parser.add_argument('--connect-workers', type=int, default=CONNECT_WORKERS,
+                        help='回连攻击者的线程池大小')
+    return parser.parse_args(argv)
+
+
+# 配置本地服务端口（由命令行参数填充）
+ARGS = parse_args()
+CFG_LOCAL_IP = '0.0.0.0'
+CFG_LOCAL_PORT = ARGS.local_port
+
 logger = logging.getLogger("Proxy Logging")
 formatter = logging.Formatter('%(name)-12s %(asctime)s %(levelname)-8s %(lineno)-4d %(message)s',
                               '%Y %b %d %a %H:%M:%S', )
@@ -23,44 +49,71 @@ logger.addHandler(stream_handler)
 logger.setLevel(logging.DEBUG)
 
 
-# 单向流数据传递
-def tcp_mapping_worker(conn_receiver, conn_sender):
+# 单向流数据传递，upstream 为 True 表示 客户端 -> 远端 方向，字节数与关闭原因记入 record
+def tcp_mapping_worker(conn_receiver, conn_sender, record, upstream):
     while True:
         try:
             data = conn_receiver.recv(PKT_BUFF_SIZE)
         except socket.error as e:
             logger.debug(f"Connection closed due to socket error: {e}")
+            reason = 'recv_error'
             break
         if not data:
             logger.info('No more data received, closing connection.')
+            reason = 'client_closed' if upstream else 'upstream_closed'
             break
         try:
             conn_sender.sendall(data)
         except socket.error as e:
             logger.error(f"Failed sending data: {e}")
+            reason = 'send_error'
             break
-        logger.info(f"Mapping {conn_receiver.getpeername()} -> {conn_sender.getpeername()} > {len(data)} bytes.")
-
-    conn_receiver.close()
-    conn_sender.close()
+        if upstream:
+            record.bytes_up += len(data)
+        else:
+            record.bytes_down += len(data)
+        # 对端地址取自 record，不再每包 getpeername()（对端重置后会抛异常）
+        logger.info(f"Mapping {record.client if upstream else record.upstream} -> "
+                    f"{record.upstream if upstream else record.client} > {len(data)} bytes.")
+
+    # close() 不会唤醒另一方向线程阻塞中的 recv，先 shutdown 让它立即退出，名额才能及时归还
+    for conn in (conn_receiver, conn_sender):
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        conn.close()
+    # 两个方向都结束后输出访问日志，并归还 record.admission 占用的并发名额
+    record.direction_done(reason)
 
 
 # 端口映射请求处理
-def tcp_mapping_request(local_conn):
-    # 获取客户端的 IP 地址，并将其用作远程服务器 IP，目标端口为 22
-    remote_ip = local_conn.getpeername()[0]  # 获取客户端的 IP 地址
-    remote_port = 22  # 目标端口 22 (SSH)
-
-    remote_conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+def tcp_mapping_request(local_conn, record):
+    remote_conn = None
     try:
+        # 获取客户端的 IP 地址，并将其用作远程服务器 IP，目标端口为 22
+        # 客户端可能已经断开，getpeername() 同样会失败，放在 try 内保证名额归还
+        remote_ip = local_conn.getpeername()[0]  # 获取客户端的 IP 地址
+        remote_port = 22  # 目标端口 22 (SSH)
+
+        # 攻击者的 22 端口多半被过滤，不设超时的话每个连接都会占住线程池直到内核放弃重传
+        remote_conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        remote_conn.settimeout(CONN_TIMEOUT)
+        connect_start = time.monotonic()
         remote_conn.connect((remote_ip, remote_port))
-    except socket.error as e:
-        logger.error(f'Unable to connect to remote server {remote_ip}:{remote_port} - {e}')
+        remote_conn.settimeout(None)
+        record.connected((remote_ip, remote_port), time.monotonic() - connect_start)
+
+        threading.Thread(target=tcp_mapping_worker, args=(local_conn, remote_conn, record, True),
+                         daemon=True).start()
+        threading.Thread(target=tcp_mapping_worker, args=(remote_conn, local_conn, record, False),
+                         daemon=True).start()
+    except Exception as e:
+        logger.error(f'Unable to connect to remote server for {record.client} - {e}')
         local_conn.close()
-        return
-
-    threading.Thread(target=tcp_mapping_worker, args=(local_conn, remote_conn), daemon=True).start()
-    threading.Thread(target=tcp_mapping_worker, args=(remote_conn, local_conn), daemon=True).start()
+        if remote_conn:
+            remote_conn.close()
+        record.finish('connect_failed')
 
 
 # 端口映射函数
@@ -68,14 +121,25 @@ def tcp_mapping(local_ip, local_port):
     local_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     local_server.bind((local_ip, local_port))
     local_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    local_server.listen(5)
+    local_server.listen(ARGS.backlog)
     logger.debug(f'Starting mapping service on {local_ip}:{local_port} ...')
 
+    # 爆破流量突发时限制并发，超限直接 RST，不再为每个连接新建线程
+    limit = Admission(ARGS.max_conns) if ARGS.max_conns else None
+    pool = connect_pool(ARGS.connect_workers)
+
     while True:
         try:
             local_conn, local_addr = local_server.accept()
+            if limit and not limit.admit():
+                # 只计数，按间隔汇总输出一条，爆破高峰时不为每个被拒绝的连接写日志
+                reject(local_conn)
+                limit.log_rejected()
+                continue
             logger.debug(f'Received mapping request from {local_addr}')
-            threading.Thread(target=tcp_mapping_request, args=(local_conn,), daemon=True).start()
+            record = ConnectionRecord(local_addr)
+            record.admission = limit
+            pool.submit(tcp_mapping_request, local_conn, record)
         except Exception as e:
             logger.error(f"Error accepting connection: {e}")
             local_server.close()
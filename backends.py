@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# 多远端负载均衡：轮询、最少连接、加权、按源 IP 一致性哈希，后台 TCP 健康检查
+
+import bisect
+import socket
+import hashlib
+import threading
+
+from proxy_common import logger
+
+POLICIES = ('round_robin', 'least_conn', 'weighted', 'hash')
+# 健康检查间隔与超时（秒）
+CHECK_INTERVAL = 5
+CHECK_TIMEOUT = 2
+# 一致性哈希环上每个权重单位对应的虚拟节点数
+VIRTUAL_NODES = 100
+
+
+def parse_backend(text):
+    """'host:port' 或 'host:port@weight'，IPv6 写作 '[::1]:80'"""
+    weight = 1
+    if '@' in text:
+        text, weight = text.rsplit('@', 1)
+        weight = int(weight)
+    host, port = text.rsplit(':', 1)
+    return Backend(host.strip('[]'), int(port), weight)
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class Backend:
+    """一个远端地址及其统计"""
+
+    def __init__(self, host, port, weight=1):
+        self.host = host
+        self.port = port
+        self.weight = max(1, weight)
+        self.address = (host, port)  # 事件引擎启动时替换为解析后的地址
+        self.healthy = True
+        self.active = 0
+        self.connections = 0
+        self.failures = 0
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.current_weight = 0  # 平滑加权轮询使用
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        return f"[{self.host}]:{self.port}" if ':' in self.host else f"{self.host}:{self.port}"
+
+    def acquire(self):
+        with self._lock:
+            self.active += 1
+            self.connections += 1
+
+    def release(self, record):
+        """连接结束时由 ConnectionRecord 调用"""
+        with self._lock:
+            self.active -= 1
+            self.bytes_up += record.bytes_up
+            self.bytes_down += record.bytes_down
+
+
+class BackendPool:
+    def __init__(self, backends, policy='round_robin', check_interval=CHECK_INTERVAL, name=None):
+        if policy not in POLICIES:
+            raise ValueError(f'unknown balancing policy: {policy}')
+        self.backends = list(backends)
+        self.policy = policy
+        self.check_interval = check_interval
+        self.name = name  # 多映射模式下作为指标的 mapping 标签
+        self._rr = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._ring = []
+        self._ring_nodes = []
+        if policy == 'hash':
+            for backend in self.backends:
+                for i in range(VIRTUAL_NODES * backend.weight):
+                    self._ring.append((_hash(f'{backend.name}#{i}'), backend))
+            self._ring.sort(key=lambda node: node[0])
+            self._ring_nodes = [node[0] for node in self._ring]
+
+    def start(self):
+        if self.check_interval > 0 and len(self.backends) > 1:
+            threading.Thread(target=self._check_loop, name='health-check', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    # ---------- 选择远端 ----------
+    def select(self, client_ip=None):
+        """按策略挑选一个健康的远端并计入活动连接；全部不健康时在所有远端中挑选"""
+        with self._lock:
+            candidates = [b for b in self.backends if b.healthy] or self.backends
+            if self.policy == 'least_conn':
+                backend = min(candidates, key=lambda b: b.active / b.weight)
+            elif self.policy == 'weighted':
+                backend = self._smooth_weighted(candidates)
+            elif self.policy == 'hash' and client_ip is not None:
+                backend = self._consistent_hash(client_ip, candidates)
+            else:
+                backend = candidates[self._rr % len(candidates)]
+                self._rr += 1
+        backend.acquire()
+        return backend
+
+    @staticmethod
+    def _smooth_weighted(candidates):
+        # nginx 平滑加权轮询：权重大的更常被选中，但不会连续扎堆
+        total = 0
+        best = None
+        for backend in candidates:
+            backend.current_weight += backend.weight
+            total += backend.weight
+            if best is None or backend.current_weight > best.current_weight:
+                best = backend
+        best.current_weight -= total
+        return best
+
+    def _consistent_hash(self, client_ip, candidates):
+        # 从哈希位置顺时针找到第一个健康远端，远端上下线只影响其相邻区间的客户端
+        index = bisect.bisect(self._ring_nodes, _hash(client_ip))
+        for offset in range(len(self._ring)):
+            backend = self._ring[(index + offset) % len(self._ring)][1]
+            if backend in candidates:
+                return backend
+        return candidates[0]
+
+    def mark_failed(self, backend, error):
+        """连接远端失败时立即标记为不健康，等待健康检查恢复"""
+        with backend._lock:
+            backend.failures += 1
+        # 未开启健康检查时不做标记，否则远端永远无法恢复
+        if backend.healthy and self.check_interval > 0 and len(self.backends) > 1:
+            backend.healthy = False
+            logger.warning(f'Backend {backend.name} marked down: {error}')
+
+    # ---------- 健康检查 ----------
+    def _check(self, backend):
+        try:
+            socket.create_connection((backend.host, backend.port), timeout=CHECK_TIMEOUT).close()
+        except OSError as e:
+            if backend.healthy:
+                logger.warning(f'Backend {backend.name} failed health check: {e}')
+            backend.healthy = False
+        else:
+            if not backend.healthy:
+                logger.info(f'Backend {backend.name} is back up.')
+            backend.healthy = True
+
+    def _check_loop(self):
+        # 启动时立即检查一轮，之后每 check_interval 秒并发检查所有远端
+        while True:
+            threads = [threading.Thread(target=self._check, args=(b,), daemon=True) for b in self.backends]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if self._stopped.wait(self.check_interval):
+                break
+
+    # ---------- 统计 ----------
+    def render_metrics(self):
+        return render_backend_metrics([self])
+
+    def stats(self):
+        return {b.name: {'healthy': b.healthy, 'active': b.active, 'connections': b.connections,
+                         'failures': b.failures, 'bytes_up': b.bytes_up, 'bytes_down': b.bytes_down}
+                for b in self.backends}
+
+
+_BACKEND_METRICS = (
+    ('proxy_backend_up', 'gauge', 'Backend health (1 healthy, 0 down).', lambda b: int(b.healthy)),
+    ('proxy_backend_active_connections', 'gauge', 'Connections currently relayed to the backend.',
+     lambda b: b.active),
+    ('proxy_backend_connections_total', 'counter', 'Connections assigned to the backend.', lambda b: b.connections),
+    ('proxy_backend_failures_total', 'counter', 'Failed connects to the backend.', lambda b: b.failures),
+)
+
+
+def render_backend_metrics(pools):
+    """多个 BackendPool 的指标按指标名分组输出（Prometheus 要求同名指标连续出现）"""
+    labeled = []
+    for pool in pools:
+        prefix = f'mapping="{pool.name}",' if pool.name else ''
+        labeled += [(f'{prefix}backend="{b.name}"', b) for b in pool.backends]
+    lines = []
+    for name, kind, help_text, value in _BACKEND_METRICS:
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+        lines += [f'{name}{{{labels}}} {value(b)}' for labels, b in labeled]
+    lines += ['# HELP proxy_backend_bytes_total Bytes relayed by finished connections, per direction.',
+              '# TYPE proxy_backend_bytes_total counter']
+    for labels, b in labeled:
+        lines.append(f'proxy_backend_bytes_total{{{labels},direction="up"}} {b.bytes_up}')
+        lines.append(f'proxy_backend_bytes_total{{{labels},direction="down"}} {b.bytes_down}')
+    return lines
@@ -0,0 +1,3 @@
+# -*- coding: utf-8 -*-
+# 本地基准测试：在回环地址上启动 echo/数据源后端与各转发实现，用同一套负载测量吞吐、延迟、建连速率、内存与 UDP 包速率
+# 用法：python -m bench [--targets proxy,proxy-event] [--tests throughput,latency] [--output result.json]
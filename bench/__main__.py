@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# python -m bench：依次启动各目标跑选定的测试，结果以 JSON 输出，附带提交号便于跨版本对比
+
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+
+from proxy_common import raise_nofile_limit
+from bench import load
+from bench.servers import run_tcp_backend
+from bench.targets import TARGETS, ROOT, free_port, wait_port, start_target, stop_target
+
+TCP_TESTS = ('throughput', 'latency', 'rss', 'connect')
+UDP_TESTS = ('udp',)
+DEFAULT_TARGETS = ('proxy', 'proxy-event', 'proxy6', 'proxy_dual', 'portmap', 'portmapUDP', 'udp')
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_test(test, name, args, ports, workdir):
+    """每个测试使用全新的目标进程，避免前一个测试残留的连接影响结果"""
+    protocol = TARGETS[name][0]
+    listen = free_port(socket.SOCK_DGRAM if protocol == 'udp' else socket.SOCK_STREAM)
+    remote = ports['sink'] if protocol == 'udp' else (ports['source'] if test == 'throughput' else ports['echo'])
+    proc = start_target(name, remote, listen, workdir)
+    try:
+        if test == 'throughput':
+            return load.throughput(listen, args.seconds, args.streams)
+        if test == 'latency':
+            return load.latency(listen, args.seconds)
+        if test == 'rss':
+            return load.rss_per_1k(listen, proc.pid, args.connections)
+        if test == 'connect':
+            return load.connect_rate(listen, args.seconds)
+        return load.udp_pps(listen, ports['sink'], args.seconds, args.udp_size, args.udp_senders)
+    finally:
+        stop_target(proc)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench', description='各转发实现的本地基准测试')
+    parser.add_argument('--targets', default=','.join(DEFAULT_TARGETS),
+                        help=f'逗号分隔的目标，可选：{", ".join(TARGETS)}')
+    parser.add_argument('--tests', default=','.join(TCP_TESTS + UDP_TESTS),
+                        help='逗号分隔的测试：throughput 吞吐、latency 请求/响应延迟、rss 每 1k 连接内存、'
+                             'connect 建连速率、udp 包速率；只对协议匹配的目标执行')
+    parser.add_argument('--seconds', type=float, default=3, help='每项测试持续时间（秒）')
+    parser.add_argument('--streams', type=int, default=1, help='吞吐测试的并行连接数')
+    parser.add_argument('--connections', type=int, default=load.RSS_CONNECTIONS, help='内存测试保持的连接数')
+    parser.add_argument('--udp-size', type=int, default=100, help='UDP 数据报大小（字节）')
+    parser.add_argument('--udp-senders', type=int, default=2, help='UDP 发送进程数')
+    parser.add_argument('--output', help='结果另存为 JSON 文件')
+    args = parser.parse_args(argv)
+    args.targets = [name for name in args.targets.split(',') if name]
+    args.tests = [test for test in args.tests.split(',') if test]
+    for name in args.targets:
+        if name not in TARGETS:
+            parser.error(f'unknown target {name}')
+    for test in args.tests:
+        if test not in TCP_TESTS + UDP_TESTS:
+            parser.error(f'unknown test {test}')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    raise_nofile_limit()
+    ports = {'echo': free_port(), 'source': free_port(), 'sink': free_port(socket.SOCK_DGRAM)}
+    backend = multiprocessing.Process(target=run_tcp_backend, args=(ports['echo'], ports['source']), daemon=True)
+    backend.start()
+    wait_port(ports['echo'])
+    report = {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seconds': args.seconds,
+        'results': {},
+    }
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            for name in args.targets:
+                tests = UDP_TESTS if TARGETS[name][0] == 'udp' else TCP_TESTS
+                result = report['results'][name] = {}
+                for test in (test for test in args.tests if test in tests):
+                    try:
+                        values = run_test(test, name, args, ports, workdir)
+                    except Exception as e:
+                        values = {f'{test}_error': str(e)}
+                    result.update(values)
+                    print(f'{name} {test}: {json.dumps(values)}', file=sys.stderr)
+    finally:
+        backend.terminate()
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
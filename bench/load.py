@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+# 负载发生器：每个函数对一个已启动的目标压测一段时间，返回若干指标
+
+import time
+import socket
+import threading
+import multiprocessing
+
+from bench.servers import run_udp_sink, run_udp_sender
+
+RR_SIZE = 64  # 请求/响应测试的消息大小
+RSS_CONNECTIONS = 1000
+
+
+def _connect(port, timeout=10):
+    sock = socket.create_connection(('127.0.0.1', port), timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def _recv_exact(sock, size):
+    got = 0
+    while got < size:
+        data = sock.recv(size - got)
+        if not data:
+            raise ConnectionError('connection closed by relay')
+        got += len(data)
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def throughput(source_port, seconds, streams=1):
+    """从数据源经目标下载，返回总吞吐（MiB/s）"""
+    totals = [0] * streams
+
+    def stream(index):
+        sock = _connect(source_port)
+        buf = bytearray(256 * 1024)
+        deadline = time.monotonic() + seconds
+        try:
+            while time.monotonic() < deadline:
+                size = sock.recv_into(buf)
+                if not size:
+                    break
+                totals[index] += size
+        finally:
+            sock.close()
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=stream, args=(i,)) for i in range(streams)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+    return {'bulk_mib_per_s': round(sum(totals) / elapsed / 1024 / 1024, 1)}
+
+
+def latency(echo_port, seconds, size=RR_SIZE):
+    """单连接上反复发送 size 字节并等待回显，返回往返时延分位数（毫秒）"""
+    sock = _connect(echo_port)
+    payload = b'r' * size
+    samples = []
+    try:
+        for _ in range(100):  # 预热
+            sock.sendall(payload)
+            _recv_exact(sock, size)
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            sock.sendall(payload)
+            _recv_exact(sock, size)
+            samples.append(time.perf_counter() - start)
+    finally:
+        sock.close()
+    return {
+        'rr_per_s': round(len(samples) / seconds),
+        'rr_p50_ms': round(_percentile(samples, 50) * 1000, 3),
+        'rr_p99_ms': round(_percentile(samples, 99) * 1000, 3),
+    }
+
+
+def connect_rate(echo_port, seconds):
+    """建连、收发 1 字节、关闭，循环执行，返回每秒完成的连接数"""
+    count = errors = 0
+    deadline = time.monotonic() + seconds
+    start = time.monotonic()
+    while time.monotonic() < deadline:
+        try:
+            sock = _connect(echo_port, 5)
+            try:
+                sock.sendall(b'c')
+                _recv_exact(sock, 1)
+                count += 1
+            finally:
+                sock.close()
+        except OSError:
+            errors += 1
+    return {'conn_per_s': round(count / (time.monotonic() - start)), 'conn_errors': errors}
+
+
+def _rss_kib(pid):
+    """进程常驻内存（KiB），Linux 读 /proc，其他平台需要 psutil"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process(pid).memory_info().rss // 1024
+
+
+def rss_per_1k(echo_port, pid, connections=RSS_CONNECTIONS):
+    """保持 connections 个已完成一次往返的连接，返回目标进程每 1000 个连接增加的常驻内存（KiB）"""
+    base = _rss_kib(pid)
+    if base is None:
+        return {'rss_kib_per_1k_conns': None}
+    socks = []
+    try:
+        for _ in range(connections):
+            sock = _connect(echo_port)
+            sock.sendall(b'm')
+            _recv_exact(sock, 1)
+            socks.append(sock)
+        time.sleep(0.5)
+        loaded = _rss_kib(pid)
+    finally:
+        for sock in socks:
+            sock.close()
+    return {'rss_base_kib': base, 'rss_kib_per_1k_conns': round((loaded - base) * 1000 / connections)}
+
+
+def udp_pps(listen_port, sink_port, seconds, size=100, senders=2):
+    """多个发送进程经目标向计数接收端发包，返回发送与实际转发的包速率"""
+    result = multiprocessing.Queue()
+    sink = multiprocessing.Process(target=run_udp_sink, args=(sink_port, seconds, result), daemon=True)
+    sink.start()
+    time.sleep(0.3)
+    procs = [multiprocessing.Process(target=run_udp_sender, args=(listen_port, seconds, size, result), daemon=True)
+             for _ in range(senders)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    sink.join()
+    values = [result.get() for _ in range(senders + 1)]
+    received, elapsed = next(v for v in values if isinstance(v, tuple))
+    sent = sum(v for v in values if not isinstance(v, tuple))
+    return {
+        'udp_sent_pps': round(sent / seconds),
+        'udp_pps': round(received / elapsed) if elapsed else 0,
+        'udp_delivered': round(received / sent, 3) if sent else None,
+    }
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# 测试用后端：TCP echo（请求/响应延迟、建连、内存测试）、TCP 数据源（持续下发，吞吐测试）、UDP 计数接收端
+
+import time
+import socket
+import selectors
+
+CHUNK = 64 * 1024
+PAYLOAD = b'x' * CHUNK
+
+
+def _listen(port):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', port))
+    server.listen(socket.SOMAXCONN)
+    server.setblocking(False)
+    return server
+
+
+def run_tcp_backend(echo_port, source_port):
+    """单线程 selectors 循环同时提供 echo 与数据源两个端口，在独立进程中运行"""
+    selector = selectors.DefaultSelector()
+    pending = {}  # echo 连接 -> 待写回的数据
+
+    def close(sock):
+        selector.unregister(sock)
+        pending.pop(sock, None)
+        sock.close()
+
+    def on_echo(sock, mask):
+        if mask & selectors.EVENT_READ:
+            try:
+                data = sock.recv(CHUNK)
+            except OSError:
+                data = b''
+            if not data:
+                close(sock)
+                return
+            pending[sock] += data
+        if pending[sock]:
+            try:
+                sent = sock.send(pending[sock])
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                close(sock)
+                return
+            pending[sock] = pending[sock][sent:]
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if pending[sock] else 0)
+        selector.modify(sock, events, on_echo)
+
+    def on_source(sock, mask):
+        try:
+            sock.send(PAYLOAD)
+        except BlockingIOError:
+            pass
+        except OSError:
+            close(sock)
+
+    def on_accept(server, handler, events):
+        def accept(sock, mask):
+            while True:
+                try:
+                    conn, _ = server.accept()
+                except BlockingIOError:
+                    return
+                conn.setblocking(False)
+                if handler is on_echo:
+                    pending[conn] = b''
+                selector.register(conn, events, handler)
+        return accept
+
+    for port, handler, events in ((echo_port, on_echo, selectors.EVENT_READ),
+                                  (source_port, on_source, selectors.EVENT_WRITE)):
+        server = _listen(port)
+        selector.register(server, selectors.EVENT_READ, on_accept(server, handler, events))
+    while True:
+        for key, mask in selector.select():
+            key.data(key.fileobj, mask)
+
+
+def run_udp_sink(port, seconds, result):
+    """统计收到的数据报数，首包开始计时，停止收包后返回 (数量, 耗时)"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    sock.bind(('127.0.0.1', port))
+    sock.settimeout(0.2)
+    buf = bytearray(65535)
+    count = 0
+    first = last = None
+    deadline = time.monotonic() + seconds + 2
+    while time.monotonic() < deadline:
+        try:
+            sock.recv_into(buf)
+        except socket.timeout:
+            if first is not None:
+                break
+            continue
+        last = time.monotonic()
+        if first is None:
+            first = last
+        count += 1
+    result.put((count, (last - first) if first else 0))
+
+
+def run_udp_sender(port, seconds, size, result):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect(('127.0.0.1', port))
+    payload = b'x' * size
+    sent = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for _ in range(1000):
+            try:
+                sock.send(payload)
+                sent += 1
+            except OSError:
+                pass
+    result.put(sent)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# 被测转发实现：每个目标以子进程启动，remote 指向本地后端，listen 为负载发生器连接的端口
+
+import os
+import sys
+import time
+import socket
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+START_TIMEOUT = 10
+
+
+def _script(name, *extra):
+    return lambda remote, listen: [sys.executable, os.path.join(ROOT, name), '127.0.0.1', str(remote), str(listen),
+                                   *extra]
+
+
+def _code(code):
+    return lambda remote, listen: [sys.executable, '-c', code.format(remote=remote, listen=listen)]
+
+
+# 名称 -> (协议, 命令行生成函数)
+TARGETS = {
+    'proxy': ('tcp', _script('proxy.py')),
+    'proxy-event': ('tcp', _script('proxy.py', '--engine', 'event')),
+    'proxy-splice': ('tcp', _script('proxy.py', '--relay', 'splice')),
+    'proxy6': ('tcp', _script('proxy6.py')),
+    'proxy_dual': ('tcp', _script('proxy_dual.py')),
+    'portmap': ('tcp', _code("import tcp_and_udp; tcp_and_udp.portmap({listen}, '127.0.0.1', {remote}, '127.0.0.1').start()")),
+    'portmapUDP': ('udp', _code("import tcp_and_udp; tcp_and_udp.portmapUDP({listen}, '127.0.0.1', {remote}, '127.0.0.1').start()")),
+    'udp': ('udp', _code("import udp_engine; udp_engine.udp_mapping('127.0.0.1', {remote}, '127.0.0.1', {listen})")),
+    # 关闭批量收发与 GSO，每次唤醒只处理一个数据报，作为对照
+    'udp-single': ('udp', _code("import udp_engine; udp_engine.UDP_BATCH = 1; udp_engine.GSO_ENABLED = False; "
+                                "udp_engine.udp_mapping('127.0.0.1', {remote}, '127.0.0.1', {listen})")),
+}
+
+
+def free_port(kind=socket.SOCK_STREAM):
+    sock = socket.socket(socket.AF_INET, kind)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_port(port, timeout=START_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'nothing listening on 127.0.0.1:{port} after {timeout}s')
+
+
+def start_target(name, remote, listen, workdir):
+    """启动目标并等待其开始监听；日志输出丢弃，proxy.log 等文件写入 workdir"""
+    protocol, command = TARGETS[name]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+    proc = subprocess.Popen(command(remote, listen), cwd=workdir, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if protocol == 'tcp':
+            wait_port(listen)
+        else:
+            time.sleep(0.5)
+        if proc.poll() is not None:
+            raise RuntimeError(f'{name} exited with code {proc.returncode}')
+    except Exception:
+        stop_target(proc)
+        raise
+    return proc
+
+
+def stop_target(proc):
+    proc.terminate()
+    try:
+        proc.wait(5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# 可复用的接收缓冲区池：转发循环用 recv_into 填充、memoryview 切片发送，避免逐包分配 bytes
+
+import threading
+
+from proxy_common import PKT_BUFF_SIZE
+
+# 默认最多缓存的空闲缓冲区数量
+POOL_SIZE = 1024
+
+
+class BufferPool:
+    """有上限的 bytearray 池，空闲缓冲区超过 count 个时直接丢弃"""
+
+    def __init__(self, count=POOL_SIZE, size=PKT_BUFF_SIZE):
+        self.count = count
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._free:
+                self.hits += 1
+                return self._free.pop()
+            self.misses += 1
+        return bytearray(self.size)
+
+    def release(self, buf):
+        # 池重新配置过大小的旧缓冲区不再回收
+        if len(buf) != self.size:
+            return
+        with self._lock:
+            if len(self._free) < self.count:
+                self._free.append(buf)
+
+    def configure(self, count=None, size=None):
+        with self._lock:
+            if count is not None:
+                self.count = count
+            if size is not None and size != self.size:
+                self.size = size
+                self._free.clear()
+            del self._free[self.count:]
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'free': len(self._free),
+                    'count': self.count, 'size': self.size}
+
+
+# 进程内共享的缓冲区池
+default_pool = BufferPool()
+
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# 远端域名解析缓存：有效期、失败缓存、到期前后台刷新，解析服务故障时继续使用旧结果
+
+import time
+import socket
+import threading
+
+from proxy_common import logger
+
+# 解析结果有效期（秒）。socket.getaddrinfo 拿不到记录本身的 TTL，这里统一使用配置值
+DNS_TTL = 60
+# 解析失败结果的缓存时间（秒），同时也是解析服务故障期间的重试间隔
+DNS_NEGATIVE_TTL = 5
+# 过期后解析服务仍不可用时，旧结果最多继续使用的时间（秒）
+DNS_MAX_STALE = 3600
+# 有效期过去这个比例后开始后台刷新
+REFRESH_RATIO = 0.8
+
+
+class _Entry:
+    __slots__ = ('result', 'error', 'expires', 'refresh_at', 'refreshing')
+
+    def __init__(self, result, error, ttl):
+        now = time.monotonic()
+        self.result = result
+        self.error = error
+        self.expires = now + ttl
+        self.refresh_at = now + ttl * REFRESH_RATIO
+        self.refreshing = False
+
+    def value(self):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class ResolverCache:
+    """与 socket.getaddrinfo 同参数的缓存版本，同一个键并发查询时只发起一次解析"""
+
+    def __init__(self, ttl=DNS_TTL, negative_ttl=DNS_NEGATIVE_TTL, max_stale=DNS_MAX_STALE):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_stale = max_stale
+        self.lookups = 0
+        self._entries = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        key = (host, port, family, type, proto, flags)
+        entry = self._entries.get(key)
+        if entry is not None:
+            now = time.monotonic()
+            if now < entry.expires:
+                if entry.error is None and now >= entry.refresh_at:
+                    self._refresh_async(key, entry)
+                return entry.value()
+            # 已过期但仍在可用期内：先返回旧地址，后台重新解析
+            if entry.error is None and now < entry.expires + self.max_stale:
+                self._refresh_async(key, entry)
+                return entry.result
+
+        with self._key_lock(key):
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() >= entry.expires:
+                entry = self._lookup(key)
+            return entry.value()
+
+    def _key_lock(self, key):
+        with self._lock:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = threading.Lock()
+            return lock
+
+    def _lookup(self, key):
+        self.lookups += 1
+        try:
+            result = socket.getaddrinfo(*key)
+        except socket.gaierror as e:
+            old = self._entries.get(key)
+            if old is not None and old.error is None and time.monotonic() < old.expires + self.max_stale:
+                logger.warning(f'Resolve {key[0]} failed ({e}), using cached addresses.')
+                old.refresh_at = time.monotonic() + self.negative_ttl
+                return old
+            entry = _Entry(None, e, self.negative_ttl)
+        else:
+            entry = _Entry(result, None, self.ttl)
+        self._entries[key] = entry
+        return entry
+
+    def _refresh_async(self, key, entry):
+        if entry.refreshing or time.monotonic() < entry.refresh_at:
+            return
+        entry.refreshing = True
+
+        def refresh():
+            try:
+                with self._key_lock(key):
+                    self._lookup(key)
+            finally:
+                entry.refreshing = False
+
+        threading.Thread(target=refresh, name='dns-refresh', daemon=True).start()
+
+
+# 进程内共享的解析缓存
+resolver = ResolverCache()
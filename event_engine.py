@@ -0,0 +1,616 @@
+# -*- coding: utf-8 -*-
+# 单线程事件循环转发引擎（selectors/epoll），替代每连接三线程的转发模型
+
+import os
+import ssl
+import heapq
+import errno
+import signal
+import socket
+import selectors
+import itertools
+import time
+from collections import deque
+
+from proxy_common import logger, CONN_TIMEOUT, set_keepalive, raise_nofile_limit
+from buffer_pool import default_pool
+from workers import enable_reuse_port
+from access_log import ConnectionRecord
+from metrics import metrics
+from dns_cache import resolver
+from admission import LISTEN_BACKLOG, reject
+from idle_reaper import IdleReaper, IDLE_TIMEOUT, REAPER_TICK
+
+# 每次可读事件最多连续 accept 的连接数，避免监听口饿死已建立的转发
+ACCEPT_BATCH = 64
+# UDP 数据报最大长度
+MAX_DATAGRAM = 65535
+# UDP 批量接收缓冲区：连续收取多个数据报，剩余空间不足一个最大数据报时停止
+DATAGRAM_BUFFER = 4 * MAX_DATAGRAM
+# 非阻塞读写暂时无法进行，等下一次事件再试；TLS 连接以 SSLWant*Error 表示
+_RETRY = (BlockingIOError, InterruptedError, ssl.SSLWantReadError, ssl.SSLWantWriteError)
+
+
+class Timer:
+    """定时器句柄，cancel 后回调不再执行"""
+    __slots__ = ('when', 'callback', 'cancelled')
+
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class EventLoop:
+    """基于 selectors 的最小事件循环：文件描述符事件 + 定时器堆"""
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self._timers = []
+        self._seq = itertools.count()
+        self._running = False
+        self._read_buf = None
+        self._read_view = None
+        self._datagram_view = None
+        self._wakeup = None  # (读端, 写端)，信号到达或其他线程提交回调时唤醒阻塞中的 select
+        self._signal_handlers = {}
+        self._ready = deque()  # 其他线程提交、等待在事件循环中执行的回调
+
+    def call_later(self, delay, callback):
+        timer = Timer(time.monotonic() + delay, callback)
+        heapq.heappush(self._timers, (timer.when, next(self._seq), timer))
+        return timer
+
+    def set_events(self, sock, events, handler):
+        """设置 socket 关注的事件，events 为 0 时取消注册"""
+        try:
+            key = self.selector.get_key(sock)
+        except (KeyError, ValueError):
+            key = None
+        if key is None:
+            if events:
+                self.selector.register(sock, events, handler)
+        elif not events:
+            self.selector.unregister(sock)
+        elif key.events != events or key.data is not handler:
+            self.selector.modify(sock, events, handler)
+
+    def forget(self, sock):
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def _run_timers(self):
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, timer = heapq.heappop(self._timers)
+            if not timer.cancelled:
+                timer.callback()
+
+    def _next_timeout(self):
+        while self._timers and self._timers[0][2].cancelled:
+            heapq.heappop(self._timers)
+        if not self._timers:
+            return None
+        return max(0, self._timers[0][0] - time.monotonic())
+
+    def run(self):
+        self._running = True
+        while self._running:
+            for key, mask in self.selector.select(self._next_timeout()):
+                key.data(mask)
+            self._run_timers()
+
+    def stop(self):
+        self._running = False
+
+    def enable_wakeup(self):
+        """创建唤醒用的 socketpair，需在事件循环线程中调用一次"""
+        if self._wakeup is None:
+            self._wakeup = socket.socketpair()
+            for sock in self._wakeup:
+                sock.setblocking(False)
+            self.set_events(self._wakeup[0], selectors.EVENT_READ, self._on_wakeup)
+
+    def call_soon_threadsafe(self, callback):
+        """从其他线程提交回调，在事件循环中执行；需要先调用过 enable_wakeup()"""
+        self._ready.append(callback)
+        wakeup = self._wakeup
+        if wakeup is None:
+            return
+        try:
+            # 0 不是信号编号，只用于唤醒
+            wakeup[1].send(b'\0')
+        except OSError:
+            pass
+
+    def add_signal_handler(self, signum, callback):
+        """信号到达时在事件循环中执行 callback，只能在主线程调用"""
+        if not self._signal_handlers:
+            self.enable_wakeup()
+            signal.set_wakeup_fd(self._wakeup[1].fileno())
+        self._signal_handlers[signum] = callback
+        # Python 层的处理函数什么都不做，真正的处理由 wakeup fd 写入的信号编号触发
+        signal.signal(signum, lambda signum, frame: None)
+
+    def _on_wakeup(self, mask):
+        try:
+            data = self._wakeup[0].recv(256)
+        except (BlockingIOError, InterruptedError):
+            return
+        for signum in data:
+            callback = self._signal_handlers.get(signum)
+            if callback:
+                callback()
+        while self._ready:
+            self._ready.popleft()()
+
+    def read_view(self):
+        """事件循环单线程执行，所有连接的 recv_into 共用一块池化缓冲区"""
+        if self._read_view is None:
+            self._read_buf = default_pool.acquire()
+            self._read_view = memoryview(self._read_buf)
+        return self._read_view
+
+    def datagram_view(self):
+        """UDP 转发共用的批量接收缓冲区，每次接收前至少留出一个最大数据报的空间，避免截断"""
+        if self._datagram_view is None:
+            self._datagram_view = memoryview(bytearray(DATAGRAM_BUFFER))
+        return self._datagram_view
+
+    def close(self):
+        if self._wakeup is not None:
+            if self._signal_handlers:
+                signal.set_wakeup_fd(-1)
+            for signum in self._signal_handlers:
+                signal.signal(signum, signal.SIG_DFL)
+            for sock in self._wakeup:
+                sock.close()
+            self._wakeup = None
+        if self._datagram_view is not None:
+            self._datagram_view.release()
+            self._datagram_view = None
+        if self._read_view is not None:
+            self._read_view.release()
+            default_pool.release(self._read_buf)
+            self._read_buf = self._read_view = None
+        self.selector.close()
+
+
+class _Side:
+    """连接的一端：socket、对端、待写出的数据、是否因限速暂停读取
+
+    eof 表示这一端已读到 EOF；shut 表示已把对端的 EOF 转给这一端（shutdown 写方向）；
+    tls 表示 sock 是已完成握手的 SSLSocket（TLS 终结的客户端一侧）；
+    transform 为压缩隧道对这一端读到的数据做的转换（压缩或解压），结果发给对端。
+    """
+    __slots__ = ('sock', 'peer', 'name', 'handler', 'pending', 'paused', 'eof', 'shut', 'tls', 'transform')
+
+    def __init__(self, sock, tls=False):
+        self.sock = sock
+        self.tls = tls
+        self.transform = None
+        self.peer = None
+        self.handler = None
+        self.name = None
+        self.pending = b''
+        self.paused = False
+        self.eof = False
+        self.shut = False
+
+
+class RelayConnection:
+    """一个客户端与远端之间的双向转发"""
+
+    def __init__(self, engine, local_conn, record):
+        self.engine = engine
+        self.record = record
+        self.record.mode = 'event'
+        self.loop = engine.loop
+        self.local = _Side(local_conn)
+        self.remote = None
+        self.closed = False
+        self.timer = None  # 连接远端的超时
+        self.connect_start = None
+        self.last_active = time.monotonic()
+        self.eof_reason = None  # 第一个读到 EOF 的方向
+
+    # ---------- TLS 握手 ----------
+    def handshake(self, remote_addr):
+        """TLS 终结：握手交给 engine.tls 的线程池，完成后回到事件循环再连接远端"""
+        self.record.mode = 'event-tls'
+        # 握手线程通过 call_soon_threadsafe 把结果交回事件循环
+        self.loop.enable_wakeup()
+        self.engine.tls.submit(self.local.sock, lambda tls_sock: self.loop.call_soon_threadsafe(
+            lambda: self._on_handshake(tls_sock, remote_addr)))
+
+    def _on_handshake(self, tls_sock, remote_addr):
+        if tls_sock is None:
+            self.close('tls_failed')
+            return
+        if self.closed:
+            # 握手期间映射已关闭
+            tls_sock.close()
+            return
+        self.local = _Side(tls_sock, tls=True)
+        self.connect(remote_addr)
+
+    # ---------- 连接远端 ----------
+    def connect(self, remote_addr):
+        self.connect_start = time.monotonic()
+        # 预连接池命中时直接开始转发
+        remote_conn = self.engine.warm_pool.acquire() if self.engine.warm_pool else None
+        if remote_conn is not None:
+            self.remote = _Side(remote_conn)
+            remote_conn.setblocking(False)
+            self.start()
+            return
+        try:
+            remote_conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        except OSError as e:
+            logger.error(f'Connection failed: {str(e)}')
+            self.local.sock.close()
+            self.closed = True
+            self.record.finish('connect_failed')
+            self.engine.connection_closed(self)
+            return
+        self.remote = _Side(remote_conn)
+        try:
+            set_keepalive(remote_conn)
+            remote_conn.setblocking(False)
+            err = remote_conn.connect_ex(remote_addr)
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                raise OSError(err, errno.errorcode.get(err, 'connect error'))
+        except OSError as e:
+            self._connect_failed(str(e))
+            return
+        self.loop.set_events(remote_conn, selectors.EVENT_WRITE, self._on_connected)
+        self.timer = self.loop.call_later(CONN_TIMEOUT, self._on_connect_timeout)
+
+    def _on_connect_timeout(self):
+        self._connect_failed('timed out')
+
+    def _connect_failed(self, error):
+        logger.error(f'Connection failed: {error}')
+        # 多远端模式下立即把该远端标记为不健康，后续连接跳过它
+        if self.record.backend is not None:
+            self.engine.backends.mark_failed(self.record.backend, error)
+        self.close('connect_failed')
+
+    def _on_connected(self, mask):
+        self.timer.cancel()
+        err = self.remote.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self._connect_failed(os.strerror(err))
+            return
+        self.start()
+
+    # ---------- 双向转发 ----------
+    def start(self):
+        local, remote = self.local, self.remote
+        local.peer, remote.peer = remote, local
+        local.handler = lambda mask: self._on_event(local, mask)
+        remote.handler = lambda mask: self._on_event(remote, mask)
+        try:
+            local.name = local.sock.getpeername()
+            remote.name = remote.sock.getpeername()
+        except OSError:
+            self.close('recv_error')
+            return
+        self.record.connected(remote.name, time.monotonic() - self.connect_start)
+        tunnel = self.engine.tunnel
+        if tunnel:
+            local.transform, remote.transform = tunnel.codecs()
+            # 客户端一侧的前导作为远端的第一段待写数据，不等应答
+            if tunnel.mode == 'zstd-client':
+                remote.pending = memoryview(tunnel.preamble())
+        local.sock.setblocking(False)
+        self.last_active = time.monotonic()
+        self._update(local)
+        self._update(remote)
+        self.engine.reaper.watch(self)
+
+    def _update(self, side):
+        """读：未读到 EOF、对端没有积压数据且未被限速暂停时才读；写：本端有积压数据时才写"""
+        if self.closed:
+            return
+        events = 0
+        if not side.eof and not side.peer.pending and not side.paused:
+            events |= selectors.EVENT_READ
+        if side.pending:
+            events |= selectors.EVENT_WRITE
+        self.loop.set_events(side.sock, events, side.handler)
+        # 一个 TLS 记录可能大于一次读取的缓冲区，已解密未读出的数据不会再触发可读事件
+        if events & selectors.EVENT_READ and side.tls and side.sock.pending():
+            self.loop.call_later(0, lambda: self._read_buffered(side))
+
+    def _read_buffered(self, side):
+        if not self.closed and not side.eof and not side.peer.pending and not side.paused:
+            self._on_readable(side)
+
+    def _on_event(self, side, mask):
+        if mask & selectors.EVENT_WRITE and not self.closed:
+            self._flush(side)
+        if mask & selectors.EVENT_READ and not self.closed:
+            self._on_readable(side)
+
+    def _on_readable(self, side):
+        # 整个事件循环共用一块池化缓冲区，只有对端写不完的部分才拷贝出来积压
+        view = self.engine.read_view
+        try:
+            size = side.sock.recv_into(view)
+        except _RETRY:
+            return
+        except Exception:
+            self.close('recv_error')
+            return
+
+        if not size:
+            # 半关闭：不再读这一端，对端的积压数据写完后把 EOF 转过去，另一个方向继续转发
+            side.eof = True
+            if self.eof_reason is None:
+                self.eof_reason = 'client_closed' if side is self.local else 'upstream_closed'
+            self._update(side)
+            self._drain(side.peer)
+            return
+
+        self.last_active = time.monotonic()
+        peer = side.peer
+        payload = view[:size]
+        if side.transform:
+            try:
+                payload = side.transform(payload)
+            except Exception as e:
+                logger.error(f'Tunnel data error: {e}')
+                self.close('tunnel_error')
+                return
+        try:
+            sent = peer.sock.send(payload) if payload else 0
+        except _RETRY:
+            sent = 0
+        except Exception:
+            self.close('send_error')
+            return
+        if sent < len(payload):
+            peer.pending = memoryview(bytes(payload[sent:]))
+            self._update(peer)
+            self._update(side)
+        if side is self.local:
+            self.record.bytes_up += size
+        else:
+            self.record.bytes_down += size
+        # 逐包日志仅对抽样连接输出（--trace-sample）
+        if self.record.traced:
+            logger.debug('Mapping > %s -> %s > %d bytes.' % (side.name, peer.name, size))
+        # 超出限速时取消该端的读事件，到时间再恢复，期间由 TCP 窗口让发送方降速
+        if self.record.shaping:
+            delay = self.record.shaping.consume(size, side is self.local)
+            if delay:
+                side.paused = True
+                self._update(side)
+                self.loop.call_later(delay, lambda: self._resume(side))
+        if side.tls and not side.paused:
+            self._update(side)
+
+    def _resume(self, side):
+        side.paused = False
+        self._update(side)
+
+    def _flush(self, side):
+        try:
+            sent = side.sock.send(side.pending)
+        except _RETRY:
+            sent = 0
+        except Exception:
+            self.close('send_error')
+            return
+        side.pending = side.pending[sent:]
+        self._update(side)
+        self._update(side.peer)
+        self._drain(side)
+
+    def _drain(self, side):
+        """对端已读到 EOF 且这一端积压写完：shutdown 这一端的写方向；两个方向都结束后关闭连接"""
+        if self.closed or side.pending or not side.peer.eof or side.shut:
+            return
+        if side.tls:
+            # SSLSocket 不能只关闭写方向：发出 close_notify 后整个连接结束
+            try:
+                side.sock.unwrap()
+            except (OSError, ValueError):
+                pass
+            self.close(self.eof_reason)
+            return
+        side.shut = True
+        try:
+            side.sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            self.close('send_error')
+            return
+        if side.peer.shut:
+            self.close(self.eof_reason)
+
+    # ---------- 超时与关闭 ----------
+    def expire(self):
+        """两个方向都超过空闲时间没有数据，由 engine.reaper 调用"""
+        self.close('idle_timeout')
+
+    def close(self, reason='closed'):
+        if self.closed:
+            return
+        self.closed = True
+        self.record.finish(reason)
+        if self.timer:
+            self.timer.cancel()
+        self.engine.reaper.forget(self)
+        for side in (self.local, self.remote):
+            if side is None:
+                continue
+            self.loop.forget(side.sock)
+            side.sock.close()
+        self.engine.connection_closed(self)
+
+
+class RelayEngine:
+    """单进程单线程端口映射服务"""
+
+    def __init__(self, remote_ip, remote_port, local_ip, local_port, reuse_port=False, warm_pool=None,
+                 backends=None, loop=None, limit=None, backlog=LISTEN_BACKLOG, shaper=None,
+                 idle_timeout=IDLE_TIMEOUT, tls=None, tunnel=None):
+        self.remote_ip = remote_ip
+        self.remote_port = remote_port
+        self.local_ip = local_ip
+        self.local_port = local_port
+        self.reuse_port = reuse_port
+        self.warm_pool = warm_pool
+        self.backends = backends
+        self.limit = limit  # admission.Admission，并发连接上限
+        self.backlog = backlog
+        self.shaper = shaper  # shaping.Shaper，带宽整形
+        self.tls = tls  # tls_termination.TLSTerminator，设置后监听端做 TLS 终结
+        self.tunnel = tunnel  # zstd_tunnel.Tunnel，两个代理之间的压缩隧道
+        # 该映射所有连接共用一个时间轮回收空闲连接，由事件循环每个 tick 推进
+        self.reaper = IdleReaper(idle_timeout)
+        self.reap_timer = None
+        self.task_counter = None  # start() 注册到 metrics.task_counters 的回调
+        self.accept_paused = False
+        # 多个映射可共用同一个事件循环（见 proxy_multi.py）
+        self.loop = loop or EventLoop()
+        self.connections = set()
+        self.server = None
+        self.remote_addr = None
+        self.read_view = None
+
+    def _on_accept(self, mask):
+        for _ in range(ACCEPT_BATCH):
+            # 排队模式下名额用完就暂停 accept，新连接留在内核监听队列里，有连接结束后再继续；
+            # 事件循环不能阻塞等待，排队时长由客户端自己的连接超时决定
+            if self.limit and self.limit.queue_timeout > 0 and not self.limit.has_room():
+                self.accept_paused = True
+                self.loop.forget(self.server)
+                return
+            try:
+                local_conn, local_addr = self.server.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logger.error(f"Error handling connection: {e}")
+                return
+            if self.limit and not self.limit.admit(wait=False):
+                reject(local_conn)
+                continue
+            record = ConnectionRecord(local_addr)
+            record.admission = self.limit
+            if self.shaper:
+                record.shaping = self.shaper.open(local_addr[0])
+            self._relay(local_conn, local_addr, record)
+
+    def _relay(self, local_conn, local_addr, record):
+        """为已准入的新客户端建立转发：连接远端，开启 TLS 终结时先握手"""
+        conn = RelayConnection(self, local_conn, record)
+        self.connections.add(conn)
+        if self.backends:
+            record.backend = self.backends.select(local_addr[0])
+            remote_addr = record.backend.address
+        else:
+            remote_addr = self.remote_addr
+        if self.tls:
+            conn.handshake(remote_addr)
+        else:
+            conn.connect(remote_addr)
+
+    def start(self, server=None):
+        """解析远端、创建监听 socket 并注册到事件循环，不阻塞；server 为从旧进程接管的监听 socket"""
+        self.set_remote(self.remote_ip, self.remote_port, self.backends)
+        self.read_view = self.loop.read_view()
+
+        if server is None:
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                enable_reuse_port(server)
+            set_keepalive(server)
+            server.bind((self.local_ip, self.local_port))
+            server.listen(self.backlog)
+        self.server = server
+        server.setblocking(False)
+        self.loop.set_events(server, selectors.EVENT_READ, self._on_accept)
+        self.reap_timer = self.loop.call_later(REAPER_TICK, self._on_reap)
+        # shutdown() 时注销，重新加载后退役的映射不再计入
+        self.task_counter = lambda: len(self.connections)
+        metrics.task_counters.append(self.task_counter)
+        logger.debug(f'Starting mapping service on {self.local_ip}:{self.local_port} (event engine) ...')
+
+    def set_remote(self, remote_ip, remote_port, backends=None):
+        """更换远端，只影响之后的新连接"""
+        # 远端地址在这里解析一次，避免在事件循环里做阻塞的 DNS 查询；同一主机的多个映射共用解析结果
+        self.remote_addr = _resolve(remote_ip, remote_port)
+        self.remote_ip, self.remote_port = remote_ip, remote_port
+        if backends:
+            for backend in backends.backends:
+                backend.address = _resolve(backend.host, backend.port)
+        self.backends = backends
+
+    def _on_reap(self):
+        self.reaper.advance()
+        self.reap_timer = self.loop.call_later(REAPER_TICK, self._on_reap)
+
+    def connection_closed(self, conn):
+        self.connections.discard(conn)
+        if self.accept_paused and self.server and (self.limit is None or self.limit.has_room()):
+            self.accept_paused = False
+            self.loop.set_events(self.server, selectors.EVENT_READ, self._on_accept)
+
+    def stop_accepting(self):
+        """关闭监听 socket，已建立的连接继续转发直到结束"""
+        if self.server:
+            self.loop.forget(self.server)
+            self.server.close()
+            self.server = None
+
+    def shutdown(self):
+        """关闭监听 socket 和该映射下的全部连接"""
+        for conn in list(self.connections):
+            conn.close('shutdown')
+        if self.reap_timer:
+            self.reap_timer.cancel()
+            self.reap_timer = None
+        if self.tls:
+            self.tls.stop()
+        if self.task_counter in metrics.task_counters:
+            metrics.task_counters.remove(self.task_counter)
+        self.task_counter = None
+        self.stop_accepting()
+
+    def serve_forever(self):
+        limit = raise_nofile_limit()
+        if limit:
+            logger.debug(f'Open file limit: {limit}')
+        self.start()
+        logger.debug(f'Idle timeout was set to {self.reaper.timeout}s.')
+        try:
+            self.loop.run()
+        except KeyboardInterrupt:
+            logger.debug("Server shutdown by user.")
+        except Exception as e:
+            logger.error(f"Server error: {e}")
+        finally:
+            self.shutdown()
+            self.loop.close()
+            logger.debug(f'Buffer pool stats: {default_pool.stats()}')
+            logger.debug('Stop mapping service.')
+
+
+def _resolve(host, port):
+    return resolver.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_STREAM)[0][4]
+
+
+def tcp_mapping(remote_ip, remote_port, local_ip, local_port, reuse_port=False, warm_pool=None, backends=None,
+                limit=None, backlog=LISTEN_BACKLOG, shaper=None, idle_timeout=IDLE_TIMEOUT, tls=None, tunnel=None):
+    """proxy.tcp_mapping 的事件循环版本"""
+    RelayEngine(remote_ip, remote_port, local_ip, local_port, reuse_port, warm_pool, backends, limit=limit,
+                backlog=backlog, shaper=shaper, idle_timeout=idle_timeout, tls=tls, tunnel=tunnel).serve_forever()
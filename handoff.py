@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# 平滑升级：新进程通过 Unix socket 从旧进程接收监听 socket（SCM_RIGHTS），端口始终处于监听状态
+
+import os
+import json
+import socket
+
+from proxy_common import logger
+
+# 等待对端响应的超时（秒）
+HANDOFF_TIMEOUT = 30
+# 单次最多传递的文件描述符数量
+MAX_FDS = 1024
+
+
+def handoff_supported():
+    return hasattr(socket, 'AF_UNIX') and hasattr(socket, 'send_fds')
+
+
+def listen_handoff(path):
+    """旧进程一侧：在 path 上等待新进程连接；残留的同名文件先删除"""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    logger.debug(f'Handoff socket listening on {path}')
+    return server
+
+
+def send_listeners(conn, listeners):
+    """旧进程一侧：把 {键: 监听 socket} 连同键列表一起发送给新进程
+
+    键为 (协议, 地址, 端口)，新进程据此把 socket 对应到自己的映射上。
+    """
+    keys = list(listeners)
+    manifest = json.dumps(keys).encode('utf-8')
+    socket.send_fds(conn, [manifest], [listeners[key].fileno() for key in keys])
+
+
+def take_over(path):
+    """新进程一侧：连接旧进程并接收监听 socket，返回 (连接, {键: socket})
+
+    新进程启动完全部映射后应向连接写入 b'ready'，旧进程收到后才停止接受新连接。
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(HANDOFF_TIMEOUT)
+    conn.connect(path)
+    manifest, fds, _, _ = socket.recv_fds(conn, 1024 * 1024, MAX_FDS)
+    keys = [tuple(key) for key in json.loads(manifest.decode('utf-8'))]
+    if len(keys) != len(fds):
+        for fd in fds:
+            os.close(fd)
+        conn.close()
+        raise OSError(f'handoff manifest lists {len(keys)} sockets but {len(fds)} were received')
+    listeners = {key: socket.socket(fileno=fd) for key, fd in zip(keys, fds)}
+    logger.debug(f'Took over {len(listeners)} listening sockets from {path}')
+    return conn, listeners
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Happy Eyeballs（RFC 8305）：对解析出的全部地址交替 IPv6/IPv4、错峰并发建连，最先连上的胜出
+
+import os
+import time
+import errno
+import socket
+import selectors
+from itertools import zip_longest
+
+# 相邻两次建连尝试的间隔（秒），RFC 8305 推荐 250ms
+ATTEMPT_DELAY = 0.25
+
+# 非阻塞 connect 进行中的错误码（Windows 为 WSAEWOULDBLOCK）
+_IN_PROGRESS = {getattr(errno, name) for name in ('EINPROGRESS', 'EWOULDBLOCK', 'EALREADY', 'WSAEWOULDBLOCK')
+                if hasattr(errno, name)}
+
+
+def interleave_families(addr_infos):
+    """按 RFC 8305 排序：第一个地址的协议族优先，之后 IPv6/IPv4 交替，去掉重复地址"""
+    if not addr_infos:
+        return []
+    first_family = addr_infos[0][0]
+    primary = [a for a in addr_infos if a[0] == first_family]
+    secondary = [a for a in addr_infos if a[0] != first_family]
+    ordered, seen = [], set()
+    for pair in zip_longest(primary, secondary):
+        for info in pair:
+            if info is not None and info[4] not in seen:
+                seen.add(info[4])
+                ordered.append(info)
+    return ordered
+
+
+def connect(addr_infos, timeout, setup=None, delay=ATTEMPT_DELAY):
+    """依次错峰发起连接，返回 (socket, sockaddr)；socket 为阻塞模式，其余尝试全部关闭
+
+    setup(sock) 在 connect 前调用，用于设置 KeepAlive 等选项。
+    全部失败时抛出最后一个错误，超过 timeout 仍未连上抛出 socket.timeout。
+    """
+    candidates = interleave_families(addr_infos)
+    if not candidates:
+        raise OSError('no address to connect')
+
+    selector = selectors.DefaultSelector()
+    pending = {}  # socket -> sockaddr
+    deadline = time.monotonic() + timeout
+    next_attempt = 0.0
+    last_error = None
+    winner = None
+
+    try:
+        while winner is None:
+            now = time.monotonic()
+            if now >= deadline:
+                raise socket.timeout('timed out')
+
+            # 到了下一次尝试的时间，或者当前没有进行中的尝试（上一个已失败），立即发起下一个
+            if candidates and (now >= next_attempt or not pending):
+                family, socktype, proto, _, sockaddr = candidates.pop(0)
+                sock = None
+                try:
+                    sock = socket.socket(family, socktype, proto)
+                    if setup:
+                        setup(sock)
+                    sock.setblocking(False)
+                    err = sock.connect_ex(sockaddr)
+                    if err == 0:
+                        winner = (sock, sockaddr)
+                        break
+                    if err not in _IN_PROGRESS:
+                        raise OSError(err, os.strerror(err))
+                except OSError as e:
+                    last_error = e
+                    if sock is not None:
+                        sock.close()
+                    continue
+                pending[sock] = sockaddr
+                selector.register(sock, selectors.EVENT_WRITE)
+                next_attempt = time.monotonic() + delay
+
+            if not pending:
+                if not candidates:
+                    raise last_error or OSError('connect failed')
+                continue
+
+            wait_until = deadline if not candidates else min(deadline, next_attempt)
+            for key, _ in selector.select(max(0, wait_until - time.monotonic())):
+                sock = key.fileobj
+                selector.unregister(sock)
+                sockaddr = pending.pop(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err == 0:
+                    winner = (sock, sockaddr)
+                    break
+                last_error = OSError(err, os.strerror(err))
+                sock.close()
+    finally:
+        for sock in pending:
+            sock.close()
+        selector.close()
+
+    winner[0].setblocking(True)
+    return winner
+
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# 空闲连接回收与半关闭：所有连接共用一个时间轮，两个方向都超过 idle_timeout 没有数据才断开，
+# 取代每个 socket 的 settimeout；一个方向读到 EOF 只 shutdown 对端的写方向，另一个方向继续转发
+
+import time
+import socket
+import threading
+
+from timing_wheel import TimingWheel
+
+# 两个方向都没有数据超过该时间（秒）才断开，0 表示不回收
+IDLE_TIMEOUT = 300
+# 时间轮精度（秒）
+REAPER_TICK = 1.0
+
+
+class IdleReaper:
+    """空闲回收器：条目需要提供 last_active 属性和 expire() 方法
+
+    线程模式由 start() 启动的后台线程推进，事件循环模式由循环定时调用 advance()。
+    """
+
+    def __init__(self, timeout=IDLE_TIMEOUT, tick=REAPER_TICK):
+        self.timeout = timeout
+        self.tick = tick
+        self.wheel = TimingWheel(tick)
+        self.reaped = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def watch(self, item):
+        if self.timeout > 0:
+            with self._lock:
+                self.wheel.add(item, self.timeout)
+
+    def forget(self, item):
+        with self._lock:
+            self.wheel.remove(item)
+
+    def advance(self, now=None):
+        """推进时间轮：到期条目期间有过数据则按剩余时间重新放入，否则调用 expire()"""
+        now = now or time.monotonic()
+        expired = []
+        with self._lock:
+            for item in self.wheel.advance(now):
+                idle = now - item.last_active
+                if self.timeout > 0 and idle < self.timeout:
+                    self.wheel.add(item, self.timeout - idle)
+                else:
+                    expired.append(item)
+        # 在锁外回调，expire() 里可能再调用 forget()
+        for item in expired:
+            self.reaped += 1
+            item.expire()
+        return len(expired)
+
+    def start(self):
+        if self.timeout > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='idle-reaper', daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            time.sleep(self.tick)
+            self.advance()
+
+
+class RelayPair:
+    """线程模式下的一对转发 socket，两个方向的线程共用
+
+    读到 EOF 的方向调用 half_close() 把 EOF 转给另一端，出错时 abort() 让两个方向一起结束；
+    两个方向都 done() 之后才真正关闭 socket。
+    """
+    __slots__ = ('local', 'remote', 'reaper', 'last_active', 'expired', '_pending', '_lock')
+
+    def __init__(self, local, remote, reaper=None):
+        self.local = local
+        self.remote = remote
+        self.reaper = reaper
+        self.last_active = time.monotonic()
+        self.expired = False
+        self._pending = 2
+        self._lock = threading.Lock()
+        if reaper:
+            reaper.watch(self)
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    @staticmethod
+    def half_close(sock):
+        try:
+            sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    def abort(self):
+        """两个 socket 都 shutdown：close() 唤醒不了阻塞在 recv 上的另一个线程，shutdown 可以"""
+        for sock in (self.local, self.remote):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def expire(self):
+        self.expired = True
+        self.abort()
+
+    def done(self):
+        with self._lock:
+            self._pending -= 1
+            if self._pending:
+                return
+        if self.reaper:
+            self.reaper.forget(self)
+        self.local.close()
+        self.remote.close()
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+# Prometheus 文本格式的本地指标接口
+# 计数按线程分片、无锁累加，抓取时再汇总；转发中的字节数直接读取活动连接的统计，热路径没有额外开销
+
+import json
+import time
+import bisect
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from proxy_common import logger
+from profiler import profiler, PROFILE_SECONDS
+
+# 直方图分桶（秒）
+CONNECT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DURATION_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+# /stats 默认推送间隔（秒）与允许的范围
+STATS_INTERVAL = 1.0
+STATS_MIN_INTERVAL = 0.1
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class _Shard:
+    """单个线程独占写入的计数分片"""
+    __slots__ = ('accepted', 'failed', 'bytes_up', 'bytes_down', 'connect_latency', 'duration')
+
+    def __init__(self):
+        self.accepted = 0
+        self.failed = 0
+        self.bytes_up = 0  # 已结束连接的字节数，活动连接的字节数在抓取时读取
+        self.bytes_down = 0
+        self.connect_latency = Histogram(CONNECT_BUCKETS)
+        self.duration = Histogram(DURATION_BUCKETS)
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.active = set()
+        self._shards = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # 事件循环引擎注册的回调，返回其管理的连接数
+        self.task_counters = []
+        # 其他组件（预连接池等）注册的回调，返回若干行 Prometheus 文本
+        self.collectors = []
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            # 线程号会被新线程复用，旧线程已结束，直接沿用它的分片，分片数不会超过并发线程峰值
+            with self._lock:
+                shard = self._shards.setdefault(threading.get_ident(), _Shard())
+            self._local.shard = shard
+        return shard
+
+    # ---------- 连接生命周期（每连接调用，不在逐包路径上） ----------
+    def opened(self, record):
+        if not self.enabled:
+            return
+        self._shard().accepted += 1
+        # 与 closed() 和抓取时的遍历互斥，避免抓取时集合大小改变
+        with self._lock:
+            self.active.add(record)
+
+    def connected(self, latency):
+        if self.enabled:
+            self._shard().connect_latency.observe(latency)
+
+    def closed(self, record, duration, failed):
+        if not self.enabled:
+            return
+        shard = self._shard()
+        # 与抓取互斥，保证字节计数从活动连接转入分片时不会被重复或遗漏统计
+        with self._lock:
+            self.active.discard(record)
+            shard.bytes_up += record.bytes_up
+            shard.bytes_down += record.bytes_down
+        shard.duration.observe(duration)
+        if failed:
+            shard.failed += 1
+
+    # ---------- 抓取时汇总 ----------
+    def _collect(self):
+        with self._lock:
+            shards = list(self._shards.values())
+            active = tuple(self.active)
+            bytes_up = sum(s.bytes_up for s in shards) + sum(r.bytes_up for r in active)
+            bytes_down = sum(s.bytes_down for s in shards) + sum(r.bytes_down for r in active)
+        return shards, active, bytes_up, bytes_down
+
+    def snapshot(self):
+        """当前累计值，/stats 据此计算两次之间的速率；monotonic 用于计算间隔，time 只用于显示"""
+        shards, active, bytes_up, bytes_down = self._collect()
+        return {
+            'monotonic': time.monotonic(),
+            'time': time.time(),
+            'active': len(active),
+            'accepted': sum(s.accepted for s in shards),
+            'failed': sum(s.failed for s in shards),
+            'bytes_up': bytes_up,
+            'bytes_down': bytes_down,
+            'connects': sum(sum(s.connect_latency.counts) for s in shards),
+            'connect_seconds': sum(s.connect_latency.sum for s in shards),
+        }
+
+    def render(self):
+        shards, active, bytes_up, bytes_down = self._collect()
+        accepted = sum(s.accepted for s in shards)
+        failed = sum(s.failed for s in shards)
+        tasks = sum(counter() for counter in self.task_counters)
+
+        lines = [
+            '# HELP proxy_active_connections Connections currently being relayed.',
+            '# TYPE proxy_active_connections gauge',
+            f'proxy_active_connections {len(active)}',
+            '# HELP proxy_connections_accepted_total Accepted client connections.',
+            '# TYPE proxy_connections_accepted_total counter',
+            f'proxy_connections_accepted_total {accepted}',
+            '# HELP proxy_connections_failed_total Client connections whose upstream connect failed.',
+            '# TYPE proxy_connections_failed_total counter',
+            f'proxy_connections_failed_total {failed}',
+            '# HELP proxy_bytes_total Bytes relayed per direction.',
+            '# TYPE proxy_bytes_total counter',
+            f'proxy_bytes_total{{direction="up"}} {bytes_up}',
+            f'proxy_bytes_total{{direction="down"}} {bytes_down}',
+            '# HELP proxy_threads Live Python threads.',
+            '# TYPE proxy_threads gauge',
+            f'proxy_threads {threading.active_count()}',
+            '# HELP proxy_event_tasks Connections owned by event loop engines.',
+            '# TYPE proxy_event_tasks gauge',
+            f'proxy_event_tasks {tasks}',
+        ]
+        lines += self._render_histogram('proxy_upstream_connect_seconds', 'Upstream connect latency.',
+                                        [s.connect_latency for s in shards], CONNECT_BUCKETS)
+        lines += self._render_histogram('proxy_connection_duration_seconds', 'Client connection duration.',
+                                        [s.duration for s in shards], DURATION_BUCKETS)
+        for collector in self.collectors:
+            lines += collector()
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _render_histogram(name, help_text, histograms, buckets):
+        counts = [sum(h.counts[i] for h in histograms) for i in range(len(buckets) + 1)]
+        lines = [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+        cumulative = 0
+        for bound, count in zip(buckets, counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        cumulative += counts[-1]
+        lines.append(f'{name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f'{name}_sum {sum(h.sum for h in histograms)}')
+        lines.append(f'{name}_count {cumulative}')
+        return lines
+
+
+# 进程内共享的指标
+metrics = Metrics()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/debug/profile':
+            self._profile(parse_qs(url.query))
+            return
+        if url.path == '/stats':
+            self._stats(parse_qs(url.query))
+            return
+        if url.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        self._reply(metrics.render(), 'text/plain; version=0.0.4; charset=utf-8')
+
+    def _profile(self, query):
+        """/debug/profile?seconds=10&timing=1：阻塞采样，返回输出文件路径与调用耗时摘要（JSON）"""
+        try:
+            seconds = float(query.get('seconds', [PROFILE_SECONDS])[0])
+        except ValueError:
+            self.send_error(400, 'seconds must be a number')
+            return
+        result = profiler.run(seconds, query.get('timing', ['0'])[0] not in ('0', ''))
+        if result is None:
+            self.send_error(409, 'profiler is already running')
+            return
+        self._reply(json.dumps(result, indent=2) + '\n', 'application/json')
+
+    def _stats(self, query):
+        """/stats?interval=1：每隔 interval 秒输出一行 JSON（累计值与期间的速率），直到客户端断开"""
+        try:
+            interval = max(STATS_MIN_INTERVAL, float(query.get('interval', [STATS_INTERVAL])[0]))
+        except ValueError:
+            self.send_error(400, 'interval must be a number')
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        previous = metrics.snapshot()
+        try:
+            while True:
+                time.sleep(interval)
+                current = metrics.snapshot()
+                # 墙上时钟会被 NTP 或手工调整，回拨时速率为负、跳变时失真，间隔只用单调时钟计算
+                elapsed = (current['monotonic'] - previous['monotonic']) or interval
+                connects = current['connects'] - previous['connects']
+                current.update({
+                    'up_bps': round((current['bytes_up'] - previous['bytes_up']) / elapsed),
+                    'down_bps': round((current['bytes_down'] - previous['bytes_down']) / elapsed),
+                    'accepted_ps': round((current['accepted'] - previous['accepted']) / elapsed, 2),
+                    'errors': current['failed'] - previous['failed'],
+                    'connect_ms': round((current['connect_seconds'] - previous['connect_seconds']) / connects * 1000,
+                                        3) if connects else None,
+                })
+                line = {key: value for key, value in current.items() if key != 'monotonic'}
+                self.wfile.write(json.dumps(line).encode('utf-8') + b'\n')
+                self.wfile.flush()
+                previous = current
+        except OSError:
+            pass  # 客户端断开
+
+    def _reply(self, text, content_type):
+        body = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(host, port, sock=None):
+    """在后台线程启动 /metrics 接口，并开始统计；sock 为平滑升级时从旧进程接管的监听 socket"""
+    metrics.enabled = True
+    server = ThreadingHTTPServer((host, port), _MetricsHandler, bind_and_activate=sock is None)
+    if sock is not None:
+        server.socket.close()
+        server.socket = sock
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.debug(f'Metrics endpoint on http://{host}:{server.server_address[1]}/metrics '
+                 f'(stats stream: /stats?interval=N, profiling: /debug/profile?seconds=N&timing=1)')
+    return server
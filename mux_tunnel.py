@@ -0,0 +1,598 @@
+# -*- coding: utf-8 -*-
+# 两个代理之间的多路复用隧道：mux-client 与 mux-server 之间保持少量长连接（link），每个客户端连接是 link 上的一个流（stream），
+# 不再为每个客户端新建跨地域的 TCP 连接（省去握手 RTT、慢启动，也不占用 conntrack 和临时端口）。
+# 新流的 OPEN 帧和第一段数据一起发出，不等待对端应答；mux-server 收到 OPEN 后连接真正的远端，连上之前收到的数据先缓存。
+# 每个流按窗口做流量控制：发送方最多发出对端授予的窗口，接收方把数据写给本地 socket 后归还窗口，
+# 一个读得慢的客户端只会停住自己的流，不会占满 link 拖慢其他流。
+
+import os
+import time
+import errno
+import socket
+import struct
+import itertools
+import selectors
+
+from proxy_common import logger, CONN_TIMEOUT, set_keepalive
+from access_log import ConnectionRecord
+from metrics import metrics
+from event_engine import RelayEngine, ACCEPT_BATCH
+from admission import LISTEN_BACKLOG
+from idle_reaper import IDLE_TIMEOUT
+
+# 隧道两端的模式
+MUX_MODES = ('mux-client', 'mux-server')
+# mux-client 与对端保持的长连接数
+MUX_LINKS = 2
+# 每个流每个方向的窗口（字节）：对端未归还窗口前最多发出这么多数据
+INITIAL_WINDOW = 256 * 1024
+# 单个 DATA 帧的最大负载
+MAX_DATA = 16 * 1024
+# link 待发送数据超过该值时所有流暂停读取，写出后恢复
+LINK_HIGH_WATER = 1024 * 1024
+# link 断开后重连的间隔（秒）
+RECONNECT_DELAY = 1
+
+# link 建立后 mux-client 首先发出的前导：魔数 + 版本
+PREAMBLE = b'PMX\x01'
+# 帧头：类型、流 ID、负载长度
+FRAME = struct.Struct('!BII')
+OPEN, DATA, FIN, RST, WINDOW = range(5)
+# WINDOW 帧的负载：归还的窗口大小
+WINDOW_UPDATE = struct.Struct('!I')
+
+_RETRY = (BlockingIOError, InterruptedError)
+
+
+class MuxLink:
+    """两个代理之间的一条长连接，承载多个流；draining 表示不再分配新流，现有流结束后关闭"""
+
+    def __init__(self, engine, sock, name=None, connecting=False):
+        self.engine = engine
+        self.loop = engine.loop
+        self.sock = sock
+        self.name = name  # 对端地址
+        self.streams = {}  # 流 ID -> MuxStream
+        self.rbuf = bytearray()
+        self.wbuf = bytearray()
+        self.connecting = connecting
+        self.preamble = engine.server_side  # mux-server 一侧先校验前导
+        self.draining = False
+        self.closed = False
+        self.timer = None  # 连接对端的超时
+
+    @property
+    def congested(self):
+        return len(self.wbuf) >= LINK_HIGH_WATER
+
+    # ---------- 建立 ----------
+    def connect(self, address):
+        """mux-client 一侧：非阻塞连接对端，连上之前的帧先留在发送缓冲里"""
+        self.wbuf += PREAMBLE
+        try:
+            set_keepalive(self.sock)
+            self.sock.setblocking(False)
+            err = self.sock.connect_ex(address)
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                raise OSError(err, errno.errorcode.get(err, 'connect error'))
+        except OSError as e:
+            # 在事件循环里关闭，调用方拿到的 link 总是可用的
+            self.loop.call_later(0, lambda: self.close(f'connect failed: {e}'))
+            return
+        self.loop.set_events(self.sock, selectors.EVENT_WRITE, self._on_connected)
+        self.timer = self.loop.call_later(CONN_TIMEOUT, lambda: self.close('connect timed out'))
+
+    def _on_connected(self, mask):
+        self.timer.cancel()
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self.close(f'connect failed: {os.strerror(err)}')
+            return
+        self.connecting = False
+        logger.debug(f'Mux link to {self.name} established.')
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._flush()
+
+    def start(self):
+        """mux-server 一侧：已 accept 的连接直接开始读帧"""
+        self.sock.setblocking(False)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._update()
+
+    # ---------- 发送 ----------
+    def send(self, kind, stream_id, payload=b''):
+        wbuf = self.wbuf
+        idle = not wbuf
+        wbuf += FRAME.pack(kind, stream_id, len(payload))
+        if payload:
+            wbuf += payload
+        # 发送缓冲原本为空时立即尝试写出，否则等可写事件
+        if idle and not self.connecting:
+            self._flush()
+
+    def _flush(self):
+        congested = self.congested
+        try:
+            sent = self.sock.send(self.wbuf)
+        except _RETRY:
+            sent = 0
+        except OSError as e:
+            self.close(str(e))
+            return
+        del self.wbuf[:sent]
+        self._update()
+        # 积压降到水位以下，恢复因 link 拥塞暂停读取的流
+        if congested and not self.congested:
+            for stream in list(self.streams.values()):
+                stream.update()
+
+    def _update(self):
+        if self.closed or self.connecting:
+            return
+        events = selectors.EVENT_READ
+        if self.wbuf:
+            events |= selectors.EVENT_WRITE
+        self.loop.set_events(self.sock, events, self._on_event)
+
+    # ---------- 接收 ----------
+    def _on_event(self, mask):
+        if mask & selectors.EVENT_WRITE and not self.closed:
+            self._flush()
+        if mask & selectors.EVENT_READ and not self.closed:
+            self._on_readable()
+
+    def _on_readable(self):
+        view = self.engine.read_view
+        try:
+            size = self.sock.recv_into(view)
+        except _RETRY:
+            return
+        except OSError as e:
+            self.close(str(e))
+            return
+        if not size:
+            self.close('closed by peer')
+            return
+        buf = self.rbuf
+        buf += view[:size]
+        if self.preamble:
+            if len(buf) < len(PREAMBLE):
+                return
+            if buf[:len(PREAMBLE)] != PREAMBLE:
+                self.close('not a mux tunnel peer')
+                return
+            del buf[:len(PREAMBLE)]
+            self.preamble = False
+        offset = 0
+        while len(buf) - offset >= FRAME.size:
+            kind, stream_id, length = FRAME.unpack_from(buf, offset)
+            if length > max(MAX_DATA, WINDOW_UPDATE.size):
+                self.close(f'bad frame length {length}')
+                return
+            end = offset + FRAME.size + length
+            if len(buf) < end:
+                break
+            self._on_frame(kind, stream_id, buf[offset + FRAME.size:end])
+            if self.closed:
+                return
+            offset = end
+        del buf[:offset]
+
+    def _on_frame(self, kind, stream_id, payload):
+        stream = self.streams.get(stream_id)
+        if kind == OPEN:
+            if self.engine.server_side and stream is None:
+                self.engine.open_stream(self, stream_id)
+            else:
+                self.close(f'unexpected OPEN for stream {stream_id}')
+        elif stream is None:
+            # 本端已关闭的流，对端还在途的数据直接丢弃，并让对端也关闭
+            if kind == DATA:
+                self.send(RST, stream_id)
+        elif kind == DATA:
+            stream.on_data(payload)
+        elif kind == FIN:
+            stream.on_fin()
+        elif kind == RST:
+            stream.close('reset_by_peer')
+        elif kind == WINDOW and len(payload) == WINDOW_UPDATE.size:
+            stream.on_window(WINDOW_UPDATE.unpack(payload)[0])
+        else:
+            self.close(f'bad frame type {kind}')
+
+    # ---------- 关闭 ----------
+    def close(self, reason):
+        """link 断开时其上的全部流一起关闭"""
+        if self.closed:
+            return
+        self.closed = True
+        if self.timer:
+            self.timer.cancel()
+        if reason:
+            logger.warning(f'Mux link {self.name} closed: {reason}')
+        self.loop.forget(self.sock)
+        self.sock.close()
+        for stream in list(self.streams.values()):
+            stream.close('link_closed')
+        self.engine.link_closed(self)
+
+
+class MuxStream:
+    """link 上的一个流，本地一端是 socket：mux-client 为客户端连接，mux-server 为到真正远端的连接"""
+
+    def __init__(self, engine, link, stream_id, sock, record, connecting=False):
+        self.engine = engine
+        self.loop = engine.loop
+        self.link = link
+        self.id = stream_id
+        self.sock = sock
+        self.record = record
+        self.record.mode = 'mux'
+        self.send_window = INITIAL_WINDOW  # 还能发给对端的字节数
+        self.unacked = 0  # 已写给本地 socket、尚未归还给对端的窗口
+        self.pending = bytearray()  # 对端发来、尚未写给本地 socket 的数据
+        self.connecting = connecting
+        self.eof = False  # 本地 socket 读到 EOF，已发出 FIN
+        self.fin = False  # 收到对端的 FIN
+        self.shut = False  # 已把对端的 FIN 转给本地 socket（shutdown 写方向）
+        self.reason = None  # 第一个结束的方向
+        self.closed = False
+        self.timer = None  # mux-server 连接远端的超时
+        self.connect_start = time.monotonic()
+        self.last_active = time.monotonic()
+        link.streams[stream_id] = self
+
+    # ---------- mux-server 连接远端 ----------
+    def connect(self, address):
+        try:
+            set_keepalive(self.sock)
+            self.sock.setblocking(False)
+            err = self.sock.connect_ex(address)
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                raise OSError(err, errno.errorcode.get(err, 'connect error'))
+        except OSError as e:
+            logger.error(f'Connection failed: {e}')
+            self.reset('connect_failed')
+            return
+        self.loop.set_events(self.sock, selectors.EVENT_WRITE, self._on_connected)
+        self.timer = self.loop.call_later(CONN_TIMEOUT, self._on_connect_timeout)
+
+    def _on_connect_timeout(self):
+        logger.error('Connection failed: timed out')
+        self.reset('connect_failed')
+
+    def _on_connected(self, mask):
+        self.timer.cancel()
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            logger.error(f'Connection failed: {os.strerror(err)}')
+            self.reset('connect_failed')
+            return
+        self.connecting = False
+        self.record.connected(self.sock.getpeername(), time.monotonic() - self.connect_start)
+        self.start()
+
+    # ---------- 转发 ----------
+    def start(self):
+        self.last_active = time.monotonic()
+        self.engine.reaper.watch(self)
+        # 连上之前对端已发来的数据和 FIN
+        if self.pending:
+            self._flush()
+        else:
+            self.update()
+            self._check_done()
+
+    def update(self):
+        """读：未读到 EOF、对端还有窗口且 link 没有积压时才读；写：有待写数据时才写"""
+        if self.closed or self.connecting:
+            return
+        events = 0
+        if not self.eof and self.send_window > 0 and not self.link.congested:
+            events |= selectors.EVENT_READ
+        if self.pending:
+            events |= selectors.EVENT_WRITE
+        self.loop.set_events(self.sock, events, self._on_event)
+
+    def _on_event(self, mask):
+        if mask & selectors.EVENT_WRITE and not self.closed:
+            self._flush()
+        if mask & selectors.EVENT_READ and not self.closed:
+            self._on_readable()
+
+    def _on_readable(self):
+        view = self.engine.read_view
+        try:
+            size = self.sock.recv_into(view, min(len(view), self.send_window, MAX_DATA))
+        except _RETRY:
+            return
+        except OSError:
+            self.reset('recv_error')
+            return
+        if not size:
+            # 半关闭：通知对端，另一个方向继续转发
+            self.eof = True
+            if self.reason is None:
+                self.reason = self._closed_reason(local=True)
+            self.link.send(FIN, self.id)
+            self.update()
+            self._check_done()
+            return
+        self.last_active = time.monotonic()
+        self.send_window -= size
+        self._count(size, outgoing=True)
+        self.link.send(DATA, self.id, view[:size])
+        if self.send_window <= 0:
+            self.engine.window_stalls += 1
+            self.update()
+        elif self.link.congested:
+            self.update()
+
+    def on_data(self, payload):
+        # 对端发出的数据不会超过窗口，超过说明两端状态不一致
+        if len(self.pending) + self.unacked + len(payload) > INITIAL_WINDOW:
+            self.reset('flow_control_error')
+            return
+        self.last_active = time.monotonic()
+        self.pending += payload
+        self._count(len(payload), outgoing=False)
+        if not self.connecting:
+            self._flush()
+
+    def _flush(self):
+        try:
+            sent = self.sock.send(self.pending)
+        except _RETRY:
+            sent = 0
+        except OSError:
+            self.reset('send_error')
+            return
+        del self.pending[:sent]
+        # 写出超过半个窗口时归还给对端，攒一攒减少 WINDOW 帧
+        self.unacked += sent
+        if self.unacked >= INITIAL_WINDOW // 2:
+            self.link.send(WINDOW, self.id, WINDOW_UPDATE.pack(self.unacked))
+            self.unacked = 0
+        self.update()
+        self._check_done()
+
+    def on_window(self, increment):
+        stalled = self.send_window <= 0
+        self.send_window += increment
+        if stalled:
+            self.update()
+
+    def on_fin(self):
+        self.fin = True
+        if self.reason is None:
+            self.reason = self._closed_reason(local=False)
+        self._check_done()
+
+    def _check_done(self):
+        """对端 FIN 且待写数据写完：shutdown 本地写方向；两个方向都结束后关闭流"""
+        if self.closed or self.connecting:
+            return
+        if self.fin and not self.pending and not self.shut:
+            self.shut = True
+            try:
+                self.sock.shutdown(socket.SHUT_WR)
+            except OSError:
+                self.reset('send_error')
+                return
+        if self.eof and self.shut:
+            self.close(self.reason)
+
+    def _closed_reason(self, local):
+        # mux-client 的本地 socket 是客户端，mux-server 的本地 socket 是远端
+        return 'client_closed' if local != self.engine.server_side else 'upstream_closed'
+
+    def _count(self, size, outgoing):
+        if outgoing != self.engine.server_side:
+            self.record.bytes_up += size
+        else:
+            self.record.bytes_down += size
+
+    # ---------- 超时与关闭 ----------
+    def expire(self):
+        self.reset('idle_timeout')
+
+    def reset(self, reason):
+        """异常结束：通知对端关闭这个流"""
+        if not self.closed and not self.link.closed:
+            self.engine.resets += 1
+            self.link.send(RST, self.id)
+        self.close(reason)
+
+    def close(self, reason='closed'):
+        if self.closed:
+            return
+        self.closed = True
+        if reason == 'reset_by_peer':
+            self.engine.resets += 1
+        self.record.finish(reason)
+        if self.timer:
+            self.timer.cancel()
+        self.engine.reaper.forget(self)
+        self.loop.forget(self.sock)
+        self.sock.close()
+        link = self.link
+        link.streams.pop(self.id, None)
+        self.engine.connection_closed(self)
+        if link.draining and not link.streams:
+            link.close(None)
+
+
+class _MuxEngine(RelayEngine):
+    """mux-client / mux-server 共用的部分：connections 为全部流，links 为全部长连接"""
+    server_side = False
+
+    def __init__(self, remote_ip, remote_port, local_ip, local_port, reuse_port=False, loop=None, limit=None,
+                 backlog=LISTEN_BACKLOG, idle_timeout=IDLE_TIMEOUT, name=''):
+        super().__init__(remote_ip, remote_port, local_ip, local_port, reuse_port, loop=loop, limit=limit,
+                         backlog=backlog, idle_timeout=idle_timeout)
+        self.name = name
+        self.links = set()
+        self.opened = 0
+        self.resets = 0
+        self.window_stalls = 0
+
+    def link_closed(self, link):
+        self.links.discard(link)
+
+    def shutdown(self):
+        super().shutdown()
+        for link in list(self.links):
+            link.close(None)
+
+    def render_metrics(self):
+        return render_mux_metrics([self])
+
+
+class MuxClient(_MuxEngine):
+    """mux-client：接受客户端连接，作为流发往 links 条长连接中负载最少的一条"""
+
+    def __init__(self, *args, links=MUX_LINKS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.link_count = max(1, links)
+        self.stream_ids = itertools.count(1)
+        self.reconnect_timer = None
+
+    def start(self, server=None):
+        super().start(server)
+        self._fill_links()
+        logger.debug(f'Mux client keeping {self.link_count} links to {self.remote_ip}:{self.remote_port}.')
+
+    def set_remote(self, remote_ip, remote_port, backends=None):
+        old = self.remote_addr
+        super().set_remote(remote_ip, remote_port)
+        if old is not None and self.remote_addr != old:
+            # 远端更换：旧 link 上的流继续转发直到结束，新流走新 link
+            for link in list(self.links):
+                link.draining = True
+                if not link.streams:
+                    link.close(None)
+            self._fill_links()
+
+    def set_links(self, count):
+        """修改长连接数量：增加时立即补足，减少时多出的 link 上不再分配新流，流结束后关闭"""
+        self.link_count = max(1, count)
+        for link in self._active_links()[self.link_count:]:
+            link.draining = True
+            if not link.streams:
+                link.close(None)
+        self._fill_links()
+
+    def _active_links(self):
+        return [link for link in self.links if not link.draining]
+
+    def _fill_links(self):
+        self.reconnect_timer = None
+        if self.server is None:
+            return
+        for _ in range(self.link_count - len(self._active_links())):
+            self._new_link()
+
+    def _new_link(self):
+        link = MuxLink(self, socket.socket(socket.AF_INET, socket.SOCK_STREAM), self.remote_addr, connecting=True)
+        self.links.add(link)
+        link.connect(self.remote_addr)
+        return link
+
+    def link_closed(self, link):
+        super().link_closed(link)
+        if self.server is not None and self.reconnect_timer is None and not link.draining:
+            self.reconnect_timer = self.loop.call_later(RECONNECT_DELAY, self._fill_links)
+
+    def shutdown(self):
+        if self.reconnect_timer:
+            self.reconnect_timer.cancel()
+            self.reconnect_timer = None
+        super().shutdown()
+
+    def _relay(self, local_conn, local_addr, record):
+        # 优先已连上的 link 中流最少的一条；全部断开时新建一条，帧先缓存，连上后立即发出
+        links = self._active_links()
+        ready = [link for link in links if not link.connecting] or links
+        link = min(ready, key=lambda link: len(link.streams)) if ready else self._new_link()
+        local_conn.setblocking(False)
+        stream = MuxStream(self, link, next(self.stream_ids), local_conn, record)
+        self.connections.add(stream)
+        self.opened += 1
+        # 不等待对端应答，OPEN 之后客户端的数据直接跟上；没有实际建连，不记录建连耗时
+        link.send(OPEN, stream.id)
+        record.connected(self.remote_addr)
+        if not link.closed:
+            stream.start()
+
+
+class MuxServer(_MuxEngine):
+    """mux-server：接受 mux-client 的长连接，为每个流连接真正的远端"""
+    server_side = True
+
+    def _on_accept(self, mask):
+        for _ in range(ACCEPT_BATCH):
+            try:
+                sock, addr = self.server.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logger.error(f"Error handling connection: {e}")
+                return
+            logger.debug(f'Mux link from {addr[0]}:{addr[1]} accepted.')
+            link = MuxLink(self, sock, addr)
+            self.links.add(link)
+            link.start()
+
+    def open_stream(self, link, stream_id):
+        if self.limit and not self.limit.admit(wait=False):
+            self.resets += 1
+            link.send(RST, stream_id)
+            return
+        record = ConnectionRecord(link.name)
+        record.admission = self.limit
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        except OSError as e:
+            logger.error(f'Connection failed: {e}')
+            record.finish('connect_failed')
+            self.resets += 1
+            link.send(RST, stream_id)
+            return
+        stream = MuxStream(self, link, stream_id, sock, record, connecting=True)
+        self.connections.add(stream)
+        self.opened += 1
+        stream.connect(self.remote_addr)
+
+
+_MUX_METRICS = (
+    ('proxy_mux_links', 'gauge', 'Tunnel links between the two proxies.', lambda engine: len(engine.links)),
+    ('proxy_mux_streams', 'gauge', 'Streams currently open over the tunnel.', lambda engine: len(engine.connections)),
+    ('proxy_mux_streams_opened_total', 'counter', 'Streams opened over the tunnel.', lambda engine: engine.opened),
+    ('proxy_mux_stream_resets_total', 'counter', 'Streams reset by either side.', lambda engine: engine.resets),
+    ('proxy_mux_window_stalls_total', 'counter', 'Times a stream stopped reading because the peer window was full.',
+     lambda engine: engine.window_stalls),
+)
+
+
+def render_mux_metrics(engines):
+    """多个 mux 映射的指标，按指标名分组输出"""
+    lines = []
+    for name, kind, help_text, value in _MUX_METRICS:
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+        for engine in engines:
+            labels = f'{{mapping="{engine.name}"}}' if engine.name else ''
+            lines.append(f'{name}{labels} {value(engine)}')
+    return lines
+
+
+def mux_mapping(mode, remote_ip, remote_port, local_ip, local_port, reuse_port=False, limit=None,
+                backlog=LISTEN_BACKLOG, idle_timeout=IDLE_TIMEOUT, links=MUX_LINKS):
+    """proxy.py --tunnel mux-client/mux-server：单个映射独占一个事件循环运行"""
+    if mode == 'mux-client':
+        engine = MuxClient(remote_ip, remote_port, local_ip, local_port, reuse_port, limit=limit, backlog=backlog,
+                           idle_timeout=idle_timeout, links=links)
+    else:
+        engine = MuxServer(remote_ip, remote_port, local_ip, local_port, reuse_port, limit=limit, backlog=backlog,
+                           idle_timeout=idle_timeout)
+    metrics.collectors.append(engine.render_metrics)
+    engine.serve_forever()
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+# 运行时按需开启的采样分析：定时抓取所有线程（转发线程、事件循环）的调用栈，输出 collapsed stack 文件，
+# 可直接交给 flamegraph.pl / speedscope 生成火焰图；可选记录热路径上 socket 调用（recv/send/connect 等）的耗时。
+# 未开启时没有采样线程、没有 profile 钩子，对转发没有任何开销。
+
+import os
+import re
+import sys
+import json
+import time
+import bisect
+import signal
+import socket
+import threading
+from collections import Counter
+
+from proxy_common import logger
+
+# 信号触发时的采样时长（秒）与采样间隔
+PROFILE_SECONDS = 10
+SAMPLE_INTERVAL = 0.005
+# 输出目录（与 proxy.log 同在工作目录）
+PROFILE_DIR = '.'
+# 记录耗时的 C 层调用：socket 方法与 os.splice
+TIMED_CALLS = frozenset(('recv', 'recv_into', 'recvfrom', 'recvfrom_into', 'recvmsg', 'send', 'sendall', 'sendto',
+                         'sendmsg', 'connect', 'connect_ex', '_accept', 'splice'))
+# 调用耗时分桶（秒）
+TIMING_BUCKETS = (0.000001, 0.000005, 0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+
+_posix = sys.modules.get('posix')
+
+
+class _CallStats:
+    __slots__ = ('count', 'total', 'max', 'counts')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.counts = [0] * (len(TIMING_BUCKETS) + 1)
+
+    def observe(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        self.counts[bisect.bisect_left(TIMING_BUCKETS, elapsed)] += 1
+
+    def quantile(self, q):
+        """按分桶估算分位数（取所在桶的上界）"""
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(TIMING_BUCKETS, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total_ms': round(self.total * 1000, 3),
+            'avg_us': round(self.total / self.count * 1e6, 1) if self.count else 0,
+            'p50_us_le': round(self.quantile(0.5) * 1e6, 1),
+            'p99_us_le': round(self.quantile(0.99) * 1e6, 1),
+            'max_us': round(self.max * 1e6, 1),
+        }
+
+
+def _thread_label(name):
+    """'Thread-12 (tcp_mapping_worker)' -> 'Thread (tcp_mapping_worker)'，同类线程的栈合并到一起"""
+    return re.sub(r'[-_]\d+', '', name)
+
+
+class Profiler:
+    """同一时间只运行一次采样；start() 立即返回，run() 阻塞到采样结束"""
+
+    def __init__(self):
+        self.active = False
+        self.timing = {}  # 调用名 -> _CallStats
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    # ---------- 调用耗时 ----------
+    def _hook(self, frame, event, arg):
+        if not self.active:
+            # 采样结束后各线程在下一次调用时自行卸下钩子
+            sys.setprofile(None)
+            return
+        if event == 'c_call':
+            if getattr(arg, '__name__', None) in TIMED_CALLS:
+                owner = getattr(arg, '__self__', None)
+                if isinstance(owner, socket.socket) or (owner is not None and owner is _posix):
+                    self._local.call = (arg.__name__, time.perf_counter())
+        elif event == 'c_return' or event == 'c_exception':
+            call = getattr(self._local, 'call', None)
+            if call is not None and call[0] == getattr(arg, '__name__', None):
+                elapsed = time.perf_counter() - call[1]
+                self._local.call = None
+                with self._lock:
+                    stats = self.timing.get(call[0])
+                    if stats is None:
+                        stats = self.timing[call[0]] = _CallStats()
+                    stats.observe(elapsed)
+
+    def _set_hook(self, hook):
+        # 3.12+ 可以给已在运行的线程设置钩子；更早的版本只覆盖新建线程和发起采样的线程（信号处理在主线程）
+        if hasattr(threading, 'setprofile_all_threads'):
+            threading.setprofile_all_threads(hook)
+            return
+        threading.setprofile(hook)
+        if hook is None or threading.current_thread() is threading.main_thread():
+            sys.setprofile(hook)
+
+    # ---------- 采样 ----------
+    def start(self, seconds=PROFILE_SECONDS, timing=False):
+        """后台采样 seconds 秒；已有采样在进行时返回 False"""
+        if not self._begin(timing):
+            return False
+        threading.Thread(target=self._sample, args=(seconds, timing), name='profiler', daemon=True).start()
+        return True
+
+    def run(self, seconds=PROFILE_SECONDS, timing=False):
+        """在当前线程采样，返回结果摘要；已有采样在进行时返回 None"""
+        if not self._begin(timing):
+            return None
+        return self._sample(seconds, timing)
+
+    def _begin(self, timing):
+        with self._lock:
+            if self.active:
+                logger.warning('Profiler is already running.')
+                return False
+            self.active = True
+            self.timing = {}
+        if timing:
+            self._set_hook(self._hook)
+        return True
+
+    def _sample(self, seconds, timing):
+        logger.info(f'Profiling for {seconds}s (call timing {"on" if timing else "off"}) ...')
+        me = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+        labels = {}
+        start = time.monotonic()
+        deadline = start + seconds
+        try:
+            while time.monotonic() < deadline:
+                frames = sys._current_frames()
+                # 出现新线程时才重新获取线程名
+                if not labels.keys() >= frames.keys():
+                    labels = {thread.ident: _thread_label(thread.name) for thread in threading.enumerate()}
+                for ident, frame in frames.items():
+                    if ident == me:
+                        continue
+                    names = []
+                    while frame is not None:
+                        code = frame.f_code
+                        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                        frame = frame.f_back
+                    names.append(labels.get(ident, 'thread'))
+                    stacks[';'.join(reversed(names))] += 1
+                samples += 1
+                time.sleep(SAMPLE_INTERVAL)
+        finally:
+            self.active = False
+            if timing:
+                self._set_hook(None)
+        return self._dump(stacks, samples, time.monotonic() - start, timing)
+
+    def _dump(self, stacks, samples, elapsed, timing):
+        prefix = os.path.join(PROFILE_DIR, f'profile-{os.getpid()}-{time.strftime("%Y%m%d-%H%M%S")}')
+        with open(prefix + '.folded', 'w', encoding='utf-8') as f:
+            for stack, count in stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        result = {'samples': samples, 'seconds': round(elapsed, 3), 'folded': prefix + '.folded', 'timing': None}
+        if timing:
+            with self._lock:
+                result['timing'] = {name: stats.summary() for name, stats in sorted(self.timing.items())}
+            with open(prefix + '.timing.json', 'w', encoding='utf-8') as f:
+                json.dump(result['timing'], f, indent=2)
+        logger.info(f'Profile written to {prefix}.folded ({samples} samples)')
+        if result['timing']:
+            logger.info(f'Call timing: {json.dumps(result["timing"])}')
+        return result
+
+
+# 进程内唯一的分析器
+profiler = Profiler()
+
+
+def install_signal_trigger(seconds=PROFILE_SECONDS):
+    """SIGUSR1 采样调用栈，SIGUSR2 同时记录 socket 调用耗时；只能在主线程调用，Windows 上没有这两个信号"""
+    if not hasattr(signal, 'SIGUSR1') or threading.current_thread() is not threading.main_thread():
+        return False
+    signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.start(seconds))
+    signal.signal(signal.SIGUSR2, lambda signum, frame: profiler.start(seconds, timing=True))
+    return True
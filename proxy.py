@@ -2,128 +2,301 @@
 # tcp mapping created by Wvfly at 2023-06-20
 
 import sys
+import time
 import socket
 import logging
+import argparse
 import threading
 from logging.handlers import RotatingFileHandler
 
-# 端口映射配置信息
-CFG_REMOTE_IP = sys.argv[1]
-CFG_REMOTE_PORT = int(sys.argv[2])
+import event_engine
+from proxy_common import set_keepalive, CONN_TIMEOUT
+from splice_relay import open_pipes
+from buffer_pool import default_pool
+import access_log
+from access_log import ConnectionRecord, start_async_logging
+import workers
+from workers import run_workers, reuse_port_supported, enable_reuse_port
+from metrics import metrics, start_metrics_server
+from upstream_pool import WarmPool
+from backends import BackendPool, Backend, parse_backend, POLICIES
+import admission
+from admission import Admission, connect_pool, reject
+from shaping import Shaper, parse_rate
+from profiler import install_signal_trigger, PROFILE_SECONDS
+from idle_reaper import IdleReaper, RelayPair, IDLE_TIMEOUT
+from tls_termination import TLSTerminator
+from zstd_tunnel import Tunnel, TUNNEL_MODES, ZSTD_LEVEL, tunnel_supported
+import mux_tunnel
+from mux_tunnel import MUX_MODES, MUX_LINKS
+
+# 端口映射配置信息（由命令行参数填充）
+CFG_REMOTE_IP = None
+CFG_REMOTE_PORT = None
 CFG_LOCAL_IP = '0.0.0.0'
-CFG_LOCAL_PORT = int(sys.argv[3])
+CFG_LOCAL_PORT = None
 
 # 接收数据缓存大小
 PKT_BUFF_SIZE = 2048
 
 logger = logging.getLogger("Proxy Logging")
-formatter = logging.Formatter('%(name)-12s %(asctime)s %(levelname)-8s %(lineno)-4d %(message)s',
-                              '%Y %b %d %a %H:%M:%S', )
 
-stream_handler = logging.StreamHandler(sys.stderr)
-stream_handler.setFormatter(formatter)
-logger.addHandler(stream_handler)
 
-file_handler = RotatingFileHandler(
-    filename="proxy.log",  # 日志文件名
-    maxBytes=100 * 1024 * 1024,  # 单个文件最大 100MB（按需调整）
-    backupCount=5,  # 保留 5 个归档文件
-    encoding="utf-8"  # 可选：指定编码
-)
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
+def setup_logger(console_level=logging.DEBUG):
+    """配置日志记录器；console_level 只影响终端（stderr）输出，proxy.log 照常记录全部"""
+    formatter = logging.Formatter('%(name)-12s %(asctime)s %(levelname)-8s %(lineno)-4d %(message)s',
+                                  '%Y %b %d %a %H:%M:%S', )
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(formatter)
+    stream_handler.setLevel(console_level)
+    logger.addHandler(stream_handler)
+
+    file_handler = RotatingFileHandler(
+        filename="proxy.log",  # 日志文件名
+        maxBytes=100 * 1024 * 1024,  # 单个文件最大 100MB（按需调整）
+        backupCount=5,  # 保留 5 个归档文件
+        encoding="utf-8"  # 可选：指定编码
+    )
+    file_handler.setFormatter(formatter)
+    logger.addHandler(file_handler)
+
+    logger.setLevel(logging.DEBUG)
+
+
+def metrics_port(text):
+    """--metrics-port 的取值：端口号，或 auto 由系统分配空闲端口"""
+    return text if text == 'auto' else int(text)
+
 
-logger.setLevel(logging.DEBUG)
+def parse_args(argv=None):
+    """解析命令行参数：proxy.py 远程IP 远程端口 本地端口 [选项]"""
+    parser = argparse.ArgumentParser(description='TCP 端口映射')
+    parser.add_argument('remote_ip', help='远程IP')
+    parser.add_argument('remote_port', type=int, help='远程端口')
+    parser.add_argument('local_port', type=int, help='本地端口')
+    parser.add_argument('--local-ip', default=CFG_LOCAL_IP, help='本地监听地址，默认 0.0.0.0')
+    parser.add_argument('--engine', choices=('thread', 'event'), default='thread',
+                        help='转发引擎：thread 每连接独立线程（默认），event 单线程事件循环')
+    parser.add_argument('--relay', choices=('copy', 'splice'), default='copy',
+                        help='thread 引擎的转发方式：copy 用户态 recv/sendall（默认），'
+                             'splice Linux 零拷贝，不支持时自动回退为 copy')
+    parser.add_argument('--buffer-size', type=int, default=PKT_BUFF_SIZE, help='接收缓冲区大小（字节）')
+    parser.add_argument('--buffer-pool-size', type=int, default=default_pool.count,
+                        help='缓冲区池最多保留的空闲缓冲区数量')
+    parser.add_argument('--trace-sample', type=float, default=0.0,
+                        help='逐包跟踪日志的连接抽样比例 0~1，默认 0 只输出每连接一条访问日志')
+    parser.add_argument('--metrics-port', type=metrics_port, default=0,
+                        help='Prometheus 指标端口（/metrics），0 表示关闭；多进程模式下第 i 个工作进程使用 端口+i。'
+                             'auto 由系统分配空闲端口，绑定后在标准输出打印一行 "Metrics port: 端口"（供 ui.py 读取）')
+    parser.add_argument('--metrics-host', default='127.0.0.1', help='指标接口监听地址')
+    parser.add_argument('--log-level', choices=('debug', 'info', 'warning', 'error'), default='debug',
+                        help='终端（stderr）日志级别，proxy.log 不受影响；配合 /stats 统计流可调到 warning')
+    parser.add_argument('--warm-pool', type=int, default=0,
+                        help='预先与远端建立并保持的连接数，新客户端直接使用，0 表示关闭')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='工作进程数，大于 1 时各进程通过 SO_REUSEPORT 共享监听端口')
+    parser.add_argument('--backend', action='append', type=parse_backend, default=[],
+                        help='额外的远端 host:port[@权重]，可重复；与位置参数中的远端一起负载均衡')
+    parser.add_argument('--lb', choices=POLICIES, default='round_robin',
+                        help='多远端选择策略：round_robin 轮询（默认）、least_conn 最少连接、'
+                             'weighted 加权轮询、hash 按客户端 IP 一致性哈希')
+    parser.add_argument('--health-interval', type=float, default=5,
+                        help='多远端时 TCP 健康检查间隔（秒），0 表示关闭')
+    parser.add_argument('--backlog', type=int, default=admission.LISTEN_BACKLOG, help='监听队列长度')
+    parser.add_argument('--max-conns', type=int, default=admission.MAX_CONNECTIONS,
+                        help='并发连接上限，0 表示不限制')
+    parser.add_argument('--queue-timeout', type=float, default=admission.QUEUE_TIMEOUT,
+                        help='达到上限后新连接排队等待的最长时间（秒），0 表示立即拒绝（RST）')
+    parser.add_argument('--connect-workers', type=int, default=admission.CONNECT_WORKERS,
+                        help='thread 引擎处理新连接（连接远端）的线程池大小')
+    parser.add_argument('--rate', type=parse_rate, default=0,
+                        help='整个映射每个方向的带宽上限（字节/秒，可带 K/M/G 后缀），0 表示不限速；需要 --engine event')
+    parser.add_argument('--burst', type=parse_rate, default=0, help='映射令牌桶突发量，默认为 1 秒的流量')
+    parser.add_argument('--client-rate', type=parse_rate, default=0,
+                        help='单个客户端 IP 每个方向的带宽上限（字节/秒），0 表示不限速')
+    parser.add_argument('--client-burst', type=parse_rate, default=0, help='客户端令牌桶突发量，默认为 1 秒的流量')
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help='两个方向都没有数据超过该时间（秒）才断开连接，0 表示不断开')
+    parser.add_argument('--profile-seconds', type=float, default=PROFILE_SECONDS,
+                        help='kill -USR1 采样调用栈（-USR2 同时记录 socket 调用耗时）的时长（秒），结果写入 profile-*.folded')
+    parser.add_argument('--tls-cert', help='TLS 终结：监听端使用的证书链（PEM），客户端经 TLS 连接，明文转发给远端；'
+                                           '需要 --engine event')
+    parser.add_argument('--tls-key', help='证书私钥（PEM），私钥与证书在同一文件时可省略')
+    parser.add_argument('--tunnel', choices=TUNNEL_MODES + MUX_MODES,
+                        help='两个 proxy.py 之间的隧道。zstd-client 压缩后发往远端（另一端的 zstd-server），'
+                             'zstd-server 解压后转发给真正的远端，需要 zstandard；'
+                             'mux-client / mux-server 在少量长连接上多路复用全部客户端连接，始终使用事件循环')
+    parser.add_argument('--zstd-level', type=int, default=ZSTD_LEVEL, help='隧道压缩级别 1~22')
+    parser.add_argument('--zstd-dict', help='隧道压缩字典（python zstd_tunnel.py train 生成），两端需一致')
+    parser.add_argument('--mux-links', type=int, default=MUX_LINKS, help='mux-client 与对端保持的长连接数')
+    args = parser.parse_args(argv)
+    if args.tunnel in TUNNEL_MODES and not tunnel_supported():
+        parser.error('--tunnel requires the zstandard package (pip install zstandard)')
+    if args.tunnel in MUX_MODES and (args.tls_cert or args.backend or args.warm_pool or args.rate or args.client_rate):
+        parser.error('--tunnel mux-* cannot be combined with --tls-cert, --backend, --warm-pool or rate limits')
+    if args.tls_key and not args.tls_cert:
+        parser.error('--tls-key requires --tls-cert')
+    # 线程引擎两个方向各一个线程，同一个 SSLSocket 不能被两个线程同时读写
+    if args.tls_cert and args.engine != 'event' and args.tunnel not in MUX_MODES:
+        parser.error('--tls-cert requires --engine event')
+    # 限速靠暂停读取实现：线程引擎只能 sleep，期间一直占着转发缓冲区和线程，事件循环暂停读取则不占资源
+    if (args.rate or args.client_rate) and args.engine != 'event' and args.tunnel not in MUX_MODES:
+        parser.error('--rate/--client-rate require --engine event')
+    return args
 
 
-# 单向流数据传递
-def tcp_mapping_worker(conn_receiver, conn_sender):
+# 单向流数据传递，pipe 不为空（splice）时数据经内核管道零拷贝转发
+# upstream 为 True 表示 客户端 -> 远端 方向，字节数与关闭原因记入 record
+# 读到 EOF 只半关闭对端（另一方向继续转发），出错时两个方向一起结束；socket 由 pair 在两个方向都结束后关闭
+# transform 不为空时（压缩隧道）收到的数据经它转换后再发送
+def tcp_mapping_worker(conn_receiver, conn_sender, record, upstream, pair, pipe=None, transform=None):
+    # 非 splice 模式从共享池借用缓冲区，recv_into 填充后按 memoryview 切片发送
+    buf = None if pipe else default_pool.acquire()
+    view = None if pipe else memoryview(buf)
     while True:
         try:
-            data = conn_receiver.recv(PKT_BUFF_SIZE)
+            if pipe:
+                size = pipe.recv_from(conn_receiver)
+            else:
+                size = conn_receiver.recv_into(buf)
         except Exception:
-            logger.debug('Connection closed.')
+            reason = 'recv_error'
             break
 
-        if not data:
-            logger.info('No more data is received.')
+        if not size:
+            reason = 'client_closed' if upstream else 'upstream_closed'
             break
 
+        payload = None if pipe else view[:size]
+        if transform is not None:
+            try:
+                payload = transform(payload)
+            except Exception as e:
+                logger.error(f'Tunnel data error: {e}')
+                reason = 'tunnel_error'
+                break
+
         try:
-            conn_sender.sendall(data)
+            if pipe:
+                pipe.send_to(conn_sender)
+            elif payload:
+                conn_sender.sendall(payload)
         except Exception:
-            logger.error('Failed sending data.')
+            reason = 'send_error'
             break
 
-        # logger.info('Mapping data > %s ' % repr(data))
-        logger.info(
-            'Mapping > %s -> %s > %d bytes.' % (conn_receiver.getpeername(), conn_sender.getpeername(), len(data)))
+        pair.touch()
+        if upstream:
+            record.bytes_up += size
+        else:
+            record.bytes_down += size
+        # 逐包日志仅对抽样连接输出（--trace-sample）
+        if record.traced:
+            logger.debug('Mapping > %s -> %s > %d bytes.' % (
+                record.client if upstream else record.upstream,
+                record.upstream if upstream else record.client, size))
 
-    conn_receiver.close()
-    conn_sender.close()
+    if pipe:
+        pipe.close()
+    else:
+        view.release()
+        default_pool.release(buf)
+    if pair.expired:
+        reason = 'idle_timeout'
+    elif reason in ('client_closed', 'upstream_closed'):
+        pair.half_close(conn_sender)
+    else:
+        pair.abort()
+    pair.done()
+    record.direction_done(reason)
 
     return
 
 
 # 端口映射请求处理
-def tcp_mapping_request(local_conn, remote_ip, remote_port):
+# backends 不为空时忽略 remote_ip/remote_port，按负载均衡策略选择远端
+def tcp_mapping_request(local_conn, remote_ip, remote_port, record, relay_mode='copy', warm_pool=None,
+                        backends=None, client_ip=None, reaper=None, tunnel=None):
     remote_conn = None
+    if backends:
+        record.backend = backends.select(client_ip)
+        remote_ip, remote_port = record.backend.address
     try:
-        remote_conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # 跨平台KeepAlive设置
-        if sys.platform.startswith('win'):
-            remote_conn.ioctl(socket.SIO_KEEPALIVE_VALS, (1, 30 * 1000, 5 * 1000))
-        else:
-            remote_conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-            remote_conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30)
-            remote_conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 5)
-            remote_conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 2)
+        connect_start = time.monotonic()
+        # 优先使用预连接池中已建立的连接
+        remote_conn = warm_pool.acquire() if warm_pool else None
+        if remote_conn is None:
+            remote_conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # 跨平台KeepAlive设置
+            set_keepalive(remote_conn)
+            remote_conn.settimeout(CONN_TIMEOUT)
+            remote_conn.connect((remote_ip, remote_port))
+        # 建连之后不再使用 socket 超时，空闲连接由 reaper 统一回收
+        remote_conn.settimeout(None)
+        record.connected(remote_conn.getpeername(), time.monotonic() - connect_start)
+
+        # 压缩隧道：客户端一侧先发出前导，不等应答直接开始转发
+        up = down = None
+        if tunnel:
+            up, down = tunnel.codecs()
+            if tunnel.mode == 'zstd-client':
+                remote_conn.sendall(tunnel.preamble())
 
-        remote_conn.settimeout(30.0)
-        remote_conn.connect((remote_ip, remote_port))
+        # splice 不可用或管道创建失败时自动回退为 recv/sendall，按实际使用的方式记录；管道由转发线程关闭
+        up_pipe, down_pipe = open_pipes(relay_mode)
+        record.mode = 'splice' if up_pipe else 'copy'
 
         # 添加双连接状态监控
-        threading.Thread(target=tcp_mapping_worker, args=(local_conn, remote_conn), daemon=True).start()
-        threading.Thread(target=tcp_mapping_worker, args=(remote_conn, local_conn), daemon=True).start()
+        pair = RelayPair(local_conn, remote_conn, reaper)
+        threading.Thread(target=tcp_mapping_worker,
+                         args=(local_conn, remote_conn, record, True, pair, up_pipe, up), daemon=True).start()
+        threading.Thread(target=tcp_mapping_worker,
+                         args=(remote_conn, local_conn, record, False, pair, down_pipe, down), daemon=True).start()
 
     except Exception as e:
         logger.error(f'Connection failed: {str(e)}')
+        if record.backend is not None and record.upstream is None:
+            backends.mark_failed(record.backend, e)
         if remote_conn:
             remote_conn.close()
         local_conn.close()
+        record.finish('connect_failed')
 
 
 # 端口映射函数
-def tcp_mapping(remote_ip, remote_port, local_ip, local_port):
+def tcp_mapping(remote_ip, remote_port, local_ip, local_port, relay_mode='copy', reuse_port=False, warm_pool=None,
+                backends=None, limit=None, backlog=admission.LISTEN_BACKLOG,
+                connect_workers=admission.CONNECT_WORKERS, idle_timeout=IDLE_TIMEOUT, tunnel=None):
     local_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     local_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # 多进程模式下各工作进程共享同一端口
+    if reuse_port:
+        enable_reuse_port(local_server)
     # 设置 Keepalive 参数（Linux 有效）
-    if sys.platform.startswith('win'):
-        local_server.ioctl(socket.SIO_KEEPALIVE_VALS, (1, 30 * 1000, 5 * 1000))
-    else:
-        local_server.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-        local_server.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30)
-        local_server.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 5)
-        local_server.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 2)
+    set_keepalive(local_server)
     local_server.bind((local_ip, local_port))
-    local_server.listen(5)
+    local_server.listen(backlog)
+    # 新连接的建连在有界线程池里执行，过载时排队而不是无限创建线程
+    pool = connect_pool(connect_workers)
+    # 所有连接共用一个时间轮回收空闲连接
+    reaper = IdleReaper(idle_timeout).start()
 
     logger.debug(f'Starting mapping service on {local_ip}:{local_port} ...')
-    logger.debug('Client timeout was set to 30s.')
+    logger.debug(f'Idle timeout was set to {idle_timeout}s.')
 
     try:
         while True:
             local_conn, local_addr = local_server.accept()
-            logger.debug(f'Receive mapping request from {local_addr}.')
+            # 达到并发上限：排队等待空闲名额，超时或不排队时直接拒绝
+            if limit and not limit.admit():
+                reject(local_conn)
+                continue
             try:
-                # 设置客户端 Socket 超时
-                local_conn.settimeout(30.0)
-                # 启动线程处理连接
-                threading.Thread(
-                    target=tcp_mapping_request,
-                    args=(local_conn, remote_ip, remote_port),
-                    daemon=True  # 设置为守护线程，防止主线程退出阻塞
-                ).start()
+                record = ConnectionRecord(local_addr)
+                record.admission = limit
+                pool.submit(tcp_mapping_request, local_conn, remote_ip, remote_port, record, relay_mode, warm_pool,
+                            backends, local_addr[0], reaper, tunnel)
             except Exception as e:
                 logger.error(f"Error handling connection: {e}")
                 local_conn.close()  # 确保异常时关闭连接
@@ -133,9 +306,100 @@ def tcp_mapping(remote_ip, remote_port, local_ip, local_port):
         logger.error(f"Server error: {e}")
     finally:
         local_server.close()
+        pool.shutdown(wait=False)
+        logger.debug(f'Buffer pool stats: {default_pool.stats()}')
         logger.debug('Stop mapping service.')
 
 
+def run_mapping(args, reuse_port=False):
+    """按命令行参数选择转发引擎并运行映射服务"""
+    # 在实际服务的进程内启动异步日志线程（fork 出的工作进程不会继承父进程的线程）
+    start_async_logging()
+    install_signal_trigger(args.profile_seconds)
+    if args.metrics_port == 'auto':
+        # 端口由本进程绑定后再告知启动方，避免启动方先探测空闲端口、再交给代理绑定之间被其它进程占用
+        metrics_server = start_metrics_server(args.metrics_host, 0)
+        print(f'Metrics port: {metrics_server.server_address[1]}', flush=True)
+    elif args.metrics_port:
+        start_metrics_server(args.metrics_host, args.metrics_port + workers.WORKER_INDEX)
+    backends = None
+    if args.backend:
+        backends = BackendPool([Backend(args.remote_ip, args.remote_port)] + args.backend,
+                               args.lb, args.health_interval).start()
+        metrics.collectors.append(backends.render_metrics)
+        if args.warm_pool > 0:
+            logger.warning('--warm-pool only applies to a single remote, disabled.')
+            args.warm_pool = 0
+    limit = None
+    if args.max_conns > 0:
+        limit = Admission(args.max_conns, args.queue_timeout)
+        metrics.collectors.append(limit.render_metrics)
+    shaper = None
+    if args.rate > 0 or args.client_rate > 0:
+        shaper = Shaper(args.rate, args.burst, args.client_rate, args.client_burst)
+        metrics.collectors.append(shaper.render_metrics)
+    tls = None
+    if args.tls_cert:
+        tls = TLSTerminator(args.tls_cert, args.tls_key)
+        metrics.collectors.append(tls.render_metrics)
+    tunnel = None
+    if args.tunnel in TUNNEL_MODES:
+        tunnel = Tunnel(args.tunnel, args.zstd_level, args.zstd_dict)
+        metrics.collectors.append(tunnel.render_metrics)
+        if args.relay == 'splice':
+            logger.warning('--relay splice cannot be combined with --tunnel, using copy.')
+            args.relay = 'copy'
+    warm_pool = None
+    if args.warm_pool > 0:
+        warm_pool = WarmPool((args.remote_ip, args.remote_port), args.warm_pool).start()
+        metrics.collectors.append(warm_pool.render_metrics)
+
+    try:
+        if args.tunnel in MUX_MODES:
+            mux_tunnel.mux_mapping(args.tunnel, args.remote_ip, args.remote_port, args.local_ip, args.local_port,
+                                   reuse_port, limit, args.backlog, args.idle_timeout, args.mux_links)
+        elif args.engine == 'event':
+            if args.relay == 'splice':
+                logger.warning('--relay splice only applies to the thread engine, using copy.')
+            event_engine.tcp_mapping(args.remote_ip, args.remote_port, args.local_ip, args.local_port,
+                                     reuse_port, warm_pool, backends, limit, args.backlog, shaper, args.idle_timeout,
+                                     tls, tunnel)
+        else:
+            tcp_mapping(args.remote_ip, args.remote_port, args.local_ip, args.local_port,
+                        args.relay, reuse_port, warm_pool, backends, limit, args.backlog, args.connect_workers,
+                        args.idle_timeout, tunnel)
+    finally:
+        if limit:
+            logger.debug(f'Admission stats: {limit.stats()}')
+        if shaper:
+            logger.debug(f'Shaping stats: {shaper.stats()}')
+        if tls:
+            logger.debug(f'TLS stats: {tls.stats()}')
+        if tunnel:
+            logger.debug(f'Tunnel stats: {tunnel.stats()}')
+        if backends:
+            logger.debug(f'Backend stats: {backends.stats()}')
+            backends.stop()
+        if warm_pool:
+            logger.debug(f'Warm pool stats: {warm_pool.stats()}')
+            warm_pool.stop()
+
+
 # 主函数
 if __name__ == '__main__':
-    tcp_mapping(CFG_REMOTE_IP, CFG_REMOTE_PORT, CFG_LOCAL_IP, CFG_LOCAL_PORT)
\ No newline at end of file
+    args = parse_args()
+    CFG_REMOTE_IP, CFG_REMOTE_PORT = args.remote_ip, args.remote_port
+    CFG_LOCAL_IP, CFG_LOCAL_PORT = args.local_ip, args.local_port
+    default_pool.configure(args.buffer_pool_size, args.buffer_size)
+    access_log.TRACE_SAMPLE = args.trace_sample
+    setup_logger(getattr(logging, args.log_level.upper()))
+
+    if args.workers > 1 and not reuse_port_supported():
+        logger.error('SO_REUSEPORT is not supported on this platform, running a single process.')
+        args.workers = 1
+
+    if args.workers > 1:
+        logger.debug(f'Starting {args.workers} workers on {CFG_LOCAL_IP}:{CFG_LOCAL_PORT} ...')
+        run_workers(args.workers, run_mapping, (args, True))
+    else:
+        run_mapping(args)
@@ -3,20 +3,68 @@
 # Updated with IPv4/IPv6 dual stack support
 
 import sys
+import time
 import socket
 import logging
+import argparse
 import threading
 from logging.handlers import RotatingFileHandler
 
-# 配置参数
-CFG_REMOTE_IP = sys.argv[1]
-CFG_REMOTE_PORT = int(sys.argv[2])
+import admission
+import access_log
+import happy_eyeballs
+from proxy_common import set_keepalive
+from splice_relay import open_pipes
+from dns_cache import ResolverCache
+from workers import run_workers, reuse_port_supported, enable_reuse_port
+from access_log import ConnectionRecord, start_async_logging
+from admission import Admission, connect_pool, reject
+from profiler import install_signal_trigger
+from idle_reaper import IdleReaper, RelayPair, IDLE_TIMEOUT
+
+
+def parse_args(argv=None):
+    """解析命令行参数：proxy6.py 远程地址 远程端口 本地端口 [copy|splice] [工作进程数] [选项]"""
+    parser = argparse.ArgumentParser(description='TCP 端口映射（IPv4/IPv6 双栈）')
+    parser.add_argument('remote_ip', help='远程地址（IP 或域名）')
+    parser.add_argument('remote_port', type=int, help='远程端口')
+    parser.add_argument('local_port', type=int, help='本地端口')
+    parser.add_argument('relay_mode', nargs='?', choices=('copy', 'splice'), default='copy',
+                        help='转发方式：copy（默认）或 splice（Linux 零拷贝，不支持时自动回退）')
+    parser.add_argument('workers', nargs='?', type=int, default=1,
+                        help='工作进程数，大于 1 时各进程通过 SO_REUSEPORT 共享监听端口')
+    parser.add_argument('--trace-sample', type=float, default=0.0,
+                        help='逐包跟踪日志的连接抽样比例 0~1，默认 0 只输出每连接一条访问日志')
+    parser.add_argument('--backlog', type=int, default=admission.LISTEN_BACKLOG, help='监听队列长度')
+    parser.add_argument('--max-conns', type=int, default=admission.MAX_CONNECTIONS,
+                        help='并发连接上限，0 表示不限制')
+    parser.add_argument('--queue-timeout', type=float, default=admission.QUEUE_TIMEOUT,
+                        help='达到上限后新连接排队等待的最长时间（秒），0 表示立即拒绝（RST）')
+    parser.add_argument('--connect-workers', type=int, default=admission.CONNECT_WORKERS,
+                        help='处理新连接（解析、连接远端）的线程池大小')
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help='两个方向都没有数据超过该时间（秒）才断开连接，0 表示不断开')
+    return parser.parse_args(argv)
+
+
+# 配置参数（由命令行参数填充）
+ARGS = parse_args()
+CFG_REMOTE_IP = ARGS.remote_ip
+CFG_REMOTE_PORT = ARGS.remote_port
 CFG_LOCAL_IP = '::'  # 监听所有IPv6/IPv4地址
-CFG_LOCAL_PORT = int(sys.argv[3])
+CFG_LOCAL_PORT = ARGS.local_port
+CFG_RELAY_MODE = ARGS.relay_mode
+CFG_WORKERS = ARGS.workers
+access_log.TRACE_SAMPLE = ARGS.trace_sample
 
 # 网络参数
 PKT_BUFF_SIZE = 2048
-CONN_TIMEOUT = 30  # 秒
+CONN_TIMEOUT = 30  # 连接远端超时（秒）
+DNS_TTL = 60  # 远端域名解析缓存有效期（秒）
+DNS_NEGATIVE_TTL = 5  # 解析失败的缓存时间（秒）
+
+# 远端域名解析缓存
+resolver = ResolverCache(ttl=DNS_TTL, negative_ttl=DNS_NEGATIVE_TTL)
 
 logger = logging.getLogger("Proxy Logging")
 formatter = logging.Formatter('%(name)-12s %(asctime)s %(levelname)-8s %(lineno)-4d %(message)s','%Y %b %d %a %H:%M:%S', )
@@ -58,40 +106,65 @@ def enable_dual_stack(sock):
     return False
 
 
-# 单向流数据传递，把收到的数据原封不动转发出去
-def tcp_mapping_worker(conn_receiver, conn_sender):
+# 单向流数据传递，把收到的数据原封不动转发出去；pipe 不为空（splice）时走内核零拷贝
+# upstream 为 True 表示 客户端 -> 远端 方向，字节数与关闭原因记入 record，连接结束时输出一条访问日志
+# 读到 EOF 只半关闭对端，另一方向继续转发；socket 由 pair 在两个方向都结束后关闭
+def tcp_mapping_worker(conn_receiver, conn_sender, record, upstream, pair, pipe=None):
     while True:
         try:
-            data = conn_receiver.recv(PKT_BUFF_SIZE)
+            if pipe:
+                size = pipe.recv_from(conn_receiver)
+            else:
+                data = conn_receiver.recv(PKT_BUFF_SIZE)
+                size = len(data)
         except Exception:
-            logger.debug('Connection closed.')
+            reason = 'recv_error'
             break
 
-        if not data:
-            logger.info('No more data is received.')
+        if not size:
+            reason = 'client_closed' if upstream else 'upstream_closed'
             break
 
         try:
-            conn_sender.sendall(data)
+            if pipe:
+                pipe.send_to(conn_sender)
+            else:
+                conn_sender.sendall(data)
         except Exception:
-            logger.error('Failed sending data.')
+            reason = 'send_error'
             break
 
-        # logger.info('Mapping data > %s ' % repr(data))
-        logger.info(
-            'Mapping > %s -> %s > %d bytes.' % (conn_receiver.getpeername(), conn_sender.getpeername(), len(data)))
-
-    conn_receiver.close()
-    conn_sender.close()
+        pair.touch()
+        if upstream:
+            record.bytes_up += size
+        else:
+            record.bytes_down += size
+        # 逐包日志仅对抽样连接输出（--trace-sample）
+        if record.traced:
+            logger.debug('Mapping > %s -> %s > %d bytes.' % (
+                record.client if upstream else record.upstream,
+                record.upstream if upstream else record.client, size))
+
+    if pipe:
+        pipe.close()
+    if pair.expired:
+        reason = 'idle_timeout'
+    elif reason in ('client_closed', 'upstream_closed'):
+        pair.half_close(conn_sender)
+    else:
+        pair.abort()
+    pair.done()
+    # 两个方向都结束后输出访问日志，并归还 record.admission 占用的并发名额
+    record.direction_done(reason)
 
     return
 
-def tcp_mapping_request(local_conn, remote_host, remote_port):
+def tcp_mapping_request(local_conn, remote_host, remote_port, record, reaper=None):
     """处理客户端连接"""
     remote_conn = None
     try:
-        # 动态解析目标地址协议
-        addr_info = socket.getaddrinfo(
+        # 动态解析目标地址协议（带缓存，连接突发时只解析一次）
+        addr_info = resolver.getaddrinfo(
             remote_host, remote_port,
             proto=socket.IPPROTO_TCP,
             type=socket.SOCK_STREAM,
@@ -99,34 +172,36 @@ def tcp_mapping_request(local_conn, remote_host, remote_port):
         )
         if not addr_info:
             logger.error(f"Cannot resolve {remote_host}:{remote_port}")
+            local_conn.close()
+            record.finish('connect_failed')
             return
 
-        # 创建与目标协议匹配的socket
-        family, socktype, proto, _, sockaddr = addr_info[0]
-        remote_conn = socket.socket(family, socktype, proto)
-
-        # 跨平台KeepAlive设置
-        if sys.platform.startswith('win'):
-            remote_conn.ioctl(socket.SIO_KEEPALIVE_VALS, (1, 30 * 1000, 5 * 1000))
-        else:
-            remote_conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-            remote_conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30)
-            remote_conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 5)
-            remote_conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 2)
-
-        remote_conn.settimeout(CONN_TIMEOUT)
-        remote_conn.connect(sockaddr)
+        # 对全部解析结果交替 IPv6/IPv4 错峰建连（Happy Eyeballs），最先连上的胜出
+        connect_start = time.monotonic()
+        remote_conn, sockaddr = happy_eyeballs.connect(addr_info, CONN_TIMEOUT, setup=set_keepalive)
+        # 建连之后不再使用 socket 超时，空闲连接由 reaper 统一回收
+        remote_conn.settimeout(None)
+        record.connected(sockaddr, time.monotonic() - connect_start)
         logger.debug(f"Connected to remote: {format_address(sockaddr)}")
 
+        # splice 不可用或管道创建失败时自动回退为 recv/sendall，按实际使用的方式记录
+        # 管道创建之后到转发线程启动之前不再有可能失败的调用，管道由转发线程关闭
+        client = format_address(local_conn.getpeername())
+        up_pipe, down_pipe = open_pipes(CFG_RELAY_MODE)
+        relay_mode = 'splice' if up_pipe else 'copy'
+        record.mode = relay_mode
+        logger.debug(f"Relay mode for {client}: {relay_mode}")
+
         # 启动双向数据传输
+        pair = RelayPair(local_conn, remote_conn, reaper)
         threading.Thread(
             target=tcp_mapping_worker,
-            args=(local_conn, remote_conn),
+            args=(local_conn, remote_conn, record, True, pair, up_pipe),
             daemon=True
         ).start()
         threading.Thread(
             target=tcp_mapping_worker,
-            args=(remote_conn, local_conn),
+            args=(remote_conn, local_conn, record, False, pair, down_pipe),
             daemon=True
         ).start()
 
@@ -135,12 +210,20 @@ def tcp_mapping_request(local_conn, remote_host, remote_port):
         if remote_conn:
             remote_conn.close()
         local_conn.close()
+        record.finish('connect_failed')
 
 
-def start_proxy_server():
+def start_proxy_server(reuse_port=False):
     """启动双栈代理服务"""
+    # 在实际服务的进程内启动异步日志线程（fork 出的工作进程不会继承父进程的线程），
+    # 访问日志写文件/写终端不占用转发线程
+    start_async_logging()
+    # kill -USR1 / -USR2 按需采样调用栈
+    install_signal_trigger()
     server = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        enable_reuse_port(server)
 
     # 关键双栈配置
     if enable_dual_stack(server):
@@ -157,24 +240,31 @@ def start_proxy_server():
         server.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 5)
         server.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 2)
 
+    # 并发连接上限与有界的建连线程池，过载时排队或快速拒绝，而不是无限创建线程
+    limit = Admission(ARGS.max_conns, ARGS.queue_timeout) if ARGS.max_conns > 0 else None
+    pool = connect_pool(ARGS.connect_workers)
+    reaper = IdleReaper(ARGS.idle_timeout).start()
+
     try:
         server.bind((CFG_LOCAL_IP, CFG_LOCAL_PORT))
-        server.listen(5)
+        server.listen(ARGS.backlog)
         logger.info(f"Listening on [{CFG_LOCAL_IP}]:{CFG_LOCAL_PORT}")
         logger.info(f"Mapping to -> {CFG_REMOTE_IP}:{CFG_REMOTE_PORT}")
 
         while True:
             client_conn, client_addr = server.accept()
-            client_conn.settimeout(CONN_TIMEOUT)
+            if limit and not limit.admit():
+                reject(client_conn)
+                limit.log_rejected()
+                continue
 
             # 日志优化显示客户端地址
             logger.debug(f"New connection: {format_address(client_addr)}")
 
-            threading.Thread(
-                target=tcp_mapping_request,
-                args=(client_conn, CFG_REMOTE_IP, CFG_REMOTE_PORT),
-                daemon=True
-            ).start()
+            # 名额随 record 在连接结束（或连接远端失败）时归还
+            record = ConnectionRecord(client_addr)
+            record.admission = limit
+            pool.submit(tcp_mapping_request, client_conn, CFG_REMOTE_IP, CFG_REMOTE_PORT, record, reaper)
 
     except KeyboardInterrupt:
         logger.info("Server shutdown by user")
@@ -182,13 +272,17 @@ def start_proxy_server():
         logger.error(f"Fatal error: {str(e)}")
     finally:
         server.close()
+        pool.shutdown(wait=False)
         logger.info("Service stopped")
 
 
 # 主函数
 if __name__ == '__main__':
     try:
-        start_proxy_server()
+        if CFG_WORKERS > 1 and reuse_port_supported():
+            run_workers(CFG_WORKERS, start_proxy_server, (True,))
+        else:
+            start_proxy_server()
     except Exception as e:
         logger.critical(f"Startup failed: {str(e)}")
         sys.exit(1)
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# 代理公共参数与工具函数，供 proxy.py 及各转发引擎共用
+
+import sys
+import socket
+import logging
+
+# 接收数据缓存大小
+PKT_BUFF_SIZE = 2048
+# 连接超时/单向空闲超时（秒）
+CONN_TIMEOUT = 30
+
+# 与 proxy.py 使用同一个日志记录器
+logger = logging.getLogger("Proxy Logging")
+
+
+def set_keepalive(sock):
+    """跨平台KeepAlive设置"""
+    if sys.platform.startswith('win'):
+        sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, 30 * 1000, 5 * 1000))
+    else:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 5)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 2)
+
+
+def raise_nofile_limit():
+    """尽量调高进程可打开的文件描述符数量（仅 Linux/Unix 有效）"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    return soft
@@ -3,20 +3,75 @@
 # Updated with IPv4/IPv6 dual stack support
 
 import sys
+import time
 import socket
 import logging
+import argparse
 import threading
 from logging.handlers import RotatingFileHandler
 
-配置参数
-CFG_REMOTE_IP = sys.argv[1]
-CFG_REMOTE_PORT = int(sys.argv[2])
+import workers
+import admission
+import access_log
+import happy_eyeballs
+from proxy_common import set_keepalive
+from splice_relay import open_pipes
+from dns_cache import ResolverCache
+from workers import run_workers, reuse_port_supported, enable_reuse_port
+from access_log import ConnectionRecord, start_async_logging
+from metrics import metrics, start_metrics_server
+from admission import Admission, connect_pool, reject
+from profiler import install_signal_trigger
+from idle_reaper import IdleReaper, RelayPair, IDLE_TIMEOUT
+
+
+def parse_args(argv=None):
+    """解析命令行参数：proxy_dual.py 远程地址 远程端口 本地端口 [copy|splice] [工作进程数] [指标端口] [选项]"""
+    parser = argparse.ArgumentParser(description='TCP 端口映射（IPv4/IPv6 双栈）')
+    parser.add_argument('remote_ip', help='远程地址（IP 或域名）')
+    parser.add_argument('remote_port', type=int, help='远程端口')
+    parser.add_argument('local_port', type=int, help='本地端口')
+    parser.add_argument('relay_mode', nargs='?', choices=('copy', 'splice'), default='copy',
+                        help='转发方式：copy（默认）或 splice（Linux 零拷贝，不支持时自动回退）')
+    parser.add_argument('workers', nargs='?', type=int, default=1,
+                        help='工作进程数，大于 1 时各进程通过 SO_REUSEPORT 共享监听端口')
+    parser.add_argument('metrics_port', nargs='?', type=int, default=0,
+                        help='Prometheus 指标端口（127.0.0.1），0 表示关闭；多进程模式下第 i 个工作进程使用 端口+i')
+    parser.add_argument('--trace-sample', type=float, default=0.0,
+                        help='逐包跟踪日志的连接抽样比例 0~1，默认 0 只输出每连接一条访问日志')
+    parser.add_argument('--backlog', type=int, default=admission.LISTEN_BACKLOG, help='监听队列长度')
+    parser.add_argument('--max-conns', type=int, default=admission.MAX_CONNECTIONS,
+                        help='并发连接上限，0 表示不限制')
+    parser.add_argument('--queue-timeout', type=float, default=admission.QUEUE_TIMEOUT,
+                        help='达到上限后新连接排队等待的最长时间（秒），0 表示立即拒绝（RST）')
+    parser.add_argument('--connect-workers', type=int, default=admission.CONNECT_WORKERS,
+                        help='处理新连接（解析、连接远端）的线程池大小')
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help='两个方向都没有数据超过该时间（秒）才断开连接，0 表示不断开')
+    return parser.parse_args(argv)
+
+
+# 配置参数（由命令行参数填充）
+ARGS = parse_args()
+CFG_REMOTE_IP = ARGS.remote_ip
+CFG_REMOTE_PORT = ARGS.remote_port
 CFG_LOCAL_IP = '::'  # 监听所有IPv6/IPv4地址
-CFG_LOCAL_PORT = int(sys.argv[3])
+CFG_LOCAL_PORT = ARGS.local_port
+CFG_RELAY_MODE = ARGS.relay_mode
+CFG_WORKERS = ARGS.workers
+CFG_METRICS_PORT = ARGS.metrics_port
+access_log.TRACE_SAMPLE = ARGS.trace_sample
 
 # 网络参数
 PKT_BUFF_SIZE = 2048
-CONN_TIMEOUT = 30  # 秒
+CONN_TIMEOUT = 30  # 连接远端超时（秒）
+DNS_TTL = 60  # 远端域名解析缓存有效期（秒）
+DNS_NEGATIVE_TTL = 5  # 解析失败的缓存时间（秒）
+
+# 远端域名解析缓存
+resolver = ResolverCache(ttl=DNS_TTL, negative_ttl=DNS_NEGATIVE_TTL)
+# 所有连接共用的空闲回收器，在 start_proxy_server 中启动
+reaper = IdleReaper(ARGS.idle_timeout)
 
 logger = logging.getLogger("Proxy Logging")
 def setup_logger():
@@ -59,33 +114,59 @@ def enable_dual_stack(sock):
     return False
 
 
-def tcp_mapping_worker(conn_recv, conn_send):
-    """单向数据流处理"""
+def tcp_mapping_worker(conn_recv, conn_send, record, upstream, pair, pipe=None):
+    """单向数据流处理，pipe 不为空（splice）时走内核零拷贝；upstream 为 True 表示 客户端 -> 远端
+
+    读到 EOF 只半关闭对端，另一方向继续转发；socket 由 pair 在两个方向都结束后关闭
+    """
+    reason = 'closed'
     try:
         while True:
-            data = conn_recv.recv(PKT_BUFF_SIZE)
-            if not data:
-                logger.debug("Connection closed gracefully")
+            if pipe:
+                size = pipe.recv_from(conn_recv)
+            else:
+                data = conn_recv.recv(PKT_BUFF_SIZE)
+                size = len(data)
+            if not size:
+                reason = 'client_closed' if upstream else 'upstream_closed'
                 break
 
             try:
-                conn_send.sendall(data)
+                if pipe:
+                    pipe.send_to(conn_send)
+                else:
+                    conn_send.sendall(data)
             except (BrokenPipeError, ConnectionResetError):
                 logger.error("Remote connection broken")
+                reason = 'send_error'
                 break
 
-            # 日志优化：显示友好IP格式
-            src = format_address(conn_recv.getpeername())
-            dst = format_address(conn_send.getpeername())
-            logger.info(f"Transfer {len(data)} bytes: {src} -> {dst}")
+            pair.touch()
+            if upstream:
+                record.bytes_up += size
+            else:
+                record.bytes_down += size
+
+            # 逐包日志仅对抽样连接输出（--trace-sample），其余连接结束时只输出一条访问日志
+            if record.traced:
+                src, dst = (record.client, record.upstream) if upstream else (record.upstream, record.client)
+                logger.debug(f"Transfer {size} bytes: {src} -> {dst}")
 
-    except socket.timeout:
-        logger.warning("Connection timeout")
     except Exception as e:
         logger.error(f"Data transfer error: {str(e)}")
+        reason = 'recv_error'
     finally:
-        conn_recv.close()
-        conn_send.close()
+        if pipe:
+            pipe.close()
+        if pair.expired:
+            logger.warning("Connection idle timeout")
+            reason = 'idle_timeout'
+        if reason in ('client_closed', 'upstream_closed'):
+            pair.half_close(conn_send)
+        else:
+            pair.abort()
+        pair.done()
+        record.direction_done(reason)
 
 
 def format_address(address):
@@ -96,12 +177,12 @@ def format_address(address):
     return f"[{ip}]:{port}" if ':' in ip else f"{ip}:{port}"
 
 
-def tcp_mapping_request(local_conn, remote_host, remote_port):
+def tcp_mapping_request(local_conn, remote_host, remote_port, record):
     """处理客户端连接"""
     remote_conn = None
     try:
-        # 动态解析目标地址协议
-        addr_info = socket.getaddrinfo(
+        # 动态解析目标地址协议（带缓存，连接突发时只解析一次）
+        addr_info = resolver.getaddrinfo(
             remote_host, remote_port,
             proto=socket.IPPROTO_TCP,
             type=socket.SOCK_STREAM,
@@ -109,34 +190,36 @@ def tcp_mapping_request(local_conn, remote_host, remote_port):
         )
         if not addr_info:
             logger.error(f"Cannot resolve {remote_host}:{remote_port}")
+            local_conn.close()
+            record.finish('connect_failed')
             return
 
-        # 创建与目标协议匹配的socket
-        family, socktype, proto, _, sockaddr = addr_info[0]
-        remote_conn = socket.socket(family, socktype, proto)
-
-        # 跨平台KeepAlive设置
-        if sys.platform.startswith('win'):
-            remote_conn.ioctl(socket.SIO_KEEPALIVE_VALS, (1, 30 * 1000, 5 * 1000))
-        else:
-            remote_conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-            remote_conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30)
-            remote_conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 5)
-            remote_conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 2)
-
-        remote_conn.settimeout(CONN_TIMEOUT)
-        remote_conn.connect(sockaddr)
+        # 对全部解析结果交替 IPv6/IPv4 错峰建连（Happy Eyeballs），最先连上的胜出
+        connect_start = time.monotonic()
+        remote_conn, sockaddr = happy_eyeballs.connect(addr_info, CONN_TIMEOUT, setup=set_keepalive)
+        # 建连之后不再使用 socket 超时，空闲连接由 reaper 统一回收
+        remote_conn.settimeout(None)
+        record.connected(sockaddr, time.monotonic() - connect_start)
         logger.debug(f"Connected to remote: {format_address(sockaddr)}")
 
+        # splice 不可用或管道创建失败时自动回退为 recv/sendall，按实际使用的方式记录
+        # 管道创建之后到转发线程启动之前不再有可能失败的调用，管道由转发线程关闭
+        client = format_address(local_conn.getpeername())
+        up_pipe, down_pipe = open_pipes(CFG_RELAY_MODE)
+        relay_mode = 'splice' if up_pipe else 'copy'
+        record.mode = relay_mode
+        logger.debug(f"Relay mode for {client}: {relay_mode}")
+
         # 启动双向数据传输
+        pair = RelayPair(local_conn, remote_conn, reaper)
         threading.Thread(
             target=tcp_mapping_worker,
-            args=(local_conn, remote_conn),
+            args=(local_conn, remote_conn, record, True, pair, up_pipe),
             daemon=True
         ).start()
         threading.Thread(
             target=tcp_mapping_worker,
-            args=(remote_conn, local_conn),
+            args=(remote_conn, local_conn, record, False, pair, down_pipe),
             daemon=True
         ).start()
 
@@ -145,12 +228,29 @@ def tcp_mapping_request(local_conn, remote_host, remote_port):
         if remote_conn:
             remote_conn.close()
         local_conn.close()
+        record.finish('connect_failed')
 
 
-def start_proxy_server():
+def start_proxy_server(reuse_port=False):
     """启动双栈代理服务"""
+    # 在实际服务的进程内启动异步日志线程（fork 出的工作进程不会继承父进程的线程），
+    # 访问日志写文件/写终端不占用转发线程
+    start_async_logging()
+    # kill -USR1 / -USR2 按需采样调用栈
+    install_signal_trigger()
+    # 并发连接上限与有界的建连线程池，过载时排队或快速拒绝，而不是无限创建线程
+    limit = Admission(ARGS.max_conns, ARGS.queue_timeout) if ARGS.max_conns > 0 else None
+    pool = connect_pool(ARGS.connect_workers)
+    reaper.start()
+    if limit:
+        metrics.collectors.append(limit.render_metrics)
+    if CFG_METRICS_PORT:
+        start_metrics_server('127.0.0.1', CFG_METRICS_PORT + workers.WORKER_INDEX)
+
     server = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        enable_reuse_port(server)
 
     # 关键双栈配置
     if enable_dual_stack(server):
@@ -169,22 +269,23 @@ def start_proxy_server():
 
     try:
         server.bind((CFG_LOCAL_IP, CFG_LOCAL_PORT))
-        server.listen(5)
+        server.listen(ARGS.backlog)
         logger.info(f"Listening on [{CFG_LOCAL_IP}]:{CFG_LOCAL_PORT}")
         logger.info(f"Mapping to -> {CFG_REMOTE_IP}:{CFG_REMOTE_PORT}")
 
         while True:
             client_conn, client_addr = server.accept()
-            client_conn.settimeout(CONN_TIMEOUT)
+            if limit and not limit.admit():
+                reject(client_conn)
+                limit.log_rejected()
+                continue
 
             # 日志优化显示客户端地址
             logger.debug(f"New connection: {format_address(client_addr)}")
 
-            threading.Thread(
-                target=tcp_mapping_request,
-                args=(client_conn, CFG_REMOTE_IP, CFG_REMOTE_PORT),
-                daemon=True
-            ).start()
+            record = ConnectionRecord(client_addr)
+            record.admission = limit
+            pool.submit(tcp_mapping_request, client_conn, CFG_REMOTE_IP, CFG_REMOTE_PORT, record)
 
     except KeyboardInterrupt:
         logger.info("Server shutdown by user")
@@ -192,13 +293,17 @@ def start_proxy_server():
         logger.error(f"Fatal error: {str(e)}")
     finally:
         server.close()
+        pool.shutdown(wait=False)
         logger.info("Service stopped")
 
 
 if __name__ == '__main__':
     setup_logger()
     try:
-        start_proxy_server()
+        if CFG_WORKERS > 1 and reuse_port_supported():
+            run_workers(CFG_WORKERS, start_proxy_server, (True,))
+        else:
+            start_proxy_server()
     except Exception as e:
         logger.critical(f"Startup failed: {str(e)}")
         sys.exit(1)
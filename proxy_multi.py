@@ -0,0 +1,501 @@
+# -*- coding: utf-8 -*-
+# 单进程多映射：从 TOML/JSON 配置文件加载全部 TCP/UDP 端口映射，共用一个事件循环、缓冲区池和解析缓存
+
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import selectors
+
+from proxy_common import logger, raise_nofile_limit
+from proxy import setup_logger
+from event_engine import EventLoop, RelayEngine
+from buffer_pool import default_pool
+import access_log
+from access_log import start_async_logging
+from metrics import metrics, start_metrics_server
+from backends import BackendPool, Backend, parse_backend, render_backend_metrics, CHECK_INTERVAL
+from udp_engine import UDPRelay, render_udp_metrics, UDP_TIMEOUT, UDP_MAX_SESSIONS
+from admission import Admission, LISTEN_BACKLOG, QUEUE_TIMEOUT
+from shaping import Shaper, parse_rate, render_shaping_metrics
+from profiler import profiler
+from idle_reaper import IDLE_TIMEOUT
+from tls_termination import TLSTerminator, render_tls_metrics
+from zstd_tunnel import Tunnel, TUNNEL_MODES, ZSTD_LEVEL, tunnel_supported, render_tunnel_metrics
+from mux_tunnel import MuxClient, MuxServer, MUX_MODES, MUX_LINKS, render_mux_metrics
+from handoff import handoff_supported, listen_handoff, send_listeners, take_over, HANDOFF_TIMEOUT
+
+try:
+    import tomllib  # Python 3.11+
+except ImportError:
+    tomllib = None
+
+# 停止监听的映射多久检查一次现有连接是否结束（秒）
+DRAIN_CHECK_INTERVAL = 1
+# 排空的最长时间（秒），超时后强制关闭剩余连接
+DRAIN_TIMEOUT = 60
+
+
+def parse_address(text, default_host='0.0.0.0'):
+    """'host:port'、'[::1]:port' 或单独的端口号"""
+    if isinstance(text, int) or ':' not in str(text):
+        return default_host, int(text)
+    host, port = str(text).rsplit(':', 1)
+    return host.strip('[]'), int(port)
+
+
+def load_config(path):
+    """读取配置文件，.toml 用 tomllib 解析，其余按 JSON 解析"""
+    with open(path, 'rb') as f:
+        if path.endswith('.toml'):
+            if tomllib is None:
+                raise ValueError('TOML config needs Python 3.11+, use a JSON file instead.')
+            config = tomllib.load(f)
+        else:
+            config = json.load(f)
+    mappings = config.get('mapping') or []
+    if not mappings:
+        raise ValueError(f'{path}: no [[mapping]] entries.')
+    for index, mapping in enumerate(mappings):
+        mapping.setdefault('name', f'mapping-{index}')
+        mapping.setdefault('protocol', 'tcp')
+        if mapping['protocol'] not in ('tcp', 'udp'):
+            raise ValueError(f"{mapping['name']}: unknown protocol {mapping['protocol']}")
+        if 'listen' not in mapping or 'remote' not in mapping:
+            raise ValueError(f"{mapping['name']}: 'listen' and 'remote' are required.")
+        for field in ('rate', 'burst', 'client_rate', 'client_burst'):
+            try:
+                parse_rate(mapping.get(field, 0))
+            except ValueError:
+                raise ValueError(f"{mapping['name']}: invalid {field} {mapping[field]!r}") from None
+        if mapping.get('tls_key') and not mapping.get('tls_cert'):
+            raise ValueError(f"{mapping['name']}: 'tls_key' needs 'tls_cert'.")
+        if mapping.get('tls_cert') and mapping['protocol'] != 'tcp':
+            raise ValueError(f"{mapping['name']}: TLS termination only applies to tcp mappings.")
+        if mapping.get('tunnel'):
+            if mapping['tunnel'] not in TUNNEL_MODES + MUX_MODES or mapping['protocol'] != 'tcp':
+                raise ValueError(f"{mapping['name']}: tunnel must be one of "
+                                 f"{', '.join(TUNNEL_MODES + MUX_MODES)} on a tcp mapping.")
+            if mapping['tunnel'] in TUNNEL_MODES and not tunnel_supported():
+                raise ValueError(f"{mapping['name']}: tunnel needs the zstandard package.")
+            if mapping['tunnel'] in MUX_MODES:
+                unsupported = [field for field in ('tls_cert', 'backends', 'rate', 'client_rate') if mapping.get(field)]
+                if unsupported:
+                    raise ValueError(f"{mapping['name']}: mux tunnel does not support {', '.join(unsupported)}.")
+    return config
+
+
+def metrics_key(config):
+    """指标监听 socket 的交接键：取配置中的 (metrics_host, metrics_port)，两个进程读同一份配置，与实际绑定的地址无关"""
+    return ('metrics', config.get('metrics_host', '127.0.0.1'), config['metrics_port'])
+
+
+def mapping_key(mapping):
+    """映射以 (协议, 监听地址, 端口) 标识，重新加载和平滑升级时据此对应"""
+    return (mapping['protocol'],) + parse_address(mapping['listen'])
+
+
+class _Service:
+    """一个运行中的映射：配置、转发器（RelayEngine/UDPRelay）和远端池"""
+    __slots__ = ('mapping', 'runner', 'pool')
+
+    def __init__(self, mapping, runner, pool):
+        self.mapping = mapping
+        self.runner = runner
+        self.pool = pool
+
+
+class MappingServer:
+    """按配置创建全部映射：TCP/UDP 映射都挂在同一个 EventLoop 上，每个映射只占一个监听 socket
+
+    SIGHUP 重新读取配置：新增、删除、修改映射，不影响其它映射的连接；删除的映射停止监听，
+    现有连接排空后关闭。配置了 handoff_socket 时，新进程可用 --takeover 接管全部监听 socket。
+    """
+
+    def __init__(self, config, path=None, listeners=None):
+        self.config = config
+        self.path = path  # 配置文件路径，SIGHUP 时重新读取
+        self.loop = EventLoop()
+        self.services = {}  # mapping_key -> _Service
+        self.retired = []  # (_Service, 截止时间)：已停止监听，等待现有连接结束
+        self.drain_timer = None
+        self.listeners = listeners or {}  # 从旧进程接管、尚未使用的监听 socket
+        self.handoff_server = None
+        self.handed_off = False
+        self.metrics_server = None
+        self.metrics_key = None
+
+    # ---------- 映射增删改 ----------
+    def _build_pool(self, mapping, remote_ip, remote_port):
+        if not mapping.get('backends'):
+            return None
+        return BackendPool([Backend(remote_ip, remote_port)] + [parse_backend(text) for text in mapping['backends']],
+                           mapping.get('lb', 'round_robin'), mapping.get('health_interval', CHECK_INTERVAL),
+                           mapping['name']).start()
+
+    @staticmethod
+    def _pool_args(mapping):
+        """决定 BackendPool 内容的配置项，主远端是池中的第一个 Backend"""
+        return (mapping['remote'], mapping.get('backends'), mapping.get('lb', 'round_robin'),
+                mapping.get('health_interval', CHECK_INTERVAL))
+
+    @staticmethod
+    def _shaping_args(mapping):
+        return [parse_rate(mapping.get(field, 0)) for field in ('rate', 'burst', 'client_rate', 'client_burst')]
+
+    def _build_shaper(self, mapping):
+        rate, burst, client_rate, client_burst = self._shaping_args(mapping)
+        if not rate and not client_rate:
+            return None
+        return Shaper(rate, burst, client_rate, client_burst, mapping['name'])
+
+    @staticmethod
+    def _build_tls(mapping):
+        if not mapping.get('tls_cert'):
+            return None
+        return TLSTerminator(mapping['tls_cert'], mapping.get('tls_key'), mapping['name'])
+
+    @staticmethod
+    def _tunnel_args(mapping):
+        return mapping['tunnel'], mapping.get('zstd_level', ZSTD_LEVEL), mapping.get('zstd_dict')
+
+    @staticmethod
+    def _is_mux(mapping):
+        return mapping.get('tunnel') in MUX_MODES
+
+    def _build_tunnel(self, mapping):
+        if mapping.get('tunnel') not in TUNNEL_MODES:
+            return None
+        return Tunnel(*self._tunnel_args(mapping), mapping['name'])
+
+    def _add(self, key, mapping):
+        local_ip, local_port = parse_address(mapping['listen'])
+        remote_ip, remote_port = parse_address(mapping['remote'])
+        pool = None
+        if mapping['protocol'] == 'udp':
+            runner = UDPRelay(remote_ip, remote_port, local_ip, local_port, loop=self.loop,
+                              timeout=mapping.get('idle_timeout', UDP_TIMEOUT),
+                              max_sessions=mapping.get('max_sessions', UDP_MAX_SESSIONS), name=mapping['name'])
+        else:
+            limit = None
+            if mapping.get('max_conns'):
+                limit = Admission(mapping['max_conns'], mapping.get('queue_timeout', QUEUE_TIMEOUT))
+            if self._is_mux(mapping):
+                if mapping['tunnel'] == 'mux-client':
+                    runner = MuxClient(remote_ip, remote_port, local_ip, local_port, loop=self.loop, limit=limit,
+                                       backlog=mapping.get('backlog', LISTEN_BACKLOG),
+                                       idle_timeout=mapping.get('idle_timeout', IDLE_TIMEOUT), name=mapping['name'],
+                                       links=mapping.get('mux_links', MUX_LINKS))
+                else:
+                    runner = MuxServer(remote_ip, remote_port, local_ip, local_port, loop=self.loop, limit=limit,
+                                       backlog=mapping.get('backlog', LISTEN_BACKLOG),
+                                       idle_timeout=mapping.get('idle_timeout', IDLE_TIMEOUT), name=mapping['name'])
+            else:
+                pool = self._build_pool(mapping, remote_ip, remote_port)
+                runner = RelayEngine(remote_ip, remote_port, local_ip, local_port, backends=pool, loop=self.loop,
+                                     limit=limit, backlog=mapping.get('backlog', LISTEN_BACKLOG),
+                                     shaper=self._build_shaper(mapping),
+                                     idle_timeout=mapping.get('idle_timeout', IDLE_TIMEOUT),
+                                     tls=self._build_tls(mapping), tunnel=self._build_tunnel(mapping))
+        try:
+            runner.start(self.listeners.pop(key, None))
+        except Exception:
+            if pool:
+                pool.stop()
+            raise
+        self.services[key] = _Service(mapping, runner, pool)
+
+    def _update(self, key, mapping):
+        service = self.services[key]
+        if mapping == service.mapping:
+            return False
+        if mapping['protocol'] == 'tcp' and mapping.get('tunnel') != service.mapping.get('tunnel') and \
+                (self._is_mux(mapping) or self._is_mux(service.mapping)):
+            # 换成或换掉 mux 隧道需要换一种转发器：旧的停止监听并排空，新的接着监听同一端口
+            self._retire(key)
+            self._add(key, mapping)
+            return True
+        remote_ip, remote_port = parse_address(mapping['remote'])
+        runner = service.runner
+        if mapping['protocol'] == 'tcp' and mapping.get('tls_cert'):
+            # 证书先加载，失败时整个映射保持原配置；原地换证书，会话缓存与票据密钥不变
+            if runner.tls is None:
+                runner.tls = self._build_tls(mapping)
+            else:
+                runner.tls.configure(mapping['tls_cert'], mapping.get('tls_key'))
+                runner.tls.name = mapping['name']
+        elif mapping['protocol'] == 'tcp' and runner.tls:
+            runner.tls.stop()
+            runner.tls = None
+        # 隧道配置只影响新连接，已建立的连接继续使用各自的压缩上下文
+        if mapping['protocol'] == 'tcp' and not self._is_mux(mapping):
+            if not mapping.get('tunnel'):
+                runner.tunnel = None
+            elif runner.tunnel is None:
+                runner.tunnel = self._build_tunnel(mapping)
+            else:
+                runner.tunnel.configure(*self._tunnel_args(mapping))
+                runner.tunnel.name = mapping['name']
+        if mapping['protocol'] == 'udp':
+            runner.set_remote(remote_ip, remote_port)
+            runner.timeout = mapping.get('idle_timeout', UDP_TIMEOUT)
+            runner.max_sessions = max(1, mapping.get('max_sessions', UDP_MAX_SESSIONS))
+            runner.name = mapping['name']
+        else:
+            # 远端列表与策略不变时沿用原来的池，保留健康检查状态与各远端的连接计数；
+            # 否则换新池，已建立的连接仍持有旧的 Backend 对象，结束时照常归还
+            pool = service.pool
+            if self._pool_args(mapping) != self._pool_args(service.mapping):
+                pool = self._build_pool(mapping, remote_ip, remote_port)
+                if service.pool:
+                    service.pool.stop()
+                service.pool = pool
+            elif pool:
+                pool.name = mapping['name']
+            runner.set_remote(remote_ip, remote_port, pool)
+            runner.reaper.timeout = mapping.get('idle_timeout', IDLE_TIMEOUT)
+            if self._is_mux(mapping):
+                runner.name = mapping['name']
+                if mapping['tunnel'] == 'mux-client':
+                    runner.set_links(mapping.get('mux_links', MUX_LINKS))
+            # 并发上限原地修改，已建立的连接照常归还名额
+            if not mapping.get('max_conns'):
+                runner.limit = None
+            elif runner.limit is None:
+                runner.limit = Admission(mapping['max_conns'], mapping.get('queue_timeout', QUEUE_TIMEOUT))
+            else:
+                runner.limit.max_conns = mapping['max_conns']
+                runner.limit.queue_timeout = mapping.get('queue_timeout', QUEUE_TIMEOUT)
+            # 限速同样原地修改，已建立的连接继续使用同一个 Shaper
+            if runner.shaper is None:
+                runner.shaper = self._build_shaper(mapping)
+            elif any(self._shaping_args(mapping)):
+                runner.shaper.configure(*self._shaping_args(mapping))
+                runner.shaper.name = mapping['name']
+            else:
+                runner.shaper = None
+        service.mapping = mapping
+        return True
+
+    def _retire(self, key):
+        service = self.services.pop(key)
+        service.runner.stop_accepting()
+        self.retired.append((service, time.monotonic() + self.config.get('drain_timeout', DRAIN_TIMEOUT)))
+        if self.drain_timer is None:
+            self.drain_timer = self.loop.call_later(DRAIN_CHECK_INTERVAL, self._check_retired)
+
+    def _check_retired(self):
+        self.drain_timer = None
+        now = time.monotonic()
+        remaining = []
+        for service, deadline in self.retired:
+            runner = service.runner
+            busy = runner.sessions if isinstance(runner, UDPRelay) else runner.connections
+            if busy and now < deadline:
+                remaining.append((service, deadline))
+                continue
+            runner.shutdown()
+            if service.pool:
+                service.pool.stop()
+        self.retired = remaining
+        if remaining:
+            self.drain_timer = self.loop.call_later(DRAIN_CHECK_INTERVAL, self._check_retired)
+        elif self.handed_off and not self.services:
+            logger.debug('All connections drained.')
+            self.loop.stop()
+
+    def start(self):
+        for mapping in self.config['mapping']:
+            self._add(mapping_key(mapping), mapping)
+        # 新配置里已不存在的映射，接管来的监听 socket 直接关闭
+        for sock in self.listeners.values():
+            sock.close()
+        self.listeners = {}
+        metrics.collectors.append(self._render_metrics)
+        logger.debug(f'{len(self.services)} mappings started.')
+
+    def reload(self):
+        """重新读取配置文件并按差异调整映射"""
+        try:
+            config = load_config(self.path)
+        except (OSError, ValueError) as e:
+            logger.error(f'Reload config failed, keeping the current mappings: {e}')
+            return
+        self.config = config
+        access_log.TRACE_SAMPLE = config.get('trace_sample', 0.0)
+        wanted = {mapping_key(mapping): mapping for mapping in config['mapping']}
+        added = updated = removed = 0
+        for key in [key for key in self.services if key not in wanted]:
+            self._retire(key)
+            removed += 1
+        for key, mapping in wanted.items():
+            try:
+                if key in self.services:
+                    updated += self._update(key, mapping)
+                else:
+                    self._add(key, mapping)
+                    added += 1
+            except (OSError, ValueError) as e:
+                logger.error(f"Mapping {mapping['name']} failed: {e}")
+        logger.info(f'Config reloaded: {added} added, {updated} updated, {removed} removed.')
+
+    # ---------- 平滑升级 ----------
+    def _listen_handoff(self):
+        path = self.config.get('handoff_socket')
+        if not path:
+            return
+        if not handoff_supported():
+            logger.warning('Listener handoff is not supported on this platform.')
+            return
+        self.handoff_server = listen_handoff(path)
+        self.handoff_server.setblocking(False)
+        self.loop.set_events(self.handoff_server, selectors.EVENT_READ, self._on_handoff_accept)
+
+    def _on_handoff_accept(self, mask):
+        try:
+            conn, _ = self.handoff_server.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        listeners = {key: service.runner.server for key, service in self.services.items() if service.runner.server}
+        if self.metrics_server:
+            listeners[self.metrics_key] = self.metrics_server.socket
+        try:
+            conn.setblocking(True)
+            send_listeners(conn, listeners)
+        except OSError as e:
+            logger.error(f'Handoff failed: {e}')
+            conn.close()
+            return
+        logger.info(f'Sent {len(listeners)} listening sockets, waiting for the new process ...')
+        # 新进程启动完成前旧进程照常服务；超时未确认视为升级失败
+        timer = self.loop.call_later(HANDOFF_TIMEOUT, lambda: self._on_handoff_done(conn, timer, None))
+        conn.setblocking(False)
+        self.loop.set_events(conn, selectors.EVENT_READ, lambda mask: self._on_handoff_done(conn, timer, mask))
+
+    def _on_handoff_done(self, conn, timer, mask):
+        reply = b''
+        if mask is not None:
+            try:
+                reply = conn.recv(16)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                pass
+        timer.cancel()
+        self.loop.forget(conn)
+        conn.close()
+        if reply != b'ready':
+            logger.error('Handoff aborted, new process did not confirm. Keep serving.')
+            return
+        logger.info('New process took over, draining existing connections.')
+        self.handed_off = True
+        # 旧进程不再接受新的升级请求；socket 文件已属于新进程，不删除
+        self.loop.forget(self.handoff_server)
+        self.handoff_server.close()
+        self.handoff_server = None
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+            self.metrics_server = None
+        for key in list(self.services):
+            self._retire(key)
+
+    # ---------- 运行 ----------
+    def start_metrics(self):
+        """按配置启动指标接口，优先使用从旧进程接管的监听 socket；需在 start() 之前调用"""
+        if not self.config.get('metrics_port'):
+            return
+        self.metrics_key = metrics_key(self.config)
+        _, host, port = self.metrics_key
+        self.metrics_server = start_metrics_server(host, port, self.listeners.pop(self.metrics_key, None))
+
+    def _render_metrics(self):
+        services = list(self.services.values()) + [service for service, _ in self.retired]
+        pools = [service.pool for service in services if service.pool]
+        relays = [service.runner for service in services if isinstance(service.runner, UDPRelay)]
+        shapers = [service.runner.shaper for service in services
+                   if not isinstance(service.runner, UDPRelay) and service.runner.shaper]
+        terminators = [service.runner.tls for service in services
+                       if not isinstance(service.runner, UDPRelay) and service.runner.tls]
+        tunnels = [service.runner.tunnel for service in services
+                   if not isinstance(service.runner, UDPRelay) and service.runner.tunnel]
+        muxes = [service.runner for service in services if isinstance(service.runner, (MuxClient, MuxServer))]
+        return ((render_backend_metrics(pools) if pools else []) + (render_udp_metrics(relays) if relays else [])
+                + (render_shaping_metrics(shapers) if shapers else [])
+                + (render_tls_metrics(terminators) if terminators else [])
+                + (render_tunnel_metrics(tunnels) if tunnels else [])
+                + (render_mux_metrics(muxes) if muxes else []))
+
+    def serve_forever(self, handoff_conn=None):
+        """handoff_conn 为 --takeover 时与旧进程的连接，全部映射启动后通知旧进程开始排空"""
+        try:
+            self.start()
+            if handoff_conn:
+                handoff_conn.sendall(b'ready')
+                handoff_conn.close()
+            self._listen_handoff()
+            if self.path and hasattr(signal, 'SIGHUP'):
+                self.loop.add_signal_handler(signal.SIGHUP, self.reload)
+            self.loop.add_signal_handler(signal.SIGTERM, self.loop.stop)
+            # 按需采样：USR1 调用栈，USR2 同时记录 socket 调用耗时
+            if hasattr(signal, 'SIGUSR1'):
+                self.loop.add_signal_handler(signal.SIGUSR1, profiler.start)
+                self.loop.add_signal_handler(signal.SIGUSR2, lambda: profiler.start(timing=True))
+            self.loop.run()
+        except KeyboardInterrupt:
+            logger.debug("Server shutdown by user.")
+        except Exception as e:
+            logger.error(f"Server error: {e}")
+        finally:
+            for service in list(self.services.values()) + [service for service, _ in self.retired]:
+                service.runner.shutdown()
+                if service.pool:
+                    service.pool.stop()
+            if self.handoff_server:
+                self.handoff_server.close()
+                os.unlink(self.config['handoff_socket'])
+            self.loop.close()
+            logger.debug(f'Buffer pool stats: {default_pool.stats()}')
+            logger.debug('Stop mapping service.')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='从配置文件加载多个 TCP/UDP 端口映射')
+    parser.add_argument('config', help='配置文件（.toml 或 .json）')
+    parser.add_argument('--takeover', action='store_true',
+                        help='平滑升级：通过配置中的 handoff_socket 接管正在运行的旧进程的监听 socket')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    setup_logger()
+    try:
+        config = load_config(args.config)
+    except (OSError, ValueError) as e:
+        logger.error(f'Load config failed: {e}')
+        sys.exit(1)
+
+    handoff_conn, listeners = None, None
+    if args.takeover:
+        if not config.get('handoff_socket') or not handoff_supported():
+            logger.error('--takeover needs handoff_socket in the config and Unix socket fd passing.')
+            sys.exit(1)
+        try:
+            handoff_conn, listeners = take_over(config['handoff_socket'])
+        except OSError as e:
+            logger.error(f'Take over failed: {e}')
+            sys.exit(1)
+
+    default_pool.configure(config.get('buffer_pool_size', default_pool.count),
+                           config.get('buffer_size', default_pool.size))
+    access_log.TRACE_SAMPLE = config.get('trace_sample', 0.0)
+    start_async_logging()
+    limit = raise_nofile_limit()
+    if limit:
+        logger.debug(f'Open file limit: {limit}')
+    server = MappingServer(config, args.config, listeners)
+    server.start_metrics()
+    server.serve_forever(handoff_conn)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# 带宽整形：按映射、按客户端 IP 的令牌桶限速；超额后暂停读取，由 TCP 窗口把压力传回发送方，不忙等
+
+import time
+import threading
+
+# 未指定突发量时允许积攒 1 秒的流量
+DEFAULT_BURST = 1.0
+UNITS = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def parse_rate(text):
+    """'512k' / '10M' / '1048576' -> 字节数，0 表示不限速"""
+    text = str(text).strip().lower().rstrip('b')
+    if text and text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(float(text or 0))
+
+
+class TokenBucket:
+    """rate 字节/秒，最多积攒 burst 字节；允许透支，透支多少决定需要暂停多久"""
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst=0):
+        self.rate = rate
+        self.burst = burst or int(rate * DEFAULT_BURST)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def update(self, rate, burst=0):
+        """原地修改速率与突发量，保留已积攒（或透支）的令牌，突发量变小时截断"""
+        self.rate = rate
+        self.burst = burst or int(rate * DEFAULT_BURST)
+        self.tokens = min(self.tokens, self.burst)
+
+    def consume(self, size, now):
+        """扣除 size 字节，返回需要暂停读取的秒数（0 表示不需要）"""
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= size
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class _Client:
+    """一个客户端 IP 的上下行令牌桶，refs 为该 IP 的活动连接数"""
+    __slots__ = ('buckets', 'refs')
+
+    def __init__(self, rate, burst):
+        self.buckets = (TokenBucket(rate, burst), TokenBucket(rate, burst))
+        self.refs = 0
+
+
+class Flow:
+    """单个连接的整形句柄，连接结束时 release()"""
+    __slots__ = ('shaper', 'ip', 'client')
+
+    def __init__(self, shaper, ip, client):
+        self.shaper = shaper
+        self.ip = ip
+        self.client = client
+
+    def consume(self, size, upstream):
+        """upstream 为 True 表示 客户端 -> 远端；返回需要暂停读取的秒数"""
+        return self.shaper.consume(self, size, upstream)
+
+    def release(self):
+        self.shaper.release(self)
+
+
+class Shaper:
+    """一个映射的带宽整形：上下行各自计算，rate 为整个映射的上限，client_rate 为单个客户端 IP 的上限
+
+    客户端令牌桶在该 IP 的第一个连接建立时创建、最后一个连接结束时删除，内存只与活动客户端数相关。
+    """
+
+    def __init__(self, rate=0, burst=0, client_rate=0, client_burst=0, name=None):
+        self.name = name
+        self.clients = {}  # IP -> _Client
+        self.buckets = None  # 整个映射的上下行令牌桶，未设置 rate 时为 None
+        self.throttled = 0
+        self.throttled_seconds = 0.0
+        self._lock = threading.Lock()
+        self.configure(rate, burst, client_rate, client_burst)
+
+    def configure(self, rate=0, burst=0, client_rate=0, client_burst=0):
+        """修改限速参数（重新加载配置时调用），已有的令牌桶原地更新，重新加载不会送出一次满额突发"""
+        with self._lock:
+            self.rate, self.burst = rate, burst
+            self.client_rate, self.client_burst = client_rate, client_burst
+            if not rate:
+                self.buckets = None
+            elif self.buckets is None:
+                self.buckets = (TokenBucket(rate, burst), TokenBucket(rate, burst))
+            else:
+                for bucket in self.buckets:
+                    bucket.update(rate, burst)
+            for client in self.clients.values():
+                for bucket in client.buckets:
+                    bucket.update(client_rate, client_burst)
+        return self
+
+    @property
+    def enabled(self):
+        return bool(self.rate or self.client_rate)
+
+    def open(self, ip):
+        with self._lock:
+            client = self.clients.get(ip)
+            if client is None:
+                client = self.clients[ip] = _Client(self.client_rate, self.client_burst)
+            client.refs += 1
+        return Flow(self, ip, client)
+
+    def release(self, flow):
+        with self._lock:
+            flow.client.refs -= 1
+            if flow.client.refs <= 0 and self.clients.get(flow.ip) is flow.client:
+                del self.clients[flow.ip]
+
+    def consume(self, flow, size, upstream):
+        direction = 0 if upstream else 1
+        now = time.monotonic()
+        delay = 0
+        with self._lock:
+            if self.buckets:
+                delay = self.buckets[direction].consume(size, now)
+            if self.client_rate:
+                delay = max(delay, flow.client.buckets[direction].consume(size, now))
+            if delay:
+                self.throttled += 1
+                self.throttled_seconds += delay
+        return delay
+
+    def stats(self):
+        return {'rate': self.rate, 'client_rate': self.client_rate, 'clients': len(self.clients),
+                'throttled': self.throttled, 'throttled_seconds': round(self.throttled_seconds, 3)}
+
+    def render_metrics(self):
+        return render_shaping_metrics([self])
+
+
+_SHAPING_METRICS = (
+    ('proxy_shaping_clients', 'gauge', 'Client IPs with active shaping state.',
+     lambda shaper: len(shaper.clients)),
+    ('proxy_shaping_throttled_total', 'counter', 'Reads paused because a token bucket ran out.',
+     lambda shaper: shaper.throttled),
+    ('proxy_shaping_throttled_seconds_total', 'counter', 'Total time reads were paused by shaping.',
+     lambda shaper: round(shaper.throttled_seconds, 3)),
+)
+
+
+def render_shaping_metrics(shapers):
+    """多个 Shaper 的指标，按指标名分组输出"""
+    lines = []
+    for name, kind, help_text, value in _SHAPING_METRICS:
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+        for shaper in shapers:
+            labels = f'{{mapping="{shaper.name}"}}' if shaper.name else ''
+            lines.append(f'{name}{labels} {value(shaper)}')
+    return lines
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# Linux 零拷贝转发：socket -> pipe -> socket（os.splice），数据不经过用户态
+
+import os
+import sys
+import socket
+import select
+
+# 单次 splice 搬运的最大字节数（默认管道容量 64KB）
+SPLICE_CHUNK = 64 * 1024
+
+
+def splice_supported():
+    """当前平台是否支持 os.splice（Linux + Python 3.10 以上）"""
+    return sys.platform.startswith('linux') and hasattr(os, 'splice')
+
+
+def _wait(sock, event, timeout):
+    """等待 socket 可读/可写，超时抛出 socket.timeout，与阻塞 socket 行为一致"""
+    poller = select.poll()
+    poller.register(sock.fileno(), event)
+    if not poller.poll(None if timeout is None else timeout * 1000):
+        raise socket.timeout('timed out')
+
+
+class SplicePipe:
+    """单向转发使用的内核管道"""
+
+    def __init__(self):
+        self.pipe_r, self.pipe_w = os.pipe()
+        self.buffered = 0
+
+    def recv_from(self, sock):
+        """把 sock 中的数据搬进管道，返回字节数，0 表示对端关闭"""
+        while True:
+            try:
+                size = os.splice(sock.fileno(), self.pipe_w, SPLICE_CHUNK,
+                                 flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            except BlockingIOError:
+                _wait(sock, select.POLLIN, sock.gettimeout())
+                continue
+            self.buffered += size
+            return size
+
+    def send_to(self, sock):
+        """把管道中的数据全部写入 sock"""
+        while self.buffered:
+            try:
+                size = os.splice(self.pipe_r, sock.fileno(), self.buffered,
+                                 flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            except BlockingIOError:
+                _wait(sock, select.POLLOUT, sock.gettimeout())
+                continue
+            self.buffered -= size
+
+    def close(self):
+        os.close(self.pipe_r)
+        os.close(self.pipe_w)
+
+
+def open_pipe(relay_mode):
+    """按转发模式创建管道，不支持 splice 或创建失败时返回 None（回退到 recv/sendall）"""
+    if relay_mode != 'splice' or not splice_supported():
+        return None
+    try:
+        return SplicePipe()
+    except OSError:
+        return None
+
+
+def open_pipes(relay_mode):
+    """为一个连接的两个方向各创建一个管道；任一个创建失败时两个方向都回退到 recv/sendall，返回 (None, None)"""
+    up = open_pipe(relay_mode)
+    if up is None:
+        return None, None
+    down = open_pipe(relay_mode)
+    if down is None:
+        up.close()
+        return None, None
+    return up, down
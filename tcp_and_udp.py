@@ -10,6 +10,9 @@ import time
 import socket
 import threading
 
+from buffer_pool import default_pool
+from udp_engine import UDPRelay
+
 def log(strLog):
     strs = time.strftime("%Y-%m-%d %H:%M:%S")
     print(strs  +" -> "+strLog)
@@ -28,15 +31,20 @@ class pipethread(threading.Thread):
         log("New Pipe create:%s->%s" % (self.source.getpeername(),self.sink.getpeername()))
 
     def run(self):
+        # 从共享池借用缓冲区，recv_into 填充，sendall 处理部分写入
+        buf = default_pool.acquire()
+        view = memoryview(buf)
         while True:
             try:
-                data = self.source.recv(1024)
-                if not data: break
-                self.sink.send(data)
+                size = self.source.recv_into(buf)
+                if not size: break
+                self.sink.sendall(view[:size])
             except Exception as ex:
                 log("redirect error:"+str(ex))
                 break
 
+        view.release()
+        default_pool.release(buf)
         self.source.close()
         self.sink.close()
 
@@ -63,92 +71,35 @@ class portmap(threading.Thread):
             except Exception as ex:
                 log("connet newhost error:"+str(ex))
                 break
+            # 两个方向都创建好再启动，否则客户端立即断开时 p1 已关闭 socket，p2 的 getpeername 会让监听线程退出
             p1 = pipethread(newsock, fwd)
-            p1.start()
             p2 = pipethread(fwd, newsock)
+            p1.start()
             p2.start()
 
-class pipethreadUDP(threading.Thread):
-    def __init__(self, connection, connectionTable, table_lock):
-        threading.Thread.__init__(self)
-        self.connection = connection
-        self.connectionTable = connectionTable
-        self.table_lock = table_lock
-        log('new thread for new connction')
-
-    def run(self):
-        while True:
-            try:
-                data,addr = self.connection['socket'].recvfrom(4096)
-                #log('recv from addr"%s' % str(addr))
-            except Exception as ex:
-                log("recvfrom error:"+str(ex))
-                break
-            try:
-                self.connection['lock'].acquire()
-                self.connection['Serversocket'].sendto(data,self.connection['address'])
-                #log('sendto address:%s' % str(self.connection['address']))
-            except Exception as ex:
-                log("sendto error:"+str(ex))
-                break
-            finally:self.connection['lock'].release()
-            self.connection['time'] = time.time()
-        self.connection['socket'].close()
-        log("thread exit for: %s" % str(self.connection['address']))
-        self.table_lock.acquire()
-        self.connectionTable.pop(self.connection['address'])
-        self.table_lock.release()
-        log('Release udp connection for timeout:%s' % str(self.connection['address']))
-
 class portmapUDP(threading.Thread):
+    '''
+    UDP 映射：所有客户端会话由 udp_engine.UDPRelay 在本线程的事件循环里处理，
+    不再为每个客户端创建线程，回包也不再经过全局锁
+    '''
     def __init__(self, port, newhost, newport, local_ip = ''):
         threading.Thread.__init__(self)
         self.newhost = newhost
         self.newport = newport
         self.port = port
         self.local_ip = local_ip
-        self.sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
-        self.sock.bind((self.local_ip,port))
-        self.connetcTable = {}
-        self.port_lock = threading.Lock()
-        self.table_lock = threading.Lock()
         self.timeout = 300
-        #ScanUDP(self.connetcTable,self.table_lock).start()
+        self.relay = UDPRelay(newhost, newport, local_ip, port, timeout=self.timeout)
+        self.relay.start()
         log('udp port redirect run->local_ip:%s,local_port:%d,remote_ip:%s,remote_port:%d' % (local_ip,port,newhost,newport))
 
     def run(self):
-        while True:
-            data,addr = self.sock.recvfrom(4096)
-            connection = None
-            newsock = None
-            self.table_lock.acquire()
-            connection = self.connetcTable.get(addr)
-            newconn = False
-            if connection is None:
-                connection = {}
-                connection['address'] = addr
-                newsock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
-                newsock.settimeout(self.timeout)
-                connection['socket'] = newsock
-                connection['lock'] = self.port_lock
-                connection['Serversocket'] = self.sock
-                connection['time'] = time.time()
-                newconn = True
-
-                log('new connection:%s' % str(addr))
-            self.table_lock.release()
-            try:
-                connection['socket'].sendto(data,(self.newhost,self.newport))
-            except Exception as ex:
-                log("sendto error:"+str(ex))
-                #break
-            if newconn:
-                self.connetcTable[addr] = connection
-                t1=pipethreadUDP(connection,self.connetcTable,self.table_lock)
-                t1.start()
+        try:
+            self.relay.loop.run()
+        finally:
+            self.relay.shutdown()
+            self.relay.loop.close()
         log('main thread exit')
-        for key in self.connetcTable.keys():
-            self.connetcTable[key]['socket'].close()
 
 if __name__=='__main__':
 
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# 分层时间轮：插入、删除 O(1)，每个 tick 只处理到期槽位，不需要全表扫描
+
+import math
+import time
+
+# 每层槽位数与层数：tick=1s 时 64^4 个 tick 约 194 天，超出的按最大范围放置、到期后重新放置
+WHEEL_SLOTS = 64
+WHEEL_LEVELS = 4
+
+
+class TimingWheel:
+    """按 tick 精度管理到期时间；advance() 返回到期的条目，由调用方决定关闭还是重新加入"""
+
+    def __init__(self, tick=1.0, slots=WHEEL_SLOTS, levels=WHEEL_LEVELS):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+        self.current = 0  # 已推进的 tick 数
+        self.origin = time.monotonic()
+        self._where = {}  # 条目 -> (层, 槽)
+
+    def __len__(self):
+        return len(self._where)
+
+    def add(self, item, delay):
+        """delay 秒后到期；条目已存在时改为新的到期时间"""
+        self.remove(item)
+        # 按当前时间换算，而不是按 current，避免 advance 落后时提前到期
+        ticks = math.ceil((time.monotonic() - self.origin + delay) / self.tick)
+        self._place(item, max(ticks, self.current + 1))
+
+    def remove(self, item):
+        where = self._where.pop(item, None)
+        if where is not None:
+            level, slot = where
+            del self.wheels[level][slot][item]
+
+    def _place(self, item, expire):
+        delta = expire - self.current
+        for level in range(self.levels):
+            span = self.slots ** (level + 1)
+            if delta < span or level == self.levels - 1:
+                if delta >= span:
+                    expire_slot = self.current + span - 1
+                else:
+                    expire_slot = expire
+                slot = (expire_slot // self.slots ** level) % self.slots
+                self.wheels[level][slot][item] = expire
+                self._where[item] = (level, slot)
+                return
+
+    def advance(self, now=None):
+        """推进到当前时间，返回到期条目列表"""
+        target = int(((now or time.monotonic()) - self.origin) / self.tick)
+        expired = []
+        while self.current < target and self._where:
+            self.current += 1
+            # 高层槽位先下放，再处理第 0 层到期槽位
+            for level in range(self.levels - 1, 0, -1):
+                unit = self.slots ** level
+                if self.current % unit == 0:
+                    slot = (self.current // unit) % self.slots
+                    bucket, self.wheels[level][slot] = self.wheels[level][slot], {}
+                    for item, expire in bucket.items():
+                        self._place(item, expire)
+            slot = self.current % self.slots
+            bucket, self.wheels[0][slot] = self.wheels[0][slot], {}
+            for item, expire in bucket.items():
+                if expire > self.current:
+                    self._place(item, expire)
+                else:
+                    del self._where[item]
+                    expired.append(item)
+        # 空轮时直接跳到目标位置
+        if self.current < target:
+            self.current = target
+        return expired
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# TLS 终结：监听端用映射自己的证书/私钥完成握手，解密后以明文转发给远端（事件循环引擎）。
+# 服务端会话缓存（TLS 1.2 会话 ID）与会话票据让回访的客户端走简短握手；
+# 握手在独立线程池里阻塞执行，新 TLS 客户端突发时不占用事件循环，已建立的转发不受影响。
+
+import ssl
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from proxy_common import logger
+from metrics import Histogram
+
+# 握手超时（秒），超时的客户端直接断开
+HANDSHAKE_TIMEOUT = 10
+# 握手线程池大小
+HANDSHAKE_WORKERS = 8
+# TLS 1.3 每次完整握手后发给客户端的会话票据数量
+SESSION_TICKETS = 2
+# 握手耗时分桶（秒）
+HANDSHAKE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 10)
+
+
+class TLSTerminator:
+    """一个映射的 TLS 监听：SSLContext 与握手统计
+
+    会话缓存和票据密钥都属于 SSLContext，更换证书时原地重新加载证书链，已发出的票据继续有效；
+    票据密钥只在进程内有效，多进程（--workers）或重启后回访的客户端会重新完整握手。
+    """
+
+    def __init__(self, certfile, keyfile=None, name='', workers=HANDSHAKE_WORKERS):
+        self.name = name
+        self.certfile = self.keyfile = None
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.context.minimum_version = ssl.TLSVersion.TLSv1_2
+        # 服务端会话缓存默认开启；这里确保没有关闭会话票据
+        self.context.options &= ~ssl.OP_NO_TICKET
+        self.context.num_tickets = SESSION_TICKETS
+        self.configure(certfile, keyfile)
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix='tls-handshake')
+        self.handshakes = 0  # 成功的握手，含会话复用
+        self.resumed = 0
+        self.failed = 0
+        self.latency = Histogram(HANDSHAKE_BUCKETS)
+        self._lock = threading.Lock()
+
+    def configure(self, certfile, keyfile=None):
+        """加载（或重新加载）证书链，失败时抛出 OSError（ssl.SSLError），原有证书不变"""
+        self.context.load_cert_chain(certfile, keyfile)
+        self.certfile, self.keyfile = certfile, keyfile
+
+    def handshake(self, sock):
+        """阻塞完成服务端握手，返回 SSLSocket；失败时关闭连接返回 None"""
+        start = time.monotonic()
+        try:
+            sock.settimeout(HANDSHAKE_TIMEOUT)
+            tls_sock = self.context.wrap_socket(sock, server_side=True)
+        except (OSError, ValueError) as e:
+            with self._lock:
+                self.failed += 1
+            logger.warning(f'TLS handshake failed: {e}')
+            sock.close()
+            return None
+        elapsed = time.monotonic() - start
+        with self._lock:
+            self.handshakes += 1
+            if tls_sock.session_reused:
+                self.resumed += 1
+            self.latency.observe(elapsed)
+        return tls_sock
+
+    def submit(self, sock, callback):
+        """在握手线程池中握手，结束后在握手线程中调用 callback(SSLSocket 或 None)"""
+        self.pool.submit(lambda: callback(self.handshake(sock)))
+
+    def stop(self):
+        self.pool.shutdown(wait=False)
+
+    def stats(self):
+        return {'handshakes': self.handshakes, 'resumed': self.resumed, 'failed': self.failed,
+                'resumption_rate': round(self.resumed / self.handshakes, 3) if self.handshakes else None,
+                'session_cache': self.context.session_stats()['number']}
+
+    def render_metrics(self):
+        return render_tls_metrics([self])
+
+
+_TLS_METRICS = (
+    ('proxy_tls_handshakes_total', 'counter', 'Completed TLS handshakes, including resumed sessions.',
+     lambda tls: tls.handshakes),
+    ('proxy_tls_resumed_total', 'counter', 'TLS handshakes that resumed a cached session or ticket.',
+     lambda tls: tls.resumed),
+    ('proxy_tls_handshake_failures_total', 'counter', 'TLS handshakes that failed or timed out.',
+     lambda tls: tls.failed),
+    ('proxy_tls_session_cache_entries', 'gauge', 'Sessions in the server-side session cache.',
+     lambda tls: tls.context.session_stats()['number']),
+)
+
+
+def render_tls_metrics(terminators):
+    """多个 TLSTerminator 的指标，按指标名分组输出；握手耗时为带 mapping 标签的直方图"""
+    lines = []
+    for name, kind, help_text, value in _TLS_METRICS:
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+        for tls in terminators:
+            labels = f'{{mapping="{tls.name}"}}' if tls.name else ''
+            lines.append(f'{name}{labels} {value(tls)}')
+    name = 'proxy_tls_handshake_seconds'
+    lines += [f'# HELP {name} TLS handshake latency.', f'# TYPE {name} histogram']
+    for tls in terminators:
+        label = f'mapping="{tls.name}",' if tls.name else ''
+        cumulative = 0
+        for bound, count in zip(HANDSHAKE_BUCKETS, tls.latency.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{label}le="{bound}"}} {cumulative}')
+        cumulative += tls.latency.counts[-1]
+        lines.append(f'{name}_bucket{{{label}le="+Inf"}} {cumulative}')
+        labels = f'{{{label[:-1]}}}' if label else ''
+        lines.append(f'{name}_sum{labels} {tls.latency.sum}')
+        lines.append(f'{name}_count{labels} {cumulative}')
+    return lines
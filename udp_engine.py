@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+# UDP 事件循环转发：一个监听 socket + 每个客户端一个已连接的远端 socket，全部挂在同一个 EventLoop 上
+
+import sys
+import time
+import errno
+import socket
+import struct
+import selectors
+from collections import OrderedDict
+
+from proxy_common import logger
+from event_engine import EventLoop, MAX_DATAGRAM
+from dns_cache import resolver
+from timing_wheel import TimingWheel
+
+# 客户端会话空闲超时（秒）
+UDP_TIMEOUT = 300
+# 会话表上限，超出时淘汰最久未活动的会话
+UDP_MAX_SESSIONS = 10000
+# 超时检查精度（秒）
+WHEEL_TICK = 1.0
+# 每次可读事件最多连续收取的数据报数
+UDP_BATCH = 64
+# UDP GSO：同一目的地、大小相同的连续数据报合并为一次 sendmsg，由内核（或网卡）切分
+# Python 未导出 UDP_SEGMENT 常量，Linux 上取值 103
+UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)
+GSO_MAX_SEGMENTS = 64
+GSO_MAX_BYTES = 65000
+GSO_ENABLED = True
+
+
+def gso_supported():
+    if not GSO_ENABLED or not sys.platform.startswith('linux'):
+        return False
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_UDP, UDP_SEGMENT, 1400)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+class _Session:
+    """一个客户端地址对应的转发会话"""
+    __slots__ = ('addr', 'sock', 'last_active')
+
+    def __init__(self, addr, sock):
+        self.addr = addr
+        self.sock = sock
+        self.last_active = time.monotonic()
+
+
+class UDPRelay:
+    """单线程 UDP 端口映射：不再为每个客户端启动线程，回包直接 sendto，无需全局发送锁"""
+
+    def __init__(self, remote_ip, remote_port, local_ip, local_port, loop=None, timeout=UDP_TIMEOUT,
+                 max_sessions=UDP_MAX_SESSIONS, name=None):
+        self.remote_ip = remote_ip
+        self.remote_port = remote_port
+        self.local_ip = local_ip
+        self.local_port = local_port
+        self.loop = loop or EventLoop()
+        self.timeout = timeout
+        self.max_sessions = max(1, max_sessions)
+        self.name = name  # 多映射模式下作为指标的 mapping 标签
+        # 客户端地址 -> _Session，按最近活动排序，队首最久未活动
+        self.sessions = OrderedDict()
+        # 每个数据包只更新 last_active；到期时再核对，仍活跃则按剩余时间重新放入
+        self.wheel = TimingWheel(WHEEL_TICK)
+        self.tick_timer = None
+        self.created = 0
+        self.evicted = 0
+        self.expired = 0
+        self.gso = gso_supported()
+        self.gso_sends = 0
+        self.server = None
+        self.remote_addr = None
+        self.read_view = None
+
+    def start(self, server=None):
+        """server 为从旧进程接管的监听 socket"""
+        self.set_remote(self.remote_ip, self.remote_port)
+        self.read_view = self.loop.datagram_view()
+        if server is None:
+            server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            server.bind((self.local_ip, self.local_port))
+        self.server = server
+        server.setblocking(False)
+        self.loop.set_events(server, selectors.EVENT_READ, self._on_client_readable)
+        self.tick_timer = self.loop.call_later(WHEEL_TICK, self._on_tick)
+        logger.debug(f'Starting UDP mapping on {self.local_ip}:{self.local_port} -> '
+                     f'{self.remote_ip}:{self.remote_port} ...')
+
+    def set_remote(self, remote_ip, remote_port):
+        """更换远端，只影响之后新建的会话"""
+        self.remote_addr = resolver.getaddrinfo(remote_ip, remote_port, socket.AF_INET, socket.SOCK_DGRAM)[0][4]
+        self.remote_ip, self.remote_port = remote_ip, remote_port
+
+    def stop_accepting(self):
+        """不再接收新的客户端数据报；监听 socket 保留用于把现有会话的回包发回客户端"""
+        if self.server:
+            self.loop.forget(self.server)
+
+    def shutdown(self):
+        if self.tick_timer:
+            self.tick_timer.cancel()
+        for session in list(self.sessions.values()):
+            self._close_session(session)
+        if self.server:
+            self.loop.forget(self.server)
+            self.server.close()
+            self.server = None
+
+    # ---------- 批量收发 ----------
+    def _recv_batch(self, sock, with_addr):
+        """一次唤醒尽量收完：数据报依次写入共享缓冲区，返回 [(偏移, 长度, 来源地址)]"""
+        view = self.read_view
+        limit = len(view) - MAX_DATAGRAM
+        batch = []
+        offset = 0
+        while len(batch) < UDP_BATCH and offset <= limit:
+            try:
+                if with_addr:
+                    size, addr = sock.recvfrom_into(view[offset:])
+                else:
+                    size, addr = sock.recv_into(view[offset:]), None
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                # Linux 上此前发送失败（如 ICMP 不可达）会在这里报告，忽略即可
+                logger.debug(f'UDP recv error: {e}')
+                break
+            batch.append((offset, size, addr))
+            offset += size
+        return batch
+
+    def _send_run(self, sock, items, addr):
+        """把发往同一目的地的一组数据报发出：连续且等长的部分用 GSO 合并，其余逐个发送"""
+        view = self.read_view
+        index = 0
+        while index < len(items):
+            start, seg, _ = items[index]
+            end = start + seg
+            count = 1
+            # 除最后一段外每段必须等长；最后一段可以更短，之后必须结束
+            if self.gso and seg:
+                while (index + count < len(items) and count < GSO_MAX_SEGMENTS
+                       and items[index + count][0] == end and 0 < items[index + count][1] <= seg
+                       and end - start + items[index + count][1] <= GSO_MAX_BYTES):
+                    end += items[index + count][1]
+                    count += 1
+                    if items[index + count - 1][1] < seg:
+                        break
+            if count > 1 and self._send_gso(sock, view[start:end], seg, addr):
+                self.gso_sends += 1
+            else:
+                for offset, size, _ in items[index:index + count]:
+                    self._send_one(sock, view[offset:offset + size], addr)
+            index += count
+
+    def _send_gso(self, sock, data, seg, addr):
+        ancillary = [(socket.SOL_UDP, UDP_SEGMENT, struct.pack('=H', seg))]
+        try:
+            if addr is None:
+                sock.sendmsg([data], ancillary)
+            else:
+                sock.sendmsg([data], ancillary, 0, addr)
+            return True
+        except (BlockingIOError, InterruptedError):
+            return True  # 发送缓冲区满，按 UDP 语义丢弃
+        except OSError as e:
+            # 内核或网卡不支持时关闭 GSO；其它错误（如超过 MTU）本组改为逐个发送
+            if e.errno in (errno.EIO, errno.ENOPROTOOPT, errno.EOPNOTSUPP):
+                logger.warning(f'UDP GSO disabled: {e}')
+                self.gso = False
+            return False
+
+    def _send_one(self, sock, data, addr):
+        try:
+            if addr is None:
+                sock.send(data)
+            else:
+                sock.sendto(data, addr)
+        except (BlockingIOError, InterruptedError):
+            pass  # 发送缓冲区满，按 UDP 语义丢弃
+        except OSError as e:
+            logger.debug(f'UDP send to {addr or self.remote_addr} failed: {e}')
+
+    # ---------- 客户端 -> 远端 ----------
+    def _on_client_readable(self, mask):
+        now = time.monotonic()
+        run, run_addr, session = [], None, None
+        # 相邻的同一客户端数据报合成一组发送
+        for item in self._recv_batch(self.server, True):
+            addr = item[2]
+            if addr != run_addr:
+                if run:
+                    self._send_run(session.sock, run, None)
+                run, run_addr = [], addr
+                session = self.sessions.get(addr)
+                if session is None:
+                    session = self._open_session(addr)
+                else:
+                    self.sessions.move_to_end(addr)
+                if session is not None:
+                    session.last_active = now
+            if session is not None:
+                run.append(item)
+        if run:
+            self._send_run(session.sock, run, None)
+
+    def _open_session(self, addr):
+        # 会话表已满时淘汰最久未活动的会话，防止伪造源地址的突发流量耗尽文件描述符
+        while len(self.sessions) >= self.max_sessions:
+            oldest = next(iter(self.sessions.values()))
+            self.evicted += 1
+            logger.debug(f'Evict UDP session: {oldest.addr}')
+            self._close_session(oldest)
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        except OSError as e:
+            logger.error(f'UDP session for {addr} failed: {e}')
+            return None
+        # connect 后内核只投递来自远端的数据报，recv 不必再核对来源地址；
+        # connect 失败（ENETUNREACH 等）只放弃这个会话，不能从事件循环回调里抛出影响其它会话
+        try:
+            sock.setblocking(False)
+            sock.connect(self.remote_addr)
+        except OSError as e:
+            sock.close()
+            logger.error(f'UDP session for {addr} failed: {e}')
+            return None
+        session = self.sessions[addr] = _Session(addr, sock)
+        self.loop.set_events(sock, selectors.EVENT_READ, lambda mask: self._on_remote_readable(session))
+        self.wheel.add(session, self.timeout)
+        self.created += 1
+        logger.debug(f'New UDP session: {addr}')
+        return session
+
+    # ---------- 远端 -> 客户端 ----------
+    def _on_remote_readable(self, session):
+        batch = self._recv_batch(session.sock, False)
+        if not batch:
+            return
+        session.last_active = time.monotonic()
+        self.sessions.move_to_end(session.addr)
+        self._send_run(self.server, batch, session.addr)
+
+    # ---------- 会话超时 ----------
+    def _on_tick(self):
+        now = time.monotonic()
+        for session in self.wheel.advance(now):
+            idle = now - session.last_active
+            if idle >= self.timeout:
+                self.expired += 1
+                logger.debug(f'Release UDP session for timeout: {session.addr}')
+                self._close_session(session)
+            else:
+                self.wheel.add(session, self.timeout - idle)
+        self.tick_timer = self.loop.call_later(WHEEL_TICK, self._on_tick)
+
+    def _close_session(self, session):
+        self.wheel.remove(session)
+        self.loop.forget(session.sock)
+        session.sock.close()
+        self.sessions.pop(session.addr, None)
+
+    def serve_forever(self):
+        self.start()
+        try:
+            self.loop.run()
+        except KeyboardInterrupt:
+            logger.debug("Server shutdown by user.")
+        finally:
+            self.shutdown()
+            self.loop.close()
+
+    def stats(self):
+        return {'sessions': len(self.sessions), 'max_sessions': self.max_sessions, 'created': self.created,
+                'evicted': self.evicted, 'expired': self.expired, 'gso': self.gso, 'gso_sends': self.gso_sends}
+
+
+_UDP_METRICS = (
+    ('proxy_udp_sessions', 'gauge', 'UDP sessions currently in the table.', lambda r: len(r.sessions)),
+    ('proxy_udp_sessions_max', 'gauge', 'UDP session table capacity.', lambda r: r.max_sessions),
+    ('proxy_udp_sessions_created_total', 'counter', 'UDP sessions created.', lambda r: r.created),
+    ('proxy_udp_sessions_evicted_total', 'counter', 'UDP sessions evicted because the table was full.',
+     lambda r: r.evicted),
+    ('proxy_udp_sessions_expired_total', 'counter', 'UDP sessions closed after the idle timeout.',
+     lambda r: r.expired),
+)
+
+
+def render_udp_metrics(relays):
+    """多个 UDPRelay 的会话表指标，按指标名分组输出"""
+    lines = []
+    for name, kind, help_text, value in _UDP_METRICS:
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+        for relay in relays:
+            labels = f'{{mapping="{relay.name}"}}' if relay.name else ''
+            lines.append(f'{name}{labels} {value(relay)}')
+    return lines
+
+
+def udp_mapping(remote_ip, remote_port, local_ip, local_port, timeout=UDP_TIMEOUT, max_sessions=UDP_MAX_SESSIONS):
+    """单个 UDP 映射独占一个事件循环运行"""
+    UDPRelay(remote_ip, remote_port, local_ip, local_port, timeout=timeout,
+             max_sessions=max_sessions).serve_forever()
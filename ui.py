@@ -1,8 +1,34 @@
 import tkinter as tk
 from tkinter import ttk, messagebox
-import subprocess,psutil,threading,os,pystray
+import subprocess,psutil,threading,os,pystray,time,json
+import urllib.request
+from collections import deque
 from PIL import Image
 
+# 日志框最多保留的行数，超出时删除最早的行
+LOG_MAX_LINES = 2000
+# 读取线程与界面之间的环形缓冲区大小，界面来不及显示时丢弃最早的行
+LOG_BUFFER_LINES = 5000
+# 界面批量刷新日志的间隔（毫秒）
+LOG_FLUSH_MS = 200
+# 每秒行数超过该值时不再逐行显示，只显示行速率
+LOG_RATE_THRESHOLD = 200
+# 代理的统计流（/stats）推送间隔（秒）；有统计流后代理终端日志只输出 warning 以上
+STATS_INTERVAL = 1
+PROXY_LOG_LEVEL = "warning"
+# 吞吐曲线保留的点数（每个点一个推送间隔）
+GRAPH_POINTS = 120
+# 代理以 --metrics-port auto 启动，绑定统计接口后在输出中打印该行，后接实际端口
+METRICS_PORT_LINE = "Metrics port: "
+
+
+def format_rate(bps):
+    for unit in ("B", "KB", "MB"):
+        if bps < 1024:
+            return f"{bps:.0f} {unit}/s"
+        bps /= 1024
+    return f"{bps:.1f} GB/s"
+
 def kill_proc_tree(pid):
     try:
         parent = psutil.Process(pid)
@@ -17,9 +43,21 @@ class ProxyController:
         self.root = tk.Tk()
         self.proxy_running = False  # 初始代理状态
         self.proxy_process = None
+        # 读取线程只往缓冲区追加，由 Tk 主循环定时取出显示（Tk 控件不能在其它线程操作）
+        self.log_buffer = deque(maxlen=LOG_BUFFER_LINES)
+        self.log_dropped = 0  # 缓冲区满被丢弃的行数
+        self.log_skipped = 0  # 速率过高未逐行显示的行数
+        self.line_count = 0  # 一秒内收到的行数，用于计算行速率
+        self.high_rate = False
+        # 统计流：读取线程追加快照，主循环取出更新计数与曲线
+        self.stats_buffer = deque(maxlen=GRAPH_POINTS)
+        self.history = deque(maxlen=GRAPH_POINTS)  # (上行, 下行) 字节/秒
+        self.rate_time = time.monotonic()
         # self.root.protocol("WM_DELETE_WINDOW", self.on_window_close)
         self.setup_ui()
         self.stop_event = threading.Event()
+        self.root.after(LOG_FLUSH_MS, self.flush_log)
+        self.root.after(LOG_FLUSH_MS, self.flush_stats)
 
         self.tray_icon = None  # 托盘图标对象
         self.tray_icon_active = False  # 托盘图标是否已激活
@@ -31,7 +69,7 @@ class ProxyController:
 
     def setup_ui(self):
         self.root.title("TCP端口映射工具(Power by wuweigang)")
-        self.root.geometry("600x400")
+        self.root.geometry("600x520")
 
         # 输入框框架
         input_frame = ttk.Frame(self.root, padding="10 10 10 10")
@@ -63,6 +101,18 @@ class ProxyController:
         )
         self.btn.pack(padx=20, pady=20)
 
+        # 实时统计：计数与吞吐曲线（上行蓝色、下行绿色）
+        stats_frame = ttk.Frame(self.root)
+        stats_frame.pack(fill=tk.X, padx=10)
+        self.stats_label = ttk.Label(stats_frame, text="统计: 未连接")
+        self.stats_label.pack(anchor=tk.W)
+        self.graph = tk.Canvas(stats_frame, height=100, background="white")
+        self.graph.pack(fill=tk.X, pady=5)
+
+        # 日志行速率
+        self.rate_label = ttk.Label(self.root, text="")
+        self.rate_label.pack(anchor=tk.W, padx=10)
+
         # 日志框
         log_frame = ttk.Frame(self.root)
         log_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
@@ -97,15 +147,104 @@ class ProxyController:
     def read_output(self):
         """读取子进程输出流的线程函数"""
         while not self.stop_event.is_set():
-            if self.proxy_process is None:
+            process = self.proxy_process
+            if process is None:
                 break  # 提前退出循环
-            output = self.proxy_process.stdout.readline()
-            # 原逻辑处理输出
-            # if output == '' and self.proxy_process.poll() is not None:
-            #     break
-            if output:
-                self.log.insert(tk.END, output)
-                self.log.see(tk.END)
+            output = process.stdout.readline()
+            if output == '':
+                break  # 进程已退出，避免空转
+            if output.startswith(METRICS_PORT_LINE):
+                # 代理已绑定统计接口，开始读取统计流
+                port = int(output[len(METRICS_PORT_LINE):])
+                threading.Thread(target=self.read_stats, args=(process, port), daemon=True).start()
+                continue
+            if len(self.log_buffer) == LOG_BUFFER_LINES:
+                self.log_dropped += 1
+            self.log_buffer.append(output)
+
+    def read_stats(self, process, port):
+        """读取代理 /stats 统计流的线程函数，断开后每 0.5 秒重试，直到代理退出"""
+        url = f"http://127.0.0.1:{port}/stats?interval={STATS_INTERVAL}"
+        while self.proxy_process is process and process.poll() is None:
+            try:
+                with urllib.request.urlopen(url, timeout=STATS_INTERVAL * 5) as response:
+                    for line in response:
+                        if self.proxy_process is not process:
+                            return
+                        self.stats_buffer.append(json.loads(line))
+            except (OSError, ValueError):
+                time.sleep(0.5)
+
+    def flush_stats(self):
+        """Tk 定时器：用最新的快照更新计数，并把期间的吞吐加入曲线"""
+        latest = None
+        buffer = self.stats_buffer
+        while buffer:
+            latest = buffer.popleft()
+            self.history.append((latest["up_bps"], latest["down_bps"]))
+        if latest:
+            connect = f"{latest['connect_ms']:.1f} ms" if latest["connect_ms"] is not None else "-"
+            self.stats_label.config(
+                text=f"连接 {latest['active']}  已接受 {latest['accepted']}  失败 {latest['failed']}"
+                     f"（+{latest['errors']}）  上行 {format_rate(latest['up_bps'])}  "
+                     f"下行 {format_rate(latest['down_bps'])}  建连 {connect}")
+            self.draw_graph()
+        self.root.after(LOG_FLUSH_MS, self.flush_stats)
+
+    def draw_graph(self):
+        graph = self.graph
+        graph.delete("all")
+        width, height = graph.winfo_width(), graph.winfo_height()
+        peak = max(max(point) for point in self.history) or 1
+        step = width / (GRAPH_POINTS - 1)
+        # 曲线靠右对齐，最新的点在最右边
+        offset = GRAPH_POINTS - len(self.history)
+        for index, color in ((0, "blue"), (1, "green")):
+            coords = []
+            for i, point in enumerate(self.history):
+                coords += [(offset + i) * step, height - 2 - point[index] / peak * (height - 16)]
+            if len(coords) >= 4:
+                graph.create_line(*coords, fill=color)
+        graph.create_text(4, 2, anchor=tk.NW, text=f"峰值 {format_rate(peak)}", fill="gray")
+
+    def append_log(self, text):
+        """在主线程向日志框追加文本，超过 LOG_MAX_LINES 行时删除最早的行"""
+        # 用户向上翻看时不自动滚动到底部
+        at_bottom = self.log.yview()[1] >= 0.999
+        self.log.insert(tk.END, text)
+        excess = int(self.log.index('end-1c').split('.')[0]) - LOG_MAX_LINES
+        if excess > 0:
+            self.log.delete('1.0', f'{excess + 1}.0')
+        if at_bottom:
+            self.log.see(tk.END)
+
+    def flush_log(self):
+        """Tk 定时器：取出缓冲区中的行一次性插入；行速率过高时只显示速率"""
+        lines = []
+        buffer = self.log_buffer
+        while buffer:
+            lines.append(buffer.popleft())
+        self.line_count += len(lines)
+        now = time.monotonic()
+        elapsed = now - self.rate_time
+        if elapsed >= 1:
+            rate = self.line_count / elapsed
+            self.line_count = 0
+            self.rate_time = now
+            text = f"日志: {rate:.0f} 行/秒"
+            if self.log_dropped:
+                text += f"，缓冲区已丢弃 {self.log_dropped} 行"
+            self.rate_label.config(text=text)
+            if self.log_skipped:
+                self.append_log(f"[{self.log_skipped} 行日志未显示（{rate:.0f} 行/秒）]\n")
+                self.log_skipped = 0
+            self.high_rate = rate > LOG_RATE_THRESHOLD
+        if lines:
+            if self.high_rate:
+                self.log_skipped += len(lines)
+            else:
+                self.append_log(''.join(lines))
+        self.root.after(LOG_FLUSH_MS, self.flush_log)
 
     def toggle_proxy(self):
         """切换代理状态的核心逻辑"""
@@ -135,7 +274,9 @@ class ProxyController:
                 "proxy.exe",
                 remote_ip,
                 str(remote_port),
-                str(local_port)
+                str(local_port),
+                "--metrics-port", "auto",
+                "--log-level", PROXY_LOG_LEVEL
             ]
 
             self.proxy_process = subprocess.Popen(
@@ -148,10 +289,15 @@ class ProxyController:
 
             #self.proxy_running = True
             # self.control_btn.config(text="停止代理")
-            self.log.insert(tk.END, f"代理已启动：{cmd}\n")
+            self.append_log(f"代理已启动：{cmd}\n")
 
             # 启动线程监听输出
+            self.log_buffer.clear()
+            self.log_dropped = self.log_skipped = 0
             threading.Thread(target=self.read_output, daemon=True).start()
+            # 统计流在代理报告统计接口端口后由 read_output 启动
+            self.stats_buffer.clear()
+            self.history.clear()
 
         except Exception as e:
             messagebox.showerror("启动失败", str(e))
@@ -170,7 +316,7 @@ class ProxyController:
             self.proxy_process = None
             # 更新状态
             #self.proxy_running = False
-            self.log.insert(tk.END, "代理已停止\n")
+            self.append_log("代理已停止\n")
 
     def on_window_close(self):
         """ 窗口关闭事件处理函数 """
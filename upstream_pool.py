@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# 预连接池：提前与远端建立 K 个连接，新客户端到达时直接配对，省去一次建连 RTT
+
+import time
+import socket
+import threading
+from collections import deque
+
+from proxy_common import logger, CONN_TIMEOUT, set_keepalive
+
+# 空闲连接最长保留时间（秒），避免被远端的空闲超时悄悄断开
+MAX_IDLE = 60
+# 后台检查空闲连接是否被远端关闭的间隔（秒）
+CHECK_INTERVAL = 5
+
+
+def _is_alive(sock):
+    """非阻塞窥探一个字节：返回空表示远端已关闭；无数据或有数据（如服务端先发的握手包）都视为可用"""
+    try:
+        sock.setblocking(False)
+        return sock.recv(1, socket.MSG_PEEK) != b''
+    except (BlockingIOError, InterruptedError):
+        return True
+    except OSError:
+        return False
+
+
+class WarmPool:
+    """维护 size 个已连接、已设置 KeepAlive 的远端 socket"""
+
+    def __init__(self, remote_addr, size, family=socket.AF_INET, max_idle=MAX_IDLE):
+        self.remote_addr = remote_addr
+        self.size = size
+        self.family = family
+        self.max_idle = max_idle
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.refills = 0
+        self.refill_seconds = 0.0
+        self._idle = deque()  # (socket, 建立时间)
+        self._wakeup = threading.Event()
+        self._stopped = False
+        # 建连线程池中的多个线程同时 acquire()，计数加锁，避免丢失更新
+        self._lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self._refill_loop, name='warm-pool', daemon=True).start()
+        logger.debug(f'Warm pool of {self.size} connections to {self.remote_addr}')
+        return self
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+    def acquire(self):
+        """取出一个可用连接（阻塞模式），池空时返回 None，由调用方自行建连"""
+        now = time.monotonic()
+        while True:
+            try:
+                sock, created = self._idle.popleft()
+            except IndexError:
+                with self._lock:
+                    self.misses += 1
+                self._wakeup.set()
+                return None
+            if now - created < self.max_idle and _is_alive(sock):
+                sock.setblocking(True)
+                with self._lock:
+                    self.hits += 1
+                self._wakeup.set()
+                return sock
+            with self._lock:
+                self.evicted += 1
+            sock.close()
+
+    def _connect(self):
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        try:
+            set_keepalive(sock)
+            sock.settimeout(CONN_TIMEOUT)
+            start = time.monotonic()
+            sock.connect(self.remote_addr)
+        except OSError:
+            sock.close()
+            raise
+        self.refills += 1
+        self.refill_seconds += time.monotonic() - start
+        return sock
+
+    def _evict_stale(self):
+        now = time.monotonic()
+        for _ in range(len(self._idle)):
+            try:
+                sock, created = self._idle.popleft()
+            except IndexError:
+                break
+            if now - created < self.max_idle and _is_alive(sock):
+                self._idle.append((sock, created))
+            else:
+                with self._lock:
+                    self.evicted += 1
+                sock.close()
+
+    def _refill_loop(self):
+        while not self._stopped:
+            self._evict_stale()
+            while not self._stopped and len(self._idle) < self.size:
+                try:
+                    sock = self._connect()
+                except OSError as e:
+                    logger.warning(f'Warm pool connect to {self.remote_addr} failed: {e}')
+                    break
+                self._idle.append((sock, time.monotonic()))
+            self._wakeup.wait(CHECK_INTERVAL)
+            self._wakeup.clear()
+        while self._idle:
+            self._idle.popleft()[0].close()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'idle': len(self._idle),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else None,
+            'evicted': self.evicted,
+            'refill_ms': round(self.refill_seconds / self.refills * 1000, 1) if self.refills else None,
+        }
+
+    def render_metrics(self):
+        return [
+            '# HELP proxy_warm_pool_idle Pre-connected upstream sockets ready for use.',
+            '# TYPE proxy_warm_pool_idle gauge',
+            f'proxy_warm_pool_idle {len(self._idle)}',
+            '# HELP proxy_warm_pool_requests_total Warm pool lookups by result.',
+            '# TYPE proxy_warm_pool_requests_total counter',
+            f'proxy_warm_pool_requests_total{{result="hit"}} {self.hits}',
+            f'proxy_warm_pool_requests_total{{result="miss"}} {self.misses}',
+            '# HELP proxy_warm_pool_evicted_total Pooled sockets dropped because the remote closed them or they aged out.',
+            '# TYPE proxy_warm_pool_evicted_total counter',
+            f'proxy_warm_pool_evicted_total {self.evicted}',
+            '# HELP proxy_warm_pool_refill_seconds Time spent connecting pooled sockets.',
+            '# TYPE proxy_warm_pool_refill_seconds summary',
+            f'proxy_warm_pool_refill_seconds_sum {self.refill_seconds}',
+            f'proxy_warm_pool_refill_seconds_count {self.refills}',
+        ]
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# 多进程工作模式：每个工作进程用 SO_REUSEPORT 绑定同一端口，由内核在进程间分配连接
+
+import time
+import socket
+import multiprocessing
+from multiprocessing.connection import wait
+
+from proxy_common import logger
+
+# 工作进程启动后这么短时间内就退出，视为启动失败，重启前先等待
+RESTART_BACKOFF = 1.0
+
+# 当前进程的工作进程编号，单进程模式为 0
+WORKER_INDEX = 0
+
+
+def reuse_port_supported():
+    return hasattr(socket, 'SO_REUSEPORT')
+
+
+def enable_reuse_port(sock):
+    """允许多个进程绑定同一个监听端口"""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+
+def _worker_main(index, target, args):
+    global WORKER_INDEX
+    WORKER_INDEX = index
+    target(*args)
+
+
+def run_workers(count, target, args=()):
+    """启动 count 个工作进程执行 target(*args)，任一进程退出后自动重新拉起"""
+    workers = {}
+    started = {}
+
+    def spawn(index):
+        proc = multiprocessing.Process(target=_worker_main, args=(index, target, args),
+                                       name=f'proxy-worker-{index}')
+        proc.start()
+        workers[index] = proc
+        started[index] = time.monotonic()
+        logger.debug(f'Worker {index} started, pid {proc.pid}.')
+
+    for index in range(count):
+        spawn(index)
+
+    try:
+        while True:
+            wait([proc.sentinel for proc in workers.values()])
+            for index, proc in list(workers.items()):
+                if proc.is_alive():
+                    continue
+                proc.join()
+                logger.warning(f'Worker {index} (pid {proc.pid}) exited with code {proc.exitcode}, restarting.')
+                if time.monotonic() - started[index] < RESTART_BACKOFF:
+                    time.sleep(RESTART_BACKOFF)
+                spawn(index)
+    except KeyboardInterrupt:
+        logger.debug("Supervisor shutdown by user.")
+    finally:
+        for proc in workers.values():
+            if proc.is_alive():
+                proc.terminate()
+        for proc in workers.values():
+            proc.join()
+        logger.debug('All workers stopped.')
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+# 两个 proxy.py 之间的 zstd 压缩隧道：客户端一侧（zstd-client）把客户端的明文流压缩成帧发给服务端一侧（zstd-server），
+# 服务端一侧解压后转发给真正的远端，回程方向相反。每个连接的每个方向一个流式压缩上下文，后续数据块可以引用之前的内容；
+# 已压缩、已加密等不可压缩的数据跳过压缩原样发送，一段时间后重新试探。
+#
+# 训练字典：python zstd_tunnel.py train 样本文件... -o tunnel.dict [--size 字节数]，两端需使用同一个字典
+
+import sys
+import struct
+import argparse
+import threading
+
+try:
+    import zstandard as zstd  # 可选依赖，见 requirements.txt
+except ImportError:
+    zstd = None
+
+# 隧道两端的模式
+TUNNEL_MODES = ('zstd-client', 'zstd-server')
+# 默认压缩级别（1~22，越高越慢）
+ZSTD_LEVEL = 3
+# 不小于该大小的数据块才判断是否可压缩，太小的块压缩后本来就可能变大
+BYPASS_MIN = 512
+# 压缩后仍不小于原大小的该比例视为不可压缩
+BYPASS_RATIO = 0.9
+# 判定不可压缩后，之后这么多字节直接原样发送，再重新试探
+BYPASS_BYTES = 1024 * 1024
+# 默认字典大小
+DICT_SIZE = 112640
+
+# 客户端一侧建连后首先发出的前导：魔数、版本、字典 ID；字典不一致时服务端一侧直接断开
+PREAMBLE = struct.Struct('!4sBI')
+MAGIC = b'PZT\0'
+VERSION = 1
+# 帧头：类型 + 负载长度
+FRAME = struct.Struct('!BI')
+FRAME_RAW = 0
+FRAME_ZSTD = 1
+MAX_FRAME = 16 * 1024 * 1024
+
+
+def tunnel_supported():
+    """是否安装了 zstandard"""
+    return zstd is not None
+
+
+class _Encoder:
+    """一个方向的压缩：明文数据块 -> 帧"""
+    __slots__ = ('tunnel', 'compressor', 'bypass')
+
+    def __init__(self, tunnel):
+        self.tunnel = tunnel
+        # ZstdCompressor 不能被多个流同时使用，每个方向单独创建
+        self.compressor = zstd.ZstdCompressor(level=tunnel.level, dict_data=tunnel.dictionary).compressobj()
+        self.bypass = 0
+
+    def __call__(self, data):
+        size = len(data)
+        if self.bypass > 0:
+            # 原样发送的数据两端都不经过压缩上下文，流状态保持一致
+            self.bypass -= size
+            frame = FRAME.pack(FRAME_RAW, size) + data
+            self.tunnel.count_tx(size, len(frame), size)
+            return frame
+        payload = self.compressor.compress(data) + self.compressor.flush(zstd.COMPRESSOBJ_FLUSH_BLOCK)
+        if size >= BYPASS_MIN and len(payload) >= size * BYPASS_RATIO:
+            self.bypass = BYPASS_BYTES
+        frame = FRAME.pack(FRAME_ZSTD, len(payload)) + payload
+        self.tunnel.count_tx(size, len(frame), 0)
+        return frame
+
+
+class _Decoder:
+    """一个方向的解压：收到的字节流 -> 明文，不完整的帧留到下次"""
+    __slots__ = ('tunnel', 'decompressor', 'buffer', 'preamble')
+
+    def __init__(self, tunnel, preamble):
+        self.tunnel = tunnel
+        self.decompressor = zstd.ZstdDecompressor(dict_data=tunnel.dictionary).decompressobj()
+        self.buffer = bytearray()
+        self.preamble = preamble  # 服务端一侧先校验前导
+
+    def __call__(self, data):
+        buf = self.buffer
+        buf += data
+        if self.preamble:
+            if len(buf) < PREAMBLE.size:
+                return b''
+            magic, version, dict_id = PREAMBLE.unpack_from(buf)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('not a zstd tunnel peer')
+            if dict_id != self.tunnel.dict_id:
+                raise ValueError(f'dictionary mismatch: peer {dict_id}, local {self.tunnel.dict_id}')
+            del buf[:PREAMBLE.size]
+            self.preamble = False
+        chunks = []
+        wire = 0
+        while len(buf) >= FRAME.size:
+            kind, length = FRAME.unpack_from(buf)
+            if kind not in (FRAME_RAW, FRAME_ZSTD) or length > MAX_FRAME:
+                raise ValueError(f'bad frame type {kind} length {length}')
+            end = FRAME.size + length
+            if len(buf) < end:
+                break
+            payload = bytes(buf[FRAME.size:end])
+            del buf[:end]
+            wire += end
+            chunks.append(self.decompressor.decompress(payload) if kind == FRAME_ZSTD else payload)
+        data = b''.join(chunks)
+        if wire:
+            self.tunnel.count_rx(len(data), wire)
+        return data
+
+
+class Tunnel:
+    """一个映射的隧道配置与统计；codecs() 为每个连接创建上下行两个方向的转换函数"""
+
+    def __init__(self, mode, level=ZSTD_LEVEL, dict_path=None, name=''):
+        if zstd is None:
+            raise ValueError('zstd tunnel needs the zstandard package (pip install zstandard).')
+        self.name = name
+        self.raw_tx = self.wire_tx = self.bypassed = 0  # 压缩后发往隧道
+        self.raw_rx = self.wire_rx = 0  # 从隧道收到并解压
+        self._lock = threading.Lock()
+        self.configure(mode, level, dict_path)
+
+    def configure(self, mode, level=ZSTD_LEVEL, dict_path=None):
+        """修改配置，只影响之后的新连接"""
+        if mode not in TUNNEL_MODES:
+            raise ValueError(f'unknown tunnel mode {mode}')
+        dictionary = None
+        if dict_path:
+            with open(dict_path, 'rb') as f:
+                dictionary = zstd.ZstdCompressionDict(f.read())
+            # 预先按压缩级别处理字典，每个连接创建压缩上下文时不再重复
+            dictionary.precompute_compress(level=level)
+        self.mode, self.level, self.dict_path, self.dictionary = mode, level, dict_path, dictionary
+        self.dict_id = dictionary.dict_id() if dictionary else 0
+
+    def preamble(self):
+        """客户端一侧连上远端后立即发送，不等待应答，不增加往返"""
+        return PREAMBLE.pack(MAGIC, VERSION, self.dict_id)
+
+    def codecs(self):
+        """返回 (客户端 -> 远端, 远端 -> 客户端) 两个方向的转换函数"""
+        if self.mode == 'zstd-client':
+            return _Encoder(self), _Decoder(self, False)
+        return _Decoder(self, True), _Encoder(self)
+
+    def count_tx(self, raw, wire, bypassed):
+        with self._lock:
+            self.raw_tx += raw
+            self.wire_tx += wire
+            self.bypassed += bypassed
+
+    def count_rx(self, raw, wire):
+        with self._lock:
+            self.raw_rx += raw
+            self.wire_rx += wire
+
+    def ratio(self):
+        """压缩比：明文字节 / 隧道上的字节（含帧头），两个方向合计"""
+        wire = self.wire_tx + self.wire_rx
+        return round((self.raw_tx + self.raw_rx) / wire, 3) if wire else None
+
+    def stats(self):
+        return {'mode': self.mode, 'level': self.level, 'dict_id': self.dict_id, 'raw_tx': self.raw_tx,
+                'wire_tx': self.wire_tx, 'raw_rx': self.raw_rx, 'wire_rx': self.wire_rx,
+                'bypassed': self.bypassed, 'ratio': self.ratio()}
+
+    def render_metrics(self):
+        return render_tunnel_metrics([self])
+
+
+_TUNNEL_METRICS = (
+    ('proxy_tunnel_raw_bytes_total', 'counter', 'Uncompressed bytes carried by the tunnel.',
+     lambda tunnel: {'tx': tunnel.raw_tx, 'rx': tunnel.raw_rx}),
+    ('proxy_tunnel_wire_bytes_total', 'counter', 'Bytes on the tunnel link, including frame headers.',
+     lambda tunnel: {'tx': tunnel.wire_tx, 'rx': tunnel.wire_rx}),
+    ('proxy_tunnel_bypassed_bytes_total', 'counter', 'Bytes sent uncompressed because they did not compress.',
+     lambda tunnel: {'tx': tunnel.bypassed}),
+)
+
+
+def render_tunnel_metrics(tunnels):
+    """多个 Tunnel 的指标，按指标名分组输出"""
+    lines = []
+    for name, kind, help_text, value in _TUNNEL_METRICS:
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+        for tunnel in tunnels:
+            label = f'mapping="{tunnel.name}",' if tunnel.name else ''
+            for direction, count in value(tunnel).items():
+                lines.append(f'{name}{{{label}direction="{direction}"}} {count}')
+    name = 'proxy_tunnel_compression_ratio'
+    lines += [f'# HELP {name} Uncompressed bytes divided by tunnel bytes, both directions.', f'# TYPE {name} gauge']
+    for tunnel in tunnels:
+        labels = f'{{mapping="{tunnel.name}"}}' if tunnel.name else ''
+        lines.append(f'{name}{labels} {tunnel.ratio() or 0}')
+    return lines
+
+
+def train_dictionary(paths, size=DICT_SIZE):
+    """用样本文件训练字典，样本应是隧道上典型的明文数据（SQL、JSON、日志等）"""
+    samples = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            samples.append(f.read())
+    return zstd.train_dictionary(size, samples)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python zstd_tunnel.py', description='zstd 隧道工具')
+    sub = parser.add_subparsers(dest='command', required=True)
+    train = sub.add_parser('train', help='用样本文件训练压缩字典')
+    train.add_argument('samples', nargs='+', help='样本文件，建议数百个以上')
+    train.add_argument('-o', '--output', required=True, help='字典输出文件')
+    train.add_argument('--size', type=int, default=DICT_SIZE, help='字典大小（字节）')
+    args = parser.parse_args(argv)
+    if zstd is None:
+        parser.error('zstandard is not installed (pip install zstandard).')
+    try:
+        dictionary = train_dictionary(args.samples, args.size)
+    except zstd.ZstdError as e:
+        parser.error(f'{e} (more or larger samples are needed)')
+    with open(args.output, 'wb') as f:
+        f.write(dictionary.as_bytes())
+    print(f'Dictionary {dictionary.dict_id()} ({len(dictionary)} bytes) written to {args.output}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()